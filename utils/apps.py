@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class UtilsConfig(AppConfig):
+  name = 'utils'
+
+  def ready(self):
+    # The static metadata of the models is computed once, see static_metadata
+    from utils.model_streaming.static_metadata import load_static_metadata
+    load_static_metadata()
+    # The payload cache invalidation receivers, see payload_cache
+    from utils.model_streaming.payload_cache import connect_cached_models
+    connect_cached_models()
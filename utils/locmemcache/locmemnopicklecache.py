@@ -23,13 +23,28 @@
 # timeout conecpt introduced in Django 1.7.
 
 import time
+import threading
 
 from django.core.cache.backends.base import BaseCache
-from django.utils.synch import RWLock
+# Passed by BaseCache (e.g. set_many) when no timeout is given
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+try:
+    from django.utils.synch import RWLock
+except ImportError:
+    # django.utils.synch was removed in Django 3.0: the readers and writers
+    # share an exclusive lock
+    class RWLock(object):
+        def __init__(self):
+            self._lock = threading.RLock()
 
-# Stub class to ensure not passing in a `timeout` argument results in
-# the default timeout
-DEFAULT_TIMEOUT = object()
+        def reader_enters(self):
+            self._lock.acquire()
+
+        def reader_leaves(self):
+            self._lock.release()
+
+        writer_enters = reader_enters
+        writer_leaves = reader_leaves
 
 # Global in-memory store of cache data. Keyed by name, to provide
 # multiple named local memory caches.
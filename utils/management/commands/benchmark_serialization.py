@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+
+class Command(BaseCommand):
+  help = ('Benchmark the serialization modes of model_streaming on a generated fakeapp graph, and save the '
+          'results as JSON. The graph is written to the default database: use a disposable one.')
+
+  def add_arguments(self, parser):
+    parser.add_argument('--sizes', default='1000',
+                        help='comma separated numbers of ModelToDictTestModel, e.g. 1000,100000,1000000')
+    parser.add_argument('--fan-out', type=int, default=3, help='related objects per reverse relation')
+    parser.add_argument('--m2m-fan-out', type=int, default=3, help='related objects per many to many relation')
+    parser.add_argument('--mode', action='append', dest='modes', help='mode measured (default: all), repeatable')
+    parser.add_argument('--no-memory', action='store_false', dest='memory', help='do not measure the peak memory')
+    parser.add_argument('--output', help='file the results are saved to')
+    parser.add_argument('--compare', help='results of a previous run compared to this one (requires --output)')
+
+  def handle(self, *args, **options):
+    # The benchmark imports the fakeapp models, which must be installed
+    from utils.tests.benchmarks import serialization
+    try:
+      sizes = [int(size) for size in options['sizes'].split(',')]
+    except ValueError as e:
+      raise CommandError(e)
+    if options['compare'] and not options['output']:
+      raise CommandError('--compare requires --output')
+    modes = options['modes']
+    if modes is not None:
+      unknown = set(modes) - set(name for name, function, limit in serialization.MODES)
+      if unknown:
+        raise CommandError('unknown modes: %s' % ', '.join(sorted(unknown)))
+    serialization.main(sizes, options['output'], options['fan_out'], options['m2m_fan_out'], modes, options['memory'])
+    if options['compare']:
+      serialization.compare(options['compare'], options['output'])
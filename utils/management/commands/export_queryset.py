@@ -0,0 +1,42 @@
+import json
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from utils.model_streaming.parallel_streaming import export_queryset
+
+
+class Command(BaseCommand):
+  help = ('Export the instances of a model to a file with model_to_dict, the ranges of primary keys being '
+          'encoded by a pool of processes. An interrupted export restarts after the last range written.')
+
+  def add_arguments(self, parser):
+    parser.add_argument('model', help='app_label.ModelName')
+    parser.add_argument('path', help='output file')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='number of processes (default: number of CPUs, 0: no pool)')
+    parser.add_argument('--range-size', type=int, default=20000, help='instances per range')
+    parser.add_argument('--chunk-size', type=int, default=2000, help='instances fetched at once')
+    parser.add_argument('--format', choices=('json', 'msgpack'), default='json')
+    parser.add_argument('--database', default='default')
+    parser.add_argument('--options', default='{}',
+                        help='keyword arguments of model_to_dict as a JSON object, e.g. {"max_depth": 1}')
+
+  def handle(self, *args, **options):
+    try:
+      model = apps.get_model(options['model'])
+      kwargs = json.loads(options['options'])
+    except (LookupError, ValueError) as e:
+      raise CommandError(e)
+    if not isinstance(kwargs, dict):
+      raise CommandError('--options must be a JSON object')
+    queryset = model._default_manager.using(options['database']).all()
+
+    def progress(done, total, count):
+      self.stderr.write('%i/%i ranges, %i instances' % (done, total, count))
+
+    try:
+      count = export_queryset(queryset, options['path'], options['processes'], options['range_size'],
+                              options['format'], options['chunk_size'], progress, **kwargs)
+    except ValueError as e:
+      raise CommandError(e)
+    self.stdout.write('%i instances exported to %s' % (count, options['path']))
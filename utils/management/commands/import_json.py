@@ -0,0 +1,40 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from utils.model_streaming.bulk_import import import_json
+
+
+class Command(BaseCommand):
+  help = ('Import a JSON array of records in the model_to_dict shape (e.g. written by export_queryset) into a '
+          'model, by chunks: the records update the instances having their key and create the others.')
+
+  def add_arguments(self, parser):
+    parser.add_argument('model', help='app_label.ModelName')
+    parser.add_argument('path', help='input file')
+    parser.add_argument('--chunk-size', type=int, default=500, help='records applied at once')
+    parser.add_argument('--key', default='pk', help='field identifying the records, e.g. uuid (default: pk)')
+    parser.add_argument('--database', default='default')
+
+  def handle(self, *args, **options):
+    try:
+      model = apps.get_model(options['model'])
+    except (LookupError, ValueError) as e:
+      raise CommandError(e)
+    reported = [0]
+
+    def progress(result):
+      for index, message in result.errors[reported[0]:]:
+        self.stderr.write('record %i: %s' % (index, message))
+      reported[0] = len(result.errors)
+      self.stderr.write('%i records, %i created, %i updated, %i errors' % (
+        result.records, result.created, result.updated, len(result.errors)))
+
+    try:
+      result = import_json(model, options['path'], options['chunk_size'], options['key'], options['database'],
+                           progress)
+    except (IOError, OSError, ValueError) as e:
+      raise CommandError(e)
+    self.stdout.write('%i records imported to %s: %i created, %i updated, %i unchanged' % (
+      result.records - len(result.errors), options['model'], result.created, result.updated, result.unchanged))
+    if result.errors:
+      raise CommandError('%i records not imported' % len(result.errors))
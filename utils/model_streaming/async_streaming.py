@@ -0,0 +1,124 @@
+from itertools import islice
+from asgiref.sync import sync_to_async
+from django.db.models import prefetch_related_objects
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.model_streaming import relation_attname
+from utils.model_streaming.queryset_streaming import is_aggregate
+from utils.model_streaming.queryset_streaming import relation_tree
+from utils.model_streaming.queryset_streaming import tree_map
+from utils.model_streaming.queryset_streaming import model_tree_map
+from utils.model_streaming.queryset_streaming import tree_lookups
+from utils.model_streaming.queryset_streaming import chunked_queryset
+from utils.model_streaming.queryset_streaming import load_references
+from utils.model_streaming.field_selectors import compile_selector
+from utils.model_streaming.values_streaming import flat_projection
+from utils.model_streaming.values_streaming import projection_dict
+from utils.model_streaming.values_streaming import projection_values
+
+try:
+  from django.db.models import aprefetch_related_objects
+except ImportError:
+  # Before Django 5.0, the prefetch queries run in the sync thread
+  aprefetch_related_objects = sync_to_async(prefetch_related_objects)
+
+# The ids of the references are read in the sync thread
+aload_references = sync_to_async(load_references)
+
+
+#
+# Async API for the ASGI deployments (Python 3 only)
+#
+# The rows are read with the async ORM (aiterator) and the relations of
+# each chunk are loaded with aprefetch_related_objects, so model_to_dict runs
+# on instances already holding all the relations it follows and does not
+# query the database. The encoding of a chunk runs on the event loop: a
+# smaller chunk_size lets other requests interleave more often.
+#
+async def amodel_to_dict(instance, **kwargs):
+  """ Async version of model_to_dict: the relations of the instance are first
+  loaded with the async ORM. Takes the same keyword arguments as
+  model_to_dict.
+  """
+  tree = relation_tree(instance.__class__,
+                       kwargs.get('included_fields', None),
+                       kwargs.get('excluded_fields', None),
+                       kwargs.get('max_depth', 100),
+                       kwargs.get('expand', None),
+                       kwargs.get('relations', None),
+                       selection=compile_selector(kwargs.get('select', None)))
+  # The counts and flags are annotated on the querysets, not on a loaded
+  # instance
+  for field_name, field, subtree, options, plan in tree:
+    if is_aggregate(options):
+      manager = getattr(instance, field_name)
+      value = await (manager.acount() if options.get('count', False) else manager.aexists())
+      setattr(instance, relation_attname(field_name), value)
+  select_related, prefetch_related, annotations = tree_lookups(tree)
+  if select_related or prefetch_related:
+    await aprefetch_related_objects([instance], *(select_related + prefetch_related))
+  await aload_references([instance], tree)
+  return model_to_dict(instance, tree=tree_map(tree), **kwargs)
+
+
+async def aiterate_chunks(queryset, chunk_size=2000, **kwargs):
+  """ Async version of iterate_chunks: async generator yielding lists of at
+  most chunk_size instances with all their relations loaded.
+  """
+  queryset, prefetch_related, tree = chunked_queryset(queryset, **kwargs)
+  chunk = []
+  async for instance in queryset.aiterator(chunk_size=chunk_size):
+    chunk.append(instance)
+    if len(chunk) == chunk_size:
+      if prefetch_related:
+        await aprefetch_related_objects(chunk, *prefetch_related)
+      await aload_references(chunk, tree)
+      yield chunk
+      chunk = []
+  if chunk:
+    if prefetch_related:
+      await aprefetch_related_objects(chunk, *prefetch_related)
+    await aload_references(chunk, tree)
+    yield chunk
+
+
+async def aiterate_dict_chunks(queryset, chunk_size=2000, **kwargs):
+  """ Async version of iterate_dict_chunks """
+  projection = flat_projection(queryset.model, **kwargs)
+  if projection is None:
+    tree = model_tree_map(queryset.model, **kwargs)
+    async for chunk in aiterate_chunks(queryset, chunk_size, **kwargs):
+      yield [model_to_dict(instance, tree=tree, **kwargs) for instance in chunk]
+    return
+  model_name = queryset.model.__name__
+  # aiterator() of values_list() runs the query in the async thread on some
+  # Django versions, the chunks of the sync iterator are read in the sync
+  # thread as aiterator() does
+  rows = projection_values(queryset, projection).iterator(chunk_size=chunk_size)
+  read_chunk = sync_to_async(lambda: list(islice(rows, chunk_size)))
+  while True:
+    chunk = await read_chunk()
+    if not chunk:
+      break
+    yield [projection_dict(model_name, projection, row) for row in chunk]
+
+
+async def aqueryset_to_dicts(queryset, chunk_size=2000, **kwargs):
+  """ Async version of queryset_to_dicts. Takes the same keyword arguments as
+  queryset_to_dicts.
+  """
+  return [d async for chunk in aiterate_dict_chunks(queryset, chunk_size, **kwargs) for d in chunk]
+
+
+async def astream_queryset_json(queryset, chunk_size=2000, **kwargs):
+  """ Async generator yielding the JSON array of the instances of a queryset,
+  one fragment per chunk, as stream_queryset_json. Can be given as is to a
+  StreamingHttpResponse in an async view:
+    StreamingHttpResponse(astream_queryset_json(queryset), content_type='application/json')
+  Takes the same keyword arguments as queryset_to_dicts.
+  """
+  separator = '['
+  async for chunk in aiterate_dict_chunks(queryset, chunk_size, **kwargs):
+    yield separator + ','.join(dumps(d) for d in chunk)
+    separator = ','
+  yield ']' if separator == ',' else '[]'
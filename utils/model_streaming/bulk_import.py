@@ -0,0 +1,354 @@
+import re
+import json
+import codecs
+import decimal
+import itertools
+from django.db import router
+from django.db import DatabaseError
+from django.db.models import prefetch_related_objects
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.exceptions import ValidationError
+from utils.model_streaming.update_model_from_dict import UnitOfWork
+from utils.model_streaming.update_model_from_dict import dict_lookups
+from utils.model_streaming.update_model_from_dict import update_model_from_dict
+from utils.model_streaming.update_model_from_dict import writer_plan
+from utils.model_streaming.update_model_from_dict import SET_VALUE
+from utils.model_streaming.update_model_from_dict import SET_FOREIGN
+from utils.model_streaming.update_model_from_dict import UPDATE_RELATED
+from utils.model_streaming.update_model_from_dict import RELATED_LIST
+
+
+#
+# Incremental parser of a JSON array
+#
+# The array is read by blocks and its elements decoded one at a time, so that
+# only the element being decoded and one block are held in memory. A block
+# ending inside an element is completed with the next ones, read in blocks
+# as large as the text already held so that a large element is decoded in
+# linear time.
+# The numbers with a fraction are decoded as Decimal by default, as
+# update_model_from_dict converts them to the value of their field.
+#
+_whitespace = re.compile(r'[ \t\n\r]*')
+_number_start = '-0123456789'
+_number_characters = '.eE+-0123456789'
+
+
+class JSONArrayParser(object):
+  """ Iterable over the elements of the JSON array read from stream, a file
+  (binary, UTF-8 encoded, or text) or any object having a read method.
+  Raise ValueError, with the position of the error, if the text is not a JSON
+  array.
+  """
+  def __init__(self, stream, buffer_size=65536, parse_float=decimal.Decimal):
+    self.stream = stream
+    self.buffer_size = buffer_size
+    self.decoder = json.JSONDecoder(parse_float=parse_float)
+    self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+    self.buffer = u''
+    # position in the buffer, and number of characters dropped before it
+    self.position = 0
+    self.offset = 0
+    self.eof = False
+
+  def fill(self, size=None):
+    """ Append the next block to the buffer, dropping the text already
+    decoded. Return False at the end of the stream.
+    """
+    if self.eof:
+      return False
+    block = self.stream.read(size or self.buffer_size)
+    if isinstance(block, bytes):
+      text = self.text_decoder.decode(block, not block)
+    else:
+      text = block
+    if not block:
+      self.eof = True
+    self.offset += self.position
+    self.buffer = self.buffer[self.position:] + text
+    self.position = 0
+    return True
+
+  def error(self, message):
+    return ValueError('%s at character %i' % (message, self.offset + self.position))
+
+  def skip_whitespace(self):
+    while True:
+      self.position = _whitespace.match(self.buffer, self.position).end()
+      if self.position < len(self.buffer) or not self.fill():
+        return
+
+  def expect(self, characters):
+    """ Consume the next character, which must be one of characters """
+    self.skip_whitespace()
+    if self.position == len(self.buffer):
+      raise self.error('unexpected end of the JSON array')
+    character = self.buffer[self.position]
+    if character not in characters:
+      raise self.error('expected %s' % ' or '.join(repr(str(c)) for c in characters))
+    self.position += 1
+    return character
+
+  def decode_element(self):
+    self.skip_whitespace()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.position)
+      except ValueError as e:
+        # The element may continue in the next block
+        if not self.fill(max(self.buffer_size, len(self.buffer))):
+          raise self.error('invalid element (%s)' % e)
+        continue
+      # A number may continue in the next block, decoded short when the block
+      # ends in it or right after its '.' or exponent
+      if self.buffer[self.position] in _number_start and \
+         (end == len(self.buffer) or self.buffer[end] in _number_characters) and \
+         self.fill(max(self.buffer_size, len(self.buffer))):
+        continue
+      self.position = end
+      return value
+
+  def __iter__(self):
+    self.expect('[')
+    self.skip_whitespace()
+    if self.buffer.startswith(']', self.position):
+      self.position += 1
+    else:
+      while True:
+        yield self.decode_element()
+        if self.expect(',]') == ']':
+          break
+    self.skip_whitespace()
+    if self.position < len(self.buffer):
+      raise self.error('extra data after the JSON array')
+
+
+def iterate_json_array(stream, buffer_size=65536, parse_float=decimal.Decimal):
+  """ Generator yielding the elements of the JSON array read from stream,
+  see JSONArrayParser.
+  """
+  return iter(JSONArrayParser(stream, buffer_size, parse_float))
+
+
+def iterate_chunks(iterable, chunk_size):
+  """ Generator yielding the elements of iterable in lists of chunk_size """
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, chunk_size))
+    if not chunk:
+      return
+    yield chunk
+
+
+#
+# Bulk import of records in the model_to_dict shape
+#
+# The records are applied by chunks: the existing instances of a chunk are
+# loaded with one query (in_bulk on the primary key or on another field
+# identifying the records, eg. uuid) and their relations followed by the
+# records prefetched, then each record is applied with update_model_from_dict
+# in a unit of work, and the writes of the chunk flushed with bulk queries in
+# one transaction (see UnitOfWork.flush). The number of queries per chunk
+# depends on the relations and models, not on the number of records, and
+# only one chunk is held in memory.
+#
+# A record which can not be applied (not in the model_to_dict shape, unknown
+# related object, invalid value...) is skipped, the others of its chunk being
+# written, and the instances it changed before failing restored. A chunk
+# whose writes fail (eg. an integrity error) is not written at all, each of
+# its records being reported as an error, the import going on with the next
+# chunk.
+#
+# Errors of a record, reported: the shape of the records is checked first
+# (see check_record), so that any other error is a bug and stops the import
+RECORD_ERRORS = (ValueError, ObjectDoesNotExist, ValidationError)
+
+
+class ImportResult(object):
+  """ Outcome of import_records:
+  records -- number of records read
+  created, updated, unchanged -- number of records which created an instance,
+  changed an existing instance (or its related objects), or did not change
+  anything
+  errors -- list of (index of the record, message) of the records not
+  imported
+  """
+  def __init__(self):
+    self.records = 0
+    self.created = 0
+    self.updated = 0
+    self.unchanged = 0
+    self.errors = []
+
+
+def existing_instances(queryset, key_field, keys):
+  """ Return { key: instance } of the instances whose key_field is in keys """
+  if not keys:
+    return {}
+  if key_field.primary_key or key_field.unique:
+    return queryset.in_bulk(list(keys), field_name=key_field.name)
+  # in_bulk requires a unique field
+  return dict((getattr(x, key_field.attname), x) for x in queryset.filter(**{ key_field.name + '__in': keys }))
+
+
+def check_record(model, record, name='the record'):
+  """ Raise ValueError if a record is not in the model_to_dict shape applied
+  by update_model_from_dict: the record, the elements of its related lists
+  and its related objects must be dictionaries, and its choices must select
+  one of the choices of their field.
+  """
+  if not isinstance(record, dict):
+    raise ValueError('%s is not a dictionary' % name)
+  actions = writer_plan(model).actions
+  for key, value in record.items():
+    if key not in actions:
+      continue
+    action, field, convert = actions[key]
+    if action == RELATED_LIST and isinstance(value, list):
+      for position, element in enumerate(value):
+        check_record(field.related_model, element, '%s[%i]' % (key, position))
+    elif action in (SET_FOREIGN, UPDATE_RELATED) and isinstance(value, dict):
+      check_record(field.related_model, value, key)
+    elif action == SET_VALUE and getattr(field, 'choices', None) and isinstance(value, dict) and 'selected' in value:
+      selected = value['selected']
+      if not isinstance(selected, int) or isinstance(selected, bool) or not 0 <= selected < len(field.choices):
+        raise ValueError('%s selects no choice of %s' % (key, model.__name__))
+
+
+def record_key(key_field, record):
+  if not isinstance(record, dict):
+    raise ValueError('the record is not a dictionary')
+  value = record.get(key_field.name, None)
+  return None if value is None else key_field.to_python(value)
+
+
+def loaded_instances(instance, found=None):
+  """ Return { id(): instance } of an instance and of the related objects
+  loaded with it (prefetched lists and related objects, at every level).
+  """
+  if found is None:
+    found = {}
+  if id(instance) in found:
+    return found
+  found[id(instance)] = instance
+  for related_instance in instance._state.fields_cache.values():
+    if related_instance is not None:
+      loaded_instances(related_instance, found)
+  for related_instances in getattr(instance, '_prefetched_objects_cache', {}).values():
+    for related_instance in related_instances:
+      loaded_instances(related_instance, found)
+  return found
+
+
+def instance_states(instance):
+  """ Save the field values and the related objects of an instance and of
+  the related objects loaded with it, to be restored with restore_states.
+  """
+  states = []
+  for loaded in loaded_instances(instance).values():
+    values = dict((field.attname, loaded.__dict__[field.attname]) for field in loaded._meta.concrete_fields
+                  if field.attname in loaded.__dict__)
+    states.append((loaded, values, dict(loaded._state.fields_cache)))
+  return states
+
+
+def restore_states(states):
+  for instance, values, fields_cache in states:
+    instance.__dict__.update(values)
+    instance._state.fields_cache = fields_cache
+
+
+def import_chunk(model, key_field, records, first, db, result):
+  """ Apply a chunk of records, first being the index of its first record """
+  keys = set()
+  for record in records:
+    try:
+      keys.add(record_key(key_field, record))
+    except RECORD_ERRORS:
+      # reported when the record is applied
+      pass
+  keys.discard(None)
+  existing = existing_instances(model._base_manager.using(db), key_field, keys)
+  if existing:
+    lookups = []
+    for record in records:
+      if isinstance(record, dict):
+        dict_lookups(model, record, '', lookups)
+    if lookups:
+      prefetch_related_objects(list(existing.values()), *lookups)
+  unit_of_work = UnitOfWork(db)
+  created = updated = unchanged = 0
+  errors = []
+  for index, record in enumerate(records, first):
+    # The writes of each record are collected apart, so that a record failing
+    # half way does not leave writes in the unit of work of the chunk, and the
+    # instances shared with the other records of the chunk restored
+    record_unit_of_work = UnitOfWork(db)
+    states = None
+    try:
+      check_record(model, record)
+      key = record_key(key_field, record)
+      instance = existing.get(key, None) if key is not None else None
+      if instance is not None:
+        states = instance_states(instance)
+      if instance is None:
+        instance = model(**({ key_field.attname: key } if key is not None else {}))
+        update_model_from_dict(instance, record, None, record_unit_of_work)
+        if key is not None:
+          existing[key] = instance
+        created += 1
+      elif update_model_from_dict(instance, record, None, record_unit_of_work):
+        updated += 1
+      else:
+        unchanged += 1
+    except RECORD_ERRORS as e:
+      if states is not None:
+        restore_states(states)
+      errors.append((index, '%s: %s' % (e.__class__.__name__, e)))
+      continue
+    unit_of_work.merge(record_unit_of_work)
+  try:
+    unit_of_work.flush()
+  except DatabaseError as e:
+    # None of the records of the chunk is imported
+    message = 'chunk of records %i to %i not written, %s: %s' % (first, first + len(records) - 1,
+                                                                  e.__class__.__name__, e)
+    failed = dict(errors)
+    result.errors.extend((index, failed.get(index, message)) for index in range(first, first + len(records)))
+    return
+  result.created += created
+  result.updated += updated
+  result.unchanged += unchanged
+  result.errors.extend(errors)
+
+
+def import_records(model, records, chunk_size=500, key='pk', using=None, progress=None):
+  """ Apply records in the model_to_dict shape to the instances of a model,
+  chunk_size records at a time. A record updates the instance having its key
+  or creates one. Return the ImportResult.
+  Keyword arguments:
+  records -- iterable of the records, eg. iterate_json_array
+  key -- name of the field identifying the records ('pk', 'uuid'...); a
+  record without key always creates an instance
+  using -- database alias, the one of the router by default
+  progress -- callable receiving the ImportResult after each chunk
+  """
+  key_field = model._meta.pk if key == 'pk' else model._meta.get_field(key)
+  if not key_field.concrete or key_field.is_relation:
+    raise ValueError('%s can not identify the records' % key)
+  db = using or router.db_for_write(model)
+  result = ImportResult()
+  for chunk in iterate_chunks(records, chunk_size):
+    import_chunk(model, key_field, chunk, result.records, db, result)
+    result.records += len(chunk)
+    if progress is not None:
+      progress(result)
+  return result
+
+
+def import_json(model, path, chunk_size=500, key='pk', using=None, progress=None, buffer_size=65536):
+  """ Import the JSON array of records of a file (eg. written by
+  export_queryset), see import_records.
+  """
+  with open(path, 'rb') as stream:
+    return import_records(model, iterate_json_array(stream, buffer_size), chunk_size, key, using, progress)
@@ -0,0 +1,135 @@
+from itertools import islice
+from django.db import models
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.model_streaming import compile_plan
+from utils.model_streaming.model_streaming import Choice_serializer
+from utils.model_streaming.model_streaming import BitField_serializer
+from utils.model_streaming.static_streaming import model_static_to_dict
+from utils.model_streaming.values_streaming import column_converter
+from utils.model_streaming.field_selectors import compile_selector
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+#
+# Columnar export: the instances of a queryset are output as one list of
+# values per field instead of one dictionary per instance.
+#   { 'columns': [{ 'name': 'id', 'type': 'AutoField' }, ...],
+#     'data': { 'id': [12, 13], ... } }
+# The fields with choices hold the selected index and the bitfields the
+# integer mask, the labels being in the description of the column. The
+# relations are not expanded, the ForeignKeys hold the id of the related
+# object.
+#
+
+# numpy dtype of the columns stored as numpy arrays when numpy is installed
+numeric_dtypes = {
+  'AutoField': 'int64',
+  'BigAutoField': 'int64',
+  'IntegerField': 'int64',
+  'BigIntegerField': 'int64',
+  'SmallIntegerField': 'int64',
+  'PositiveIntegerField': 'int64',
+  'PositiveSmallIntegerField': 'int64',
+  'FloatField': 'float64',
+}
+
+
+def column_description(field, serializer, static):
+  """ Return the description of the column of a field, with the labels of the
+  choices and of the bitfields taken from the static metadata of the model.
+  Keyword arguments:
+  field -- the field
+  serializer -- the serializer of the field
+  static -- the outcome of model_static_to_dict for the model
+  """
+  description = { 'name': field.name, 'type': field.get_internal_type() }
+  if serializer is Choice_serializer:
+    description['labels'] = static[field.name]['labels']
+  elif serializer is BitField_serializer:
+    description['labels'] = [flag['label'] for flag in static[field.name]]
+  elif isinstance(field, models.ForeignKey):
+    description['model'] = field.related_model.__name__
+  return description
+
+
+def columnar_projection(model, included_fields=None, excluded_fields=None, selection=None):
+  """ Return the list of (column description, values_list column, converter,
+  numpy dtype or None) of the columnar export of a model.
+  Keyword arguments:
+  model -- the model class
+  included_fields -- see model_to_dict
+  excluded_fields -- see model_to_dict
+  selection -- the Selection of the fields, see compile_plan
+  """
+  static = model_static_to_dict(model)
+  projection = [({ 'name': 'id', 'type': model._meta.pk.get_internal_type() }, 'pk', None,
+                 numeric_dtypes.get(model._meta.pk.get_internal_type(), None))]
+  for field_name, getter, serializer, field in compile_plan(model, included_fields, excluded_fields, selection):
+    if field_name == 'id' or not field.concrete or field.many_to_many:
+      # the reverse and many to many relations are not columns of the model
+      continue
+    description = column_description(field, serializer, static)
+    if isinstance(field, models.ForeignKey):
+      converter = None
+      dtype = numeric_dtypes.get(field.target_field.get_internal_type(), None)
+    else:
+      converter = column_converter(field, serializer, compact=True)
+      dtype = 'int64' if serializer is Choice_serializer else numeric_dtypes.get(description['type'], None)
+    projection.append((description, field.attname, converter, dtype))
+  return projection
+
+
+def build_column(batches, dtype):
+  """ Join the batches of a column, in a numpy array when numpy is installed,
+  the column is numeric and has no null value.
+  """
+  if numpy is not None and dtype is not None and not any(None in batch for batch in batches):
+    return numpy.concatenate([numpy.array(batch, dtype=dtype) for batch in batches] or
+                             [numpy.array([], dtype=dtype)])
+  column = []
+  for batch in batches:
+    column.extend(batch)
+  return column
+
+
+def queryset_to_columns(queryset, chunk_size=2000, **kwargs):
+  """ Convert all the instances of a queryset to columns. The rows are read
+  with values_list(), chunk_size at a time, and each chunk is transposed into
+  the columns at once, no dictionary or model instance is built.
+  Keyword arguments:
+  chunk_size -- number of rows converted at once
+  included_fields -- see model_to_dict
+  excluded_fields -- see model_to_dict
+  select -- see model_to_dict, the relations being ForeignKey ids
+  The numeric columns are numpy arrays when numpy is installed, see
+  columns_to_json.
+  """
+  projection = columnar_projection(queryset.model,
+                                   kwargs.get('included_fields', None),
+                                   kwargs.get('excluded_fields', None),
+                                   compile_selector(kwargs.get('select', None)))
+  rows = queryset.values_list(*[column for description, column, converter, dtype in projection])
+  rows = rows.iterator(chunk_size=chunk_size)
+  batches = [[] for column in projection]
+  while True:
+    chunk = list(islice(rows, chunk_size))
+    if not chunk:
+      break
+    for (description, column, converter, dtype), values, column_batches in zip(projection, zip(*chunk), batches):
+      column_batches.append(list(values) if converter is None else [converter(value) for value in values])
+  return {
+    'columns': [description for description, column, converter, dtype in projection],
+    'data': dict((description['name'], build_column(column_batches, dtype))
+                 for (description, column, converter, dtype), column_batches in zip(projection, batches)),
+  }
+
+
+def columns_to_json(columns):
+  """ Return the JSON text of the outcome of queryset_to_columns """
+  data = dict((name, values.tolist() if hasattr(values, 'tolist') else values)
+              for name, values in columns['data'].items())
+  return dumps({ 'columns': columns['columns'], 'data': data })
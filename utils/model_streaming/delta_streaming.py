@@ -0,0 +1,171 @@
+import hashlib
+import datetime
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.payload_cache import get_payload_cache
+from utils.model_streaming.payload_cache import timeout_kwargs
+
+
+#
+# Delta output of model_to_dict
+#
+# A delta is a patch in the shape of the model_to_dict output, applied by
+# update_model_from_dict:
+# - every object holds its id and _ms_type, and only its changed values,
+# - a changed ForeignKey is output in full, a ForeignKey to the same object
+#   only when the related object changed,
+# - a changed related list holds all its current items, the unchanged ones as
+#   references ({ 'id', '_ms_type' }), the changed ones as patches and the new
+#   ones in full. The removed items are the ones missing from the list.
+#
+# The version given to the client is a token of the output, whose snapshot is
+# kept in the payload cache (see payload_cache) to be diffed with the next
+# output. When the snapshot expired, the delta is computed from the modified
+# date of the objects (see BaseCustomModel) if the client gives one.
+#
+reference_keys = ('id', '_ms_type')
+
+
+def snapshot_key(version):
+  return 'ms:snapshot:%s' % version
+
+
+def output_version(d):
+  return hashlib.sha1(dumps(d).encode('utf-8')).hexdigest()
+
+
+def is_object(value):
+  return isinstance(value, dict) and '_ms_type' in value
+
+
+def is_related_list(value):
+  return isinstance(value, list) and any(is_object(item) for item in value)
+
+
+def reference(d):
+  return dict((key, d[key]) for key in reference_keys if key in d)
+
+
+def same_object(old, new):
+  return is_object(old) and old.get('id') == new.get('id') and old['_ms_type'] == new['_ms_type']
+
+
+def diff_value(old, new):
+  """ Return the patch of a value, None if it did not change """
+  if is_object(new):
+    return diff_dicts(old, new) if same_object(old, new) else new
+  if is_related_list(new) or is_related_list(old):
+    return diff_lists(old, new)
+  return None if old == new else new
+
+
+def diff_dicts(old, new):
+  """ Return the patch of an object (its id, _ms_type and changed values),
+  None if it did not change.
+  """
+  patch = reference(new)
+  for key, value in new.items():
+    if key in reference_keys:
+      continue
+    if key not in old:
+      patch[key] = value
+      continue
+    change = diff_value(old[key], value)
+    if change is not None:
+      patch[key] = change
+  return patch if len(patch) > len(reference(new)) else None
+
+
+def diff_lists(old, new):
+  """ Return the patch of a related list (all its current items), None if it
+  did not change.
+  """
+  if not isinstance(old, list):
+    return new
+  previous = dict((item['id'], item) for item in old if is_object(item))
+  changed = [item.get('id') for item in old] != [item.get('id') for item in new]
+  items = []
+  for item in new:
+    if not same_object(previous.get(item.get('id'), None), item):
+      items.append(item)
+      changed = True
+      continue
+    patch = diff_dicts(previous[item['id']], item)
+    if patch is None:
+      items.append(reference(item))
+    else:
+      items.append(patch)
+      changed = True
+  return items if changed else None
+
+
+# The naive datetimes of the database (UTC with USE_TZ, else the TIME_ZONE
+# setting) and of the client (its current time zone) made aware, to be
+# compared in any time zone
+def stored_datetime(value):
+  if not isinstance(value, datetime.datetime):
+    value = parse_datetime(value)
+  if timezone.is_naive(value):
+    value = timezone.make_aware(value, datetime.timezone.utc if settings.USE_TZ else timezone.get_default_timezone())
+  return value
+
+
+def client_datetime(value):
+  if timezone.is_naive(value):
+    value = timezone.make_aware(value, timezone.get_current_timezone())
+  return value
+
+
+def modified_since(d, since):
+  """ Return the patch of an output for a client up to date at since, an
+  aware datetime: the objects modified before are output as references, their
+  relations being still walked. As the output has no microseconds, the
+  objects modified in the second of since are output as changed. The objects
+  without modified date are output in full and the related lists are always
+  output, the removed items being missing from them.
+  """
+  modified = d.get('modified', None)
+  changed = modified is None or stored_datetime(modified) >= since.replace(microsecond=0)
+  patch = reference(d)
+  for key, value in d.items():
+    if key in reference_keys:
+      continue
+    if is_object(value):
+      patch[key] = modified_since(value, since)
+    elif isinstance(value, list):
+      patch[key] = [modified_since(item, since) if is_object(item) else item for item in value]
+    elif changed:
+      patch[key] = value
+  return patch
+
+
+def model_to_delta(instance, version=None, since=None, **kwargs):
+  """ Return the changes of the output of model_to_dict for an instance since
+  a version known by the client:
+    { 'version': version of the current output, 'delta': patch }
+  When neither the version nor since can be used, the patch is the full output
+  and 'full' is True.
+  Keyword arguments:
+  version -- the version returned by a previous call
+  since -- datetime at which the client was up to date (naive in the current
+  time zone, or aware), used when the version is unknown or expired
+  Takes the same keyword arguments as model_to_dict, which must be the same
+  for all the calls of a client.
+  """
+  d = model_to_dict(instance, **kwargs)
+  current = output_version(d)
+  cache = get_payload_cache()
+  cache.set(snapshot_key(current), d, **timeout_kwargs())
+  result = { 'version': current }
+  base = cache.get(snapshot_key(version)) if version is not None else None
+  if base is not None and same_object(base, d):
+    result['delta'] = diff_dicts(base, d) or reference(d)
+  elif since is not None:
+    result['delta'] = modified_since(d, client_datetime(since))
+  else:
+    result['delta'] = d
+    result['full'] = True
+  return result
@@ -0,0 +1,108 @@
+import re
+
+
+#
+# Field selectors
+#
+# A selector lists the fields output at each level of model_to_dict, the
+# fields of a relation being selected between braces:
+#   'char,simple_foreign_key{char},many_to_many{integer}'
+# A relation given without braces only outputs the id of the related objects
+# ({ 'id', '_ms_type' }). The names are the ones of the output (the accessor
+# names for the reverse relations), the id is always output.
+#
+# A selector is compiled once into a tree of Selection, which selects the
+# fields per relation path: two paths to the same model can output different
+# fields. The plans are compiled per Selection (see compile_plan) and the
+# querysets only load the selected columns (see queryset_streaming).
+#
+class Selection(object):
+  """ A level of a compiled selector: maps the selected names to the
+  Selection of the related objects, None for the fields which are not
+  relations.
+  """
+  def __init__(self, names):
+    self.names = names
+
+  def __contains__(self, name):
+    return name in self.names
+
+  def related(self, name):
+    """ The Selection of the related objects of a relation """
+    return self.names[name] or empty_selection
+
+  def __repr__(self):
+    return 'Selection(%r)' % self.names
+
+
+# Selection of the relations given without braces, shared so that their plans
+# are compiled once
+empty_selection = Selection({})
+
+_token = re.compile(r'\s*(?:([A-Za-z_][A-Za-z0-9_]*)|(.))')
+# Compiled selectors
+_selectors = {}
+
+
+def parse_selector(text):
+  """ Compile a selector to its Selection tree, raise ValueError if the
+  selector is invalid.
+  """
+  tokens = []
+  for name, symbol in _token.findall(text.strip()):
+    if symbol and symbol not in '{},':
+      raise ValueError('invalid character %r in the selector %r' % (symbol, text))
+    tokens.append(name or symbol)
+  tokens.append(None)
+  selection, position = _parse_level(tokens, 0, text)
+  if tokens[position] is not None:
+    raise ValueError('unexpected %r in the selector %r' % (tokens[position], text))
+  return selection
+
+
+def _parse_level(tokens, position, text):
+  names = {}
+  while True:
+    name = tokens[position]
+    if name in ('{', '}', ',', None):
+      raise ValueError('field name expected in the selector %r' % text)
+    if name in names:
+      raise ValueError('%s selected twice in the selector %r' % (name, text))
+    position += 1
+    names[name] = None
+    if tokens[position] == '{':
+      if tokens[position + 1] == '}':
+        names[name] = empty_selection
+        position += 2
+      else:
+        names[name], position = _parse_level(tokens, position + 1, text)
+        if tokens[position] != '}':
+          raise ValueError('missing } in the selector %r' % text)
+        position += 1
+    if tokens[position] != ',':
+      return Selection(names), position
+    position += 1
+
+
+def canonical_selector(selection):
+  """ Return the selector of a Selection with the names sorted, the same for
+  all the selectors selecting the same fields (e.g. to key a cache).
+  """
+  names = []
+  for name in sorted(selection.names):
+    related = selection.names[name]
+    names.append(name if related is None else '%s{%s}' % (name, canonical_selector(related)))
+  return ','.join(names)
+
+
+def compile_selector(selector):
+  """ Return the Selection of a selector given as a string (compiled once) or
+  already compiled, None if there is no selector.
+  """
+  if selector is None or isinstance(selector, Selection):
+    return selector
+  try:
+    return _selectors[selector]
+  except KeyError:
+    selection = _selectors[selector] = parse_selector(selector)
+    return selection
@@ -0,0 +1,72 @@
+from django.http import StreamingHttpResponse
+from utils.model_streaming.queryset_streaming import stream_queryset_json
+from utils.model_streaming.msgpack_streaming import stream_queryset_msgpack
+
+
+# The formats a queryset can be streamed in, by content type, the first one
+# being the default
+stream_formats = [
+  ('application/json', stream_queryset_json),
+  ('application/msgpack', stream_queryset_msgpack),
+  ('application/x-msgpack', stream_queryset_msgpack),
+]
+
+
+def parse_accept(accept):
+  """ Return the list of (media range, quality) of an Accept header """
+  media_ranges = []
+  for item in accept.split(','):
+    parameters = item.split(';')
+    media_range = parameters[0].strip().lower()
+    if not media_range:
+      continue
+    quality = 1.0
+    for parameter in parameters[1:]:
+      name, _, value = parameter.partition('=')
+      if name.strip() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    media_ranges.append((media_range, quality))
+  return media_ranges
+
+
+def format_quality(content_type, media_ranges):
+  """ Return the quality of a content type given by the most specific media
+  range matching it (type/subtype, then type/*, then */*, as in RFC 9110),
+  0 if none matches.
+  """
+  main_type = content_type.split('/')[0]
+  for candidate in (content_type, main_type + '/*', '*/*'):
+    for media_range, quality in media_ranges:
+      if media_range == candidate:
+        return quality
+  return 0.0
+
+
+def negotiate_format(accept):
+  """ Return the content type of stream_formats best matching an Accept
+  header, the default format if the header is empty or accepts none. A format
+  whose most specific media range has q=0 is not acceptable, whatever the
+  wildcards.
+  """
+  media_ranges = parse_accept(accept or '')
+  best, best_quality = stream_formats[0][0], 0.0
+  for content_type, stream in stream_formats:
+    quality = format_quality(content_type, media_ranges)
+    if quality > best_quality:
+      best, best_quality = content_type, quality
+  return best
+
+
+def streaming_response(request, queryset, chunk_size=2000, **kwargs):
+  """ Return a StreamingHttpResponse of the instances of a queryset in the
+  format requested by the Accept header of the request (JSON by default).
+  Takes the same keyword arguments as queryset_to_dicts.
+  """
+  content_type = negotiate_format(request.META.get('HTTP_ACCEPT', ''))
+  stream = dict(stream_formats)[content_type]
+  response = StreamingHttpResponse(stream(queryset, chunk_size, **kwargs), content_type=content_type)
+  response['Vary'] = 'Accept'
+  return response
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+import os
+import re
 import json
 import decimal
+import datetime
+import binascii
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -14,3 +18,106 @@ class DecimalEncoder(json.JSONEncoder):
       # !! WARNING !!
       return (str(o) for o in [float(o)])
     return super(DecimalEncoder, self)._iterencode(o, markers)
+
+  # The C encoder never calls _iterencode, this is where it ends up for the
+  # types it does not know about.
+  def default(self, o):
+    if isinstance(o, decimal.Decimal):
+      return float(o)
+    return super(DecimalEncoder, self).default(o)
+
+
+#
+# Encoder of the model_streaming output
+#
+# Decimal values are output with their exact text, date, datetime and time
+# values in ISO 8601, non ASCII characters as is (the text being encoded in
+# UTF-8) and without space after the separators.
+# The encoding is done by orjson when it is installed, by the json module
+# otherwise: its encoder (C accelerated when available) is built once and
+# escapes each string in one pass. It can not output a raw number for a
+# Decimal, so the Decimal is output as a string starting with a marker that
+# is then replaced by the number. The marker holds a random part so that it
+# can not be forged in the strings of the data.
+# simplejson can be selected with set_json_backend.
+#
+_decimal_marker = '\x00' + binascii.hexlify(os.urandom(8)).decode('ascii')
+_decimal_pattern = re.compile(r'"\\u0000%s([^"]*)"' % _decimal_marker[1:])
+
+
+def encode_decimal(o):
+  if not o.is_finite():
+    raise ValueError('Out of range decimal value: %s' % o)
+  return str(o)
+
+
+# Conversion of the values the encoders do not know about
+def _default(o):
+  if isinstance(o, (datetime.date, datetime.time)):
+    return o.isoformat()
+  if hasattr(o, 'tolist'):
+    # numpy array or scalar
+    return o.tolist()
+  raise TypeError('%r is not JSON serializable' % (o,))
+
+
+def _json_default(o):
+  if isinstance(o, decimal.Decimal):
+    return _decimal_marker + encode_decimal(o)
+  return _default(o)
+
+_json_encoder = json.JSONEncoder(check_circular=False, ensure_ascii=False, separators=(',', ':'),
+                                 default=_json_default)
+
+
+def json_dumps(o):
+  """ Encode a value to JSON text with the json module """
+  text = _json_encoder.encode(o)
+  if '\\u0000' in text:
+    text = _decimal_pattern.sub(r'\1', text)
+  return text
+
+
+json_backends = { 'json': json_dumps }
+
+try:
+  import simplejson
+except ImportError:
+  pass
+else:
+  json_backends['simplejson'] = simplejson.JSONEncoder(use_decimal=True, default=_default,
+                                                      ensure_ascii=False, separators=(',', ':')).encode
+
+try:
+  import orjson
+  orjson.Fragment
+except (ImportError, AttributeError):
+  pass
+else:
+  def _orjson_default(o):
+    if isinstance(o, decimal.Decimal):
+      # output as is in the document
+      return orjson.Fragment(encode_decimal(o))
+    return _default(o)
+
+  def orjson_dumps(o):
+    return orjson.dumps(o, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+  json_backends['orjson'] = orjson_dumps
+
+# Backend used by dumps
+json_backend = 'orjson' if 'orjson' in json_backends else 'json'
+
+
+def set_json_backend(name):
+  """ Select the backend used by dumps: 'orjson', 'simplejson' or 'json' """
+  global json_backend
+  if name not in json_backends:
+    raise ValueError('the %s JSON backend is not installed' % name)
+  json_backend = name
+
+
+def dumps(o):
+  """ Encode the model_streaming output of o to JSON text with the selected
+  backend. Decimal values are output exactly, dates in ISO 8601.
+  """
+  return json_backends[json_backend](o)
@@ -1,7 +1,12 @@
-import itertools
-import json
+from operator import attrgetter
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.signals import setting_changed
 from django.db import models
-from utils.model_streaming.to_dict import choices_to_dict
+from django.db.models.signals import class_prepared
+from utils.model_streaming.to_dict import choices_index
+from utils.model_streaming.to_dict import bitfield_to_dict
+from utils.model_streaming.field_selectors import compile_selector
+from utils.model_streaming.profiling import active_profile
 
 
 def filter_fields(included_fields, excluded_fields, model_name, fields):
@@ -37,7 +42,12 @@ def default_serializer(instance, **kwargs):
 
 
 def Choice_serializer(instance, **kwargs):
-  return choices_to_dict(kwargs['field'].choices, str(instance))
+  indexes, labels = choice_table(kwargs['field'])
+  selected = indexes.get(str(instance), 0)
+  if kwargs.get('schema', None) is not None:
+    # compact output, the labels are in the schema
+    return selected
+  return { 'selected': selected, 'labels': list(labels) }
 
 
 def BooleanField_serializer(instance, **kwargs):
@@ -53,12 +63,25 @@ def CharField_serializer(instance, **kwargs):
     return instance
 
 
+# Integer mask of a BitField in the native output, the binary encoders
+# output it with an extension type
+class BitMask(int):
+  pass
+
+
 def BitField_serializer(instance, **kwargs):
+  if kwargs.get('native', False):
+    return BitMask(int(instance))
+  if kwargs.get('schema', None) is not None:
+    # compact output, the mask only
+    return int(instance)
   # Call bitfield_static_to_dict with a the value of the field
   return bitfield_to_dict(instance._labels, int(instance))
 
 
 def OneToOneField_serializer(instance, **kwargs):
+  if instance is None:
+    return None
   return model_to_dict(instance, **kwargs)
 
 
@@ -67,7 +90,10 @@ def ManyToManyField_serializer(instance, **kwargs):
 
 
 def DateTimeField_serializer(instance, **kwargs):
-  return json.dumps(instance.strftime('%Y-%m-%dT%H:%M:%S')).replace('"', '')
+  if kwargs.get('native', False):
+    return instance
+  # ISO 8601 without the time zone, the text has nothing to escape
+  return instance.strftime('%Y-%m-%dT%H:%M:%S')
 
 
 def RelatedField_serializer(instance, **kwargs):
@@ -76,6 +102,8 @@ def RelatedField_serializer(instance, **kwargs):
   # do that than to rely on a undocumented class which really is a implementation detail
   if hasattr(instance, 'all'):
     return [model_to_dict(field, **kwargs) for field in instance.all()]
+  elif instance is None:
+    return None
   else:
     return model_to_dict(instance, **kwargs)
 
@@ -83,6 +111,8 @@ def RelatedField_serializer(instance, **kwargs):
 # Forward usage of model_to_dict. We have to use this trick so we can use
 # model_to_dict in the map below.
 def to_dict(instance, **kwargs):
+  if instance is None:
+    return None
   return model_to_dict(instance, **kwargs)
 
 # Actual declaration of serializer_map
@@ -97,6 +127,9 @@ serializer_map = {
   models.fields.related.ReverseManyToOneDescriptor.__name__: RelatedField_serializer,
   models.fields.related.ForeignObjectRel.__name__: RelatedField_serializer,
   models.fields.reverse_related.ManyToOneRel.__name__: RelatedField_serializer,
+  models.fields.reverse_related.OneToOneRel.__name__: OneToOneField_serializer,
+  models.fields.reverse_related.ManyToManyRel.__name__: ManyToManyField_serializer,
+  'BitField':                         BitField_serializer,
   'default':                          default_serializer
 }
 
@@ -113,6 +146,241 @@ def get_field_name(field):
   return field.name
 
 
+#
+# Compiled serialization plans
+#
+# Resolving the fields of a model, filtering them and looking up their
+# serializer is the same work for every instance of a given model. It is done
+# once per (model class, included_fields, excluded_fields, selection) and the
+# resulting plan is kept in _plans until the app registry changes.
+#
+_plans = {}
+# (code -> index map, labels) of the fields with choices
+_choice_tables = {}
+
+
+def clear_plans(**kwargs):
+  """ Drop all the compiled plans. Connected to the signals notifying a change
+  of the app registry, can also be called directly.
+  """
+  if kwargs.get('setting', 'INSTALLED_APPS') == 'INSTALLED_APPS':
+    _plans.clear()
+    _choice_tables.clear()
+
+class_prepared.connect(clear_plans, dispatch_uid='model_streaming_clear_plans')
+setting_changed.connect(clear_plans, dispatch_uid='model_streaming_clear_plans')
+
+
+def get_serializer(field):
+  """ Return the serializer to be used for a field, taking the choices into
+  account so that it does not have to be checked for each instance.
+  """
+  serializer = serializer_map.get(field.__class__.__name__, serializer_map['default'])
+  if serializer is CharField_serializer:
+    return Choice_serializer if getattr(field, 'choices', None) else default_serializer
+  return serializer
+
+
+def choice_table(field):
+  """ Return the (code -> index map, labels) of a field with choices """
+  try:
+    return _choice_tables[field]
+  except KeyError:
+    table = _choice_tables[field] = (choices_index(field.choices), tuple(label for code, label in field.choices))
+    return table
+
+
+def field_labels(field, serializer):
+  """ Return the labels of a field output as an index or a mask in the
+  compact output, None for the other fields.
+  """
+  if serializer is Choice_serializer:
+    return list(choice_table(field)[1])
+  if serializer is BitField_serializer:
+    return list(field.labels)
+  return None
+
+
+def reverse_one_to_one_getter(field_name):
+  """ Getter of a reverse OneToOneField, returning None instead of raising
+  when there is no related object.
+  """
+  def getter(instance):
+    try:
+      return getattr(instance, field_name)
+    except ObjectDoesNotExist:
+      return None
+  return getter
+
+
+def field_spec(names):
+  """ Convert a included_fields/excluded_fields parameter to a hashable key """
+  return tuple(names) if names is not None else None
+
+
+def compile_plan(model, included_fields=None, excluded_fields=None, selection=None):
+  """ Return the serialization plan of a model, a tuple of
+  (accessor name, getter, serializer, field) in the order of the fields.
+  Keyword arguments:
+  model -- the model class
+  included_fields -- see model_to_dict
+  excluded_fields -- see model_to_dict
+  selection -- the Selection of the fields at this level of the output (see
+  field_selectors), None to output all the fields
+  """
+  key = (model, field_spec(included_fields), field_spec(excluded_fields), selection)
+  try:
+    return _plans[key]
+  except KeyError:
+    pass
+  all_fields = model._meta.get_fields(include_hidden=True)
+  if selection is not None:
+    check_selection(model, selection, all_fields)
+  fields = filter_fields(included_fields, excluded_fields, model.__name__, all_fields)
+  plan = []
+  for field in fields:
+    field_name = get_field_name(field)
+    # Hidden relations (related_name ending with '+') have no accessor
+    if field_name.endswith('+'):
+      continue
+    if selection is not None and field_name not in selection:
+      continue
+    if field.one_to_one and field.auto_created and not field.concrete:
+      getter = reverse_one_to_one_getter(field_name)
+    else:
+      getter = attrgetter(field_name)
+    plan.append((field_name, getter, get_serializer(field), field))
+  plan = tuple(plan)
+  _plans[key] = plan
+  return plan
+
+
+def check_selection(model, selection, fields):
+  """ Raise ValueError if a Selection names a field the model does not have,
+  or selects the fields of a field which is not a relation.
+  """
+  fields = dict((get_field_name(field), field) for field in fields)
+  for name, related_selection in selection.names.items():
+    if name not in fields:
+      raise ValueError('%s has no field %s' % (model.__name__, name))
+    if related_selection is not None and not fields[name].is_relation:
+      raise ValueError('%s.%s is not a relation' % (model.__name__, name))
+
+
+# Reference to a related object that is not expanded, built from the value of
+# the ForeignKey column so it does not trigger a query.
+def related_stub(field, pk):
+  if pk is None:
+    return None
+  return { 'id': pk, '_ms_type': field.related_model.__name__ }
+
+
+# Name of the attribute in which the batch entry points store the ids of the
+# related objects of a relation of which only the references are output (see
+# queryset_streaming.load_references)
+def reference_attname(field_name):
+  return '_ms_ids_' + field_name
+
+
+def related_references(instance, field_name, getter, field, options, objects=None):
+  """ Return the references of the related objects of a relation, without
+  following their relations: { 'id', '_ms_type' }, or { '$ref' } when the
+  object is already in the objects table of a normalized graph. The ids
+  loaded by the batch entry points are used when present, otherwise a query
+  is run.
+  """
+  multiple = field.many_to_many or field.one_to_many
+  if options is not None:
+    value = bounded_relation(instance, field_name, getter, options)
+    if not isinstance(value, list):
+      # count or existence flag
+      return value
+    ids = [related_instance.pk for related_instance in value]
+  else:
+    try:
+      ids = getattr(instance, reference_attname(field_name))
+    except AttributeError:
+      value = getter(instance)
+      if multiple:
+        ids = list(value.values_list('pk', flat=True))
+      else:
+        ids = value.pk if value is not None else None
+  if not multiple:
+    return related_reference(field, ids, objects)
+  return [related_reference(field, pk, objects) for pk in ids]
+
+
+# Stub of a related object, or its reference in a normalized graph when it is
+# already in the objects table
+def related_reference(field, pk, objects=None):
+  key = '%s:%s' % (field.related_model.__name__, pk)
+  if objects is not None and key in objects:
+    return { '$ref': key }
+  return related_stub(field, pk)
+
+
+# Whether the related object of a single valued relation is already loaded
+def is_loaded(instance, field):
+  if field.many_to_many or field.one_to_many:
+    return False
+  return field.is_cached(instance)
+
+
+# Name of the attribute in which the batch entry points store the outcome of
+# the options of a relation (see bounded_relation)
+def relation_attname(field_name):
+  return '_ms_' + field_name
+
+
+def bounded_relation(instance, field_name, getter, options):
+  """ Apply the options of a multiple valued relation. Returns the count, the
+  existence flag or the list of related objects. The value loaded by the
+  batch entry points is used when present, otherwise a query is run.
+  Keyword arguments:
+  instance -- the instance owning the relation
+  field_name -- the accessor name of the relation
+  getter -- the getter of the related manager
+  options -- dictionary of options, see model_to_dict
+  """
+  try:
+    return getattr(instance, relation_attname(field_name))
+  except AttributeError:
+    pass
+  manager = getter(instance)
+  if options.get('count', False):
+    return manager.count()
+  if options.get('exists', False):
+    return manager.exists()
+  queryset = manager.all()
+  if 'ordering' in options:
+    queryset = queryset.order_by(*options['ordering'])
+  if 'limit' in options:
+    queryset = queryset[:options['limit']]
+  return list(queryset)
+
+
+# Key of an instance in the objects table of a normalized graph
+def object_key(instance):
+  return '%s:%s' % (instance.__class__.__name__, instance.pk)
+
+
+def plan_schema(plan):
+  """ Return the label tables of the fields of a plan output as an index or a
+  mask in the compact output: { field name: [labels] }.
+  """
+  schema = {}
+  for field_name, getter, serializer, field in plan:
+    labels = field_labels(field, serializer)
+    if labels is not None:
+      schema[field_name] = labels
+  return schema
+
+
+# The schema of a compact output without the models having no label table
+def compact_schema(schema):
+  return dict((model_name, tables) for model_name, tables in schema.items() if tables)
+
+
 # model_to_dict shall manage related object without going back to the original model
 # model_to_dict shall manage reference to the same model but with a different instance:
 #  A(id=12) -> B(id=7) -> A(id=8)
@@ -123,37 +391,142 @@ def model_to_dict(instance, **kwargs):
   should be included. Default == None.
   excluded_fields -- field name that should be filtered out. If None, no
   fields should be filtered out. Default == None.
-  max_depth -- maximum depth in the nested field. Default == 100.
+  max_depth -- maximum depth in the nested field. Default == 100. Beyond it
+  ForeignKey and OneToOneField are output as { 'id', '_ms_type' } stubs built
+  without a query, the other relations are left out.
+  expand -- dictionary of expansion rules overriding max_depth: maps a
+  relation path (accessor names separated by '.' starting from the instance,
+  e.g. 'complexrelatedfieldmodel_set.relatedtorelatedfieldmodel_set') to the
+  number of levels to expand from this relation. 0 means the relation is not
+  expanded. Default == None.
+  relations -- dictionary of options of the multiple valued relations, mapping
+  a relation path (as for expand) to a dictionary with:
+    limit -- maximum number of related objects output
+    ordering -- list of fields the related objects are ordered by
+    count -- if True, only the number of related objects is output
+    exists -- if True, only whether there is a related object is output
+  e.g. { 'complexrelatedfieldmodel_set': { 'limit': 3, 'ordering': ['-integer'] } }
+  Default == None.
+  objects -- if set, a dictionary in which each instance is stored once under
+  its object_key, a {'$ref': key} reference being returned instead of the
+  nested dictionary (see model_to_graph). Default == None.
+  schema -- if set, compact output: a dictionary in which the label tables of
+  the fields with choices and of the bitfields are stored once per model name
+  (see plan_schema), the fields only holding the selected index or the integer
+  mask (see model_to_compact). Default == None.
+  native -- if True, the dates and datetimes are output as date and datetime
+  values and the bitfields as BitMask integers, for the binary encoders (see
+  msgpack_streaming). Default == False.
+  tree -- set by the batch entry points (see queryset_streaming.tree_map):
+  the relations they loaded, { accessor name: sub tree }. The relations not
+  in it are output as beyond max_depth, unless the related object is already
+  loaded (eg. the parent a prefetched object points back to), so that no
+  query is run. Default == None.
+  select -- selector of the fields output per relation path, e.g.
+  'char,simple_foreign_key{char},many_to_many{integer}' (see
+  field_selectors), applied with included_fields and excluded_fields. The
+  batch entry points only load the selected columns. Default == None.
   """
   # The dict that will contain the streamed object
   d = { 'id': instance.pk, '_ms_type': instance.__class__.__name__ }
-  # cycle check
-  if 'ids' not in kwargs:
-    # If ids is not initialized, do it
-    kwargs['ids'] = []
-  if (instance.pk, instance.__class__.__name__) in kwargs['ids']:
-    # If the instance has already been visited, yield
-    return d
-  # if this is the first time we stream this instance, store its id
-  kwargs['ids'].append((instance.pk, instance.__class__.__name__))
+  objects = kwargs.get('objects', None)
+  if objects is not None:
+    # normalized graph: the objects table is the visited registry
+    ref = { '$ref': object_key(instance) }
+    if ref['$ref'] in objects:
+      return ref
+    objects[ref['$ref']] = d
+  else:
+    # cycle check
+    if 'ids' not in kwargs:
+      # If ids is not initialized, do it
+      kwargs['ids'] = set()
+    # by label, two apps may have models of the same name
+    if (instance.pk, instance._meta.label) in kwargs['ids']:
+      # If the instance has already been visited, yield
+      return d
+    # if this is the first time we stream this instance, store its id
+    kwargs['ids'].add((instance.pk, instance._meta.label))
   # retrieve the parameters (use default values)
   included_fields = kwargs.get('included_fields', None)
   excluded_fields = kwargs.get('excluded_fields', None)
-  # max_depth = kwargs.get('max_depth', 100)
-  # enumerate all the fields (normal fields, foreign key, manyto..., related fields)
-  opts = instance._meta
-  fields = list(itertools.chain(opts.get_fields(include_hidden=True)))
-  # Filter the fields
-  fields = filter_fields(included_fields, excluded_fields, instance.__class__.__name__, fields)
+  expand = kwargs.get('expand', None)
+  relations = kwargs.get('relations', None)
+  # levels of relations that can still be expanded below this instance
+  depth = kwargs.get('depth', kwargs.get('max_depth', 100))
+  # relation path leading to this instance
+  path = kwargs.get('path', '')
+  # relations loaded by the batch entry points
+  tree = kwargs.get('tree', None)
+  # fields selected at this level
+  selection = kwargs['selection'] if 'selection' in kwargs else compile_selector(kwargs.get('select', None))
+  # Retrieve the compiled plan (fields already filtered, serializers resolved)
+  plan = compile_plan(instance.__class__, included_fields, excluded_fields, selection)
+  profile = active_profile()
+  if profile is not None:
+    profile.visit(d['_ms_type'])
+    plan = profile.instrument(plan)
+  schema = kwargs.get('schema', None)
+  if schema is not None and d['_ms_type'] not in schema:
+    schema[d['_ms_type']] = plan_schema(plan)
   # for earch fields, call the appropriate serializer
-  for field in fields:
-    field_name = get_field_name(field)
+  for field_name, getter, serializer, field in plan:
     kwargs['field'] = field
+    if field.is_relation:
+      field_path = path + field_name
+      levels = expand.get(field_path, depth) if expand else depth
+      if levels <= 0 or (tree is not None and field_name not in tree and not is_loaded(instance, field)):
+        # Beyond the limit, or beyond the relations loaded by a batch entry
+        # point, only the relations whose id is at hand are output
+        if isinstance(field, models.ForeignKey):
+          d[field_name] = related_stub(field, getattr(instance, field.attname))
+        continue
+      multiple = field.many_to_many or field.one_to_many
+      options = relations.get(field_path, None) if relations and multiple else None
+      if tree is not None and field_name in tree and tree[field_name] is None:
+        # Only the ids of the related objects are loaded by a batch entry
+        # point, the references are output
+        d[field_name] = related_references(instance, field_name, getter, field, options, objects)
+        continue
+      if tree is not None:
+        kwargs['tree'] = tree.get(field_name, {})
+      kwargs['depth'] = levels - 1
+      kwargs['path'] = field_path + '.'
+      kwargs['selection'] = selection.related(field_name) if selection is not None else None
+      if options is not None:
+        value = bounded_relation(instance, field_name, getter, options)
+        if isinstance(value, list):
+          value = [model_to_dict(related_instance, **kwargs) for related_instance in value]
+        d[field_name] = value
+        continue
     # retrieve the result and set it in the resulting dictionary
-    try:
-      d[field_name] = serializer_map[field.__class__.__name__](getattr(instance, field_name), **kwargs)
-    except KeyError:
-      # if no specialized serializer, fall back to default
-      d[field_name] = serializer_map['default'](getattr(instance, field_name), **kwargs)
-  # return the dictionary
-  return d
+    d[field_name] = serializer(getter(instance), **kwargs)
+  # return the dictionary, or its reference in a normalized graph
+  return d if objects is None else ref
+
+
+def model_to_graph(instance, **kwargs):
+  """ Convert a instance model to a normalized graph: each object reachable
+  from the instance is output once in the objects table, the relations being
+  {'$ref': key} references to this table.
+    { 'root': { '$ref': 'A:12' },
+      'objects': { 'A:12': { 'id': 12, '_ms_type': 'A', 'b': { '$ref': 'B:7' } },
+                   'B:7': { 'id': 7, '_ms_type': 'B', 'a': { '$ref': 'A:12' } } } }
+  Takes the same keyword arguments as model_to_dict.
+  """
+  kwargs['objects'] = {}
+  root = model_to_dict(instance, **kwargs)
+  return { 'root': root, 'objects': kwargs['objects'] }
+
+
+def model_to_compact(instance, **kwargs):
+  """ Convert a instance model to the compact output: the fields with choices
+  hold the selected index and the bitfields the integer mask, the labels being
+  output once per model in the schema.
+    { '_schema': { 'A': { 'option': ['Option 1', 'Option 2'], 'flags': ['Type 1'] } },
+      'data': { 'id': 12, '_ms_type': 'A', 'option': 1, 'flags': 1 } }
+  Takes the same keyword arguments as model_to_dict.
+  """
+  kwargs['schema'] = {}
+  data = model_to_dict(instance, **kwargs)
+  return { '_schema': compact_schema(kwargs['schema']), 'data': data }
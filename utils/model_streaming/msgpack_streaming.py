@@ -0,0 +1,326 @@
+import struct
+import calendar
+import datetime
+import decimal
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.model_streaming import BitMask
+from utils.model_streaming.queryset_streaming import iterate_dict_chunks
+
+
+#
+# MessagePack encoding of the model_streaming output, without third party
+# dependency. The output is read by any MessagePack library, the values the
+# format does not know about being extension types:
+#   -1 -- datetime, the standard timestamp type (naive values are taken as UTC)
+#    1 -- Decimal, its exact text in ASCII
+#    2 -- date, year (uint16), month (uint8), day (uint8)
+#    3 -- BitField mask, uint64
+# All integers are big endian, as in the rest of the format.
+#
+DECIMAL_EXT = 1
+DATE_EXT = 2
+BITMASK_EXT = 3
+TIMESTAMP_EXT = -1
+
+try:
+  text_types = (str, unicode)
+  binary_type = bytearray
+except NameError:
+  text_types = (str,)
+  binary_type = bytes
+try:
+  integer_types = (int, long)
+except NameError:
+  integer_types = (int,)
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+
+def _pack_integer(o, write):
+  if 0 <= o < 0x80:
+    write(struct.pack('B', o))
+  elif -0x20 <= o < 0:
+    write(struct.pack('b', o))
+  elif 0 <= o <= 0xff:
+    write(struct.pack('>BB', 0xcc, o))
+  elif 0 <= o <= 0xffff:
+    write(struct.pack('>BH', 0xcd, o))
+  elif 0 <= o <= 0xffffffff:
+    write(struct.pack('>BI', 0xce, o))
+  elif 0 <= o <= 0xffffffffffffffff:
+    write(struct.pack('>BQ', 0xcf, o))
+  elif -0x80 <= o < 0:
+    write(struct.pack('>Bb', 0xd0, o))
+  elif -0x8000 <= o < 0:
+    write(struct.pack('>Bh', 0xd1, o))
+  elif -0x80000000 <= o < 0:
+    write(struct.pack('>Bi', 0xd2, o))
+  elif -0x8000000000000000 <= o < 0:
+    write(struct.pack('>Bq', 0xd3, o))
+  else:
+    raise ValueError('integer out of the MessagePack range: %s' % o)
+
+
+def _pack_length(length, fix, fix_size, codes, write):
+  """ Write the header of a str, bin, array or map of length items.
+  Keyword arguments:
+  fix -- the code of the fix format, None if there is none
+  fix_size -- the maximum length of the fix format
+  codes -- the codes of the 8, 16 and 32 bits lengths (None if there is none)
+  """
+  if fix is not None and length <= fix_size:
+    write(struct.pack('B', fix | length))
+  elif codes[0] is not None and length <= 0xff:
+    write(struct.pack('>BB', codes[0], length))
+  elif length <= 0xffff:
+    write(struct.pack('>BH', codes[1], length))
+  elif length <= 0xffffffff:
+    write(struct.pack('>BI', codes[2], length))
+  else:
+    raise ValueError('object too large for MessagePack: %i items' % length)
+
+
+def _pack_text(o, write):
+  data = o.encode('utf-8')
+  _pack_length(len(data), 0xa0, 31, (0xd9, 0xda, 0xdb), write)
+  write(data)
+
+
+def _pack_binary(o, write):
+  _pack_length(len(o), None, 0, (0xc4, 0xc5, 0xc6), write)
+  write(bytes(o))
+
+
+def _pack_list(o, write):
+  _pack_length(len(o), 0x90, 15, (None, 0xdc, 0xdd), write)
+  for value in o:
+    _pack(value, write)
+
+
+def _pack_dict(o, write):
+  _pack_length(len(o), 0x80, 15, (None, 0xde, 0xdf), write)
+  for key, value in o.items():
+    _pack(key, write)
+    _pack(value, write)
+
+
+def _pack_ext(code, data, write):
+  length = len(data)
+  fixext = { 1: 0xd4, 2: 0xd5, 4: 0xd6, 8: 0xd7, 16: 0xd8 }.get(length, None)
+  if fixext is not None:
+    write(struct.pack('>Bb', fixext, code))
+  elif length <= 0xff:
+    write(struct.pack('>BBb', 0xc7, length, code))
+  elif length <= 0xffff:
+    write(struct.pack('>BHb', 0xc8, length, code))
+  else:
+    write(struct.pack('>BIb', 0xc9, length, code))
+  write(data)
+
+
+def _pack_decimal(o, write):
+  if not o.is_finite():
+    raise ValueError('Out of range decimal value: %s' % o)
+  _pack_ext(DECIMAL_EXT, str(o).encode('ascii'), write)
+
+
+def _pack_datetime(o, write):
+  if o.tzinfo is not None:
+    o = o.replace(tzinfo=None) - o.utcoffset()
+  seconds = calendar.timegm(o.timetuple())
+  nanoseconds = o.microsecond * 1000
+  if nanoseconds == 0 and 0 <= seconds <= 0xffffffff:
+    _pack_ext(TIMESTAMP_EXT, struct.pack('>I', seconds), write)
+  elif 0 <= seconds < 1 << 34:
+    _pack_ext(TIMESTAMP_EXT, struct.pack('>Q', nanoseconds << 34 | seconds), write)
+  else:
+    _pack_ext(TIMESTAMP_EXT, struct.pack('>Iq', nanoseconds, seconds), write)
+
+
+def _pack_date(o, write):
+  _pack_ext(DATE_EXT, struct.pack('>HBB', o.year, o.month, o.day), write)
+
+
+def _pack_bitmask(o, write):
+  _pack_ext(BITMASK_EXT, struct.pack('>Q', o), write)
+
+
+def _pack_float(o, write):
+  write(struct.pack('>Bd', 0xcb, o))
+
+
+# Packers of the exact types, the subclasses are found by _packer_for
+_packers = {
+  type(None): lambda o, write: write(b'\xc0'),
+  bool: lambda o, write: write(b'\xc3' if o else b'\xc2'),
+  float: _pack_float,
+  decimal.Decimal: _pack_decimal,
+  datetime.datetime: _pack_datetime,
+  datetime.date: _pack_date,
+  datetime.time: lambda o, write: _pack_text(o.isoformat(), write),
+  BitMask: _pack_bitmask,
+  binary_type: _pack_binary,
+  dict: _pack_dict,
+  list: _pack_list,
+  tuple: _pack_list,
+}
+for integer_type in integer_types:
+  _packers[integer_type] = _pack_integer
+for text_type in text_types:
+  _packers[text_type] = _pack_text
+
+
+def _packer_for(o):
+  for base in type(o).__mro__:
+    if base in _packers:
+      return _packers[base]
+  raise TypeError('%r can not be packed in MessagePack' % (o,))
+
+
+def _pack(o, write):
+  try:
+    packer = _packers[type(o)]
+  except KeyError:
+    packer = _packer_for(o)
+  packer(o, write)
+
+
+def packb(o):
+  """ Encode a value to MessagePack """
+  chunks = []
+  _pack(o, chunks.append)
+  return b''.join(chunks)
+
+
+#
+# Decoding, mainly for the Python clients and the tests
+#
+def _ext_value(code, data):
+  if code == DECIMAL_EXT:
+    return decimal.Decimal(data.decode('ascii'))
+  if code == DATE_EXT:
+    return datetime.date(*struct.unpack('>HBB', data))
+  if code == BITMASK_EXT:
+    return BitMask(struct.unpack('>Q', data)[0])
+  if code == TIMESTAMP_EXT:
+    if len(data) == 4:
+      seconds, nanoseconds = struct.unpack('>I', data)[0], 0
+    elif len(data) == 8:
+      value = struct.unpack('>Q', data)[0]
+      seconds, nanoseconds = value & ((1 << 34) - 1), value >> 34
+    else:
+      nanoseconds, seconds = struct.unpack('>Iq', data)
+    return _epoch + datetime.timedelta(seconds=seconds, microseconds=nanoseconds // 1000)
+  raise ValueError('unknown MessagePack extension type %i' % code)
+
+
+class Unpacker(object):
+  """ Decoder of a buffer holding one or several MessagePack objects """
+  def __init__(self, data):
+    self.data = data
+    self.offset = 0
+
+  def read(self, size):
+    if self.offset + size > len(self.data):
+      raise ValueError('truncated MessagePack data')
+    data = self.data[self.offset:self.offset + size]
+    self.offset += size
+    return data
+
+  def read_struct(self, format):
+    return struct.unpack(format, self.read(struct.calcsize(format)))[0]
+
+  def at_end(self):
+    return self.offset >= len(self.data)
+
+  def unpack(self):
+    code = self.read_struct('B')
+    if code <= 0x7f:
+      return code
+    if code >= 0xe0:
+      return code - 0x100
+    if 0x80 <= code <= 0x8f:
+      return self.read_map(code & 0x0f)
+    if 0x90 <= code <= 0x9f:
+      return self.read_array(code & 0x0f)
+    if 0xa0 <= code <= 0xbf:
+      return self.read(code & 0x1f).decode('utf-8')
+    if code == 0xc0:
+      return None
+    if code in (0xc2, 0xc3):
+      return code == 0xc3
+    if code in (0xc4, 0xc5, 0xc6):
+      return self.read(self.read_struct({ 0xc4: '>B', 0xc5: '>H', 0xc6: '>I' }[code]))
+    if code in (0xc7, 0xc8, 0xc9):
+      length = self.read_struct({ 0xc7: '>B', 0xc8: '>H', 0xc9: '>I' }[code])
+      ext = self.read_struct('b')
+      return _ext_value(ext, self.read(length))
+    if code in (0xca, 0xcb):
+      return self.read_struct({ 0xca: '>f', 0xcb: '>d' }[code])
+    if 0xcc <= code <= 0xd3:
+      return self.read_struct('>' + 'BHIQbhiq'[code - 0xcc])
+    if 0xd4 <= code <= 0xd8:
+      ext = self.read_struct('b')
+      return _ext_value(ext, self.read(1 << (code - 0xd4)))
+    if code in (0xd9, 0xda, 0xdb):
+      return self.read(self.read_struct({ 0xd9: '>B', 0xda: '>H', 0xdb: '>I' }[code])).decode('utf-8')
+    if code in (0xdc, 0xdd):
+      return self.read_array(self.read_struct({ 0xdc: '>H', 0xdd: '>I' }[code]))
+    if code in (0xde, 0xdf):
+      return self.read_map(self.read_struct({ 0xde: '>H', 0xdf: '>I' }[code]))
+    raise ValueError('invalid MessagePack code 0x%x' % code)
+
+  def read_array(self, length):
+    return [self.unpack() for i in range(length)]
+
+  def read_map(self, length):
+    d = {}
+    for i in range(length):
+      key = self.unpack()
+      d[key] = self.unpack()
+    return d
+
+
+def unpackb(data):
+  """ Decode a MessagePack object """
+  unpacker = Unpacker(data)
+  o = unpacker.unpack()
+  if not unpacker.at_end():
+    raise ValueError('extra data after the MessagePack object')
+  return o
+
+
+def unpack_stream(data):
+  """ Generator decoding the objects of a MessagePack stream """
+  unpacker = Unpacker(data)
+  while not unpacker.at_end():
+    yield unpacker.unpack()
+
+
+#
+# Entry points
+#
+def model_to_msgpack(instance, **kwargs):
+  """ Return the MessagePack encoding of the output of model_to_dict for an
+  instance, with the native values (see model_to_dict). Takes the same
+  keyword arguments as model_to_dict.
+  """
+  kwargs['native'] = True
+  return packb(model_to_dict(instance, **kwargs))
+
+
+def stream_queryset_msgpack(queryset, chunk_size=2000, **kwargs):
+  """ Generator yielding the MessagePack encoding of the instances of a
+  queryset, one fragment per chunk. The stream is a sequence of MessagePack
+  maps, one per instance, to be read with a streaming unpacker (the number of
+  instances is not known when the stream starts). Can be given as is to a
+  StreamingHttpResponse:
+    StreamingHttpResponse(stream_queryset_msgpack(queryset), content_type='application/msgpack')
+  Takes the same keyword arguments as queryset_to_dicts.
+  """
+  kwargs['native'] = True
+  for chunk in iterate_dict_chunks(queryset, chunk_size, **kwargs):
+    chunks = []
+    for d in chunk:
+      _pack(d, chunks.append)
+    yield b''.join(chunks)
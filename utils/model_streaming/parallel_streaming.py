@@ -0,0 +1,200 @@
+import os
+import json
+import multiprocessing
+import django
+from django.apps import apps
+from django.db import connections
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.msgpack_streaming import packb
+from utils.model_streaming.queryset_streaming import iterate_dict_chunks
+
+
+#
+# Parallel export of the instances of a queryset
+#
+# The queryset is split into ranges of primary keys, each range being
+# serialized by a process of a pool. Each process opens its own database
+# connection and compiles its own plans. The encoded ranges are written in
+# the order of the primary keys, as stream_queryset_json (format == 'json')
+# or stream_queryset_msgpack (format == 'msgpack') would output them for the
+# queryset ordered by pk.
+#
+# The last range has no upper bound so that the rows created after the
+# ranges were computed are exported as well.
+#
+def pk_ranges(queryset, range_size=20000):
+  """ Split a queryset into ranges of range_size primary keys, as a list of
+  (first pk, last pk), the last pk of the last range being None.
+  """
+  if not queryset.query.can_filter():
+    raise ValueError('a sliced queryset can not be split into pk ranges')
+  ranges = []
+  first = None
+  count = 0
+  for pk in queryset.order_by('pk').values_list('pk', flat=True).iterator(chunk_size=range_size):
+    if count == 0:
+      first = pk
+    count += 1
+    if count == range_size:
+      ranges.append((first, pk))
+      count = 0
+  if count:
+    ranges.append((first, None))
+  elif ranges:
+    ranges[-1] = (ranges[-1][0], None)
+  return ranges
+
+
+def encode_range(queryset, format, chunk_size, kwargs):
+  """ Return the encoded instances of a queryset, without the enclosing JSON
+  array, and their number.
+  """
+  if format == 'msgpack':
+    kwargs = dict(kwargs, native=True)
+  count = 0
+  fragments = []
+  for chunk in iterate_dict_chunks(queryset, chunk_size, **kwargs):
+    count += len(chunk)
+    if format == 'json':
+      fragments.append(','.join(dumps(d) for d in chunk).encode('utf-8'))
+    else:
+      fragments.extend(packb(d) for d in chunk)
+  return (b',' if format == 'json' else b'').join(fragments), count
+
+
+def _init_worker():
+  # With the spawn start method, the worker starts without Django
+  if not apps.ready:
+    django.setup()
+
+
+def export_range(task):
+  """ Encode the instances of a pk range, run by the processes of the pool.
+  task is (model label, database alias, query, first pk, last pk, format,
+  chunk_size, keyword arguments of model_to_dict).
+  """
+  label, using, query, first, last, format, chunk_size, kwargs = task
+  queryset = apps.get_model(label)._default_manager.db_manager(using).all()
+  queryset.query = query
+  queryset = queryset.filter(pk__gte=first).order_by('pk')
+  if last is not None:
+    queryset = queryset.filter(pk__lte=last)
+  return encode_range(queryset, format, chunk_size, kwargs)
+
+
+def iterate_ranges(queryset, ranges, processes=None, format='json', chunk_size=2000, **kwargs):
+  """ Generator yielding the (encoded instances, number of instances) of each
+  pk range, in order.
+  Keyword arguments:
+  ranges -- the pk ranges, see pk_ranges
+  processes -- number of processes, the number of CPUs if None, 0 to encode
+  the ranges in the current process
+  format -- 'json' or 'msgpack'
+  chunk_size -- number of instances fetched and encoded at once by a process
+  Takes the same keyword arguments as queryset_to_dicts.
+  """
+  if format not in ('json', 'msgpack'):
+    raise ValueError('unknown export format: %s' % format)
+  tasks = [(queryset.model._meta.label, queryset.db, queryset.query, first, last, format, chunk_size, kwargs)
+           for first, last in ranges]
+  if processes == 0:
+    for task in tasks:
+      yield export_range(task)
+    return
+  # The forked processes must not share the connections of this one
+  connections.close_all()
+  pool = multiprocessing.Pool(processes, _init_worker)
+  try:
+    for result in pool.imap(export_range, tasks):
+      yield result
+  finally:
+    pool.terminate()
+    pool.join()
+
+
+def stream_queryset_parallel(queryset, processes=None, range_size=20000, format='json', chunk_size=2000, **kwargs):
+  """ Generator yielding the encoded instances of a queryset ordered by pk,
+  one fragment per range, as stream_queryset_json (format == 'json') or
+  stream_queryset_msgpack (format == 'msgpack') do. See iterate_ranges.
+  """
+  ranges = pk_ranges(queryset, range_size)
+  separator = b'['
+  for payload, count in iterate_ranges(queryset, ranges, processes, format, chunk_size, **kwargs):
+    if format == 'msgpack':
+      yield payload
+    elif count:
+      yield separator + payload
+      separator = b','
+  if format == 'json':
+    yield b']' if separator == b',' else b'[]'
+
+
+#
+# Resumable export to a file
+#
+# The progress is kept next to the output file (path + '.progress'): the pk
+# ranges, the number of ranges written and the size of the output after the
+# last one. An interrupted export restarts after the last range written.
+#
+def read_progress(path, spec):
+  try:
+    with open(path) as progress_file:
+      progress = json.load(progress_file)
+  except (IOError, OSError):
+    return None
+  if progress['spec'] != spec:
+    raise ValueError('%s belongs to another export, remove it to restart' % path)
+  return progress
+
+
+def write_progress(path, progress):
+  with open(path + '.tmp', 'w') as progress_file:
+    json.dump(progress, progress_file)
+  os.rename(path + '.tmp', path)
+
+
+def export_queryset(queryset, path, processes=None, range_size=20000, format='json', chunk_size=2000,
+                    progress=None, **kwargs):
+  """ Export the instances of a queryset ordered by pk to a file, the ranges
+  of range_size instances being encoded in parallel (see iterate_ranges).
+  The export restarts after the last range written if it was interrupted.
+  Return the number of instances written by this call.
+  Keyword arguments:
+  path -- path of the output file
+  progress -- callable receiving (ranges written, number of ranges, instances
+  written) after each range
+  Takes the same keyword arguments as iterate_ranges.
+  """
+  spec = json.loads(dumps({ 'model': queryset.model._meta.label, 'format': format, 'kwargs': kwargs }))
+  progress_path = path + '.progress'
+  state = read_progress(progress_path, spec) if os.path.exists(path) else None
+  if state is None:
+    state = { 'spec': spec, 'ranges': pk_ranges(queryset, range_size), 'done': 0, 'offset': 0, 'count': 0,
+              'complete': False }
+    write_progress(progress_path, state)
+  if state['complete']:
+    return 0
+  written = 0
+  with open(path, 'r+b' if os.path.exists(path) else 'wb') as output:
+    output.seek(state['offset'])
+    output.truncate()
+    if format == 'json' and state['offset'] == 0:
+      output.write(b'[')
+    ranges = state['ranges'][state['done']:]
+    for payload, count in iterate_ranges(queryset, ranges, processes, format, chunk_size, **kwargs):
+      if format == 'json' and count and state['count']:
+        output.write(b',')
+      output.write(payload)
+      output.flush()
+      written += count
+      state['done'] += 1
+      state['count'] += count
+      state['offset'] = output.tell()
+      write_progress(progress_path, state)
+      if progress is not None:
+        progress(state['done'], len(state['ranges']), state['count'])
+    if format == 'json':
+      output.write(b']')
+  state['complete'] = True
+  write_progress(progress_path, state)
+  return written
@@ -0,0 +1,348 @@
+import json
+import uuid
+import hashlib
+from itertools import islice
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+from django.db.models.signals import m2m_changed
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.field_selectors import compile_selector
+from utils.model_streaming.field_selectors import canonical_selector
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.msgpack_streaming import packb
+from utils.model_streaming.queryset_streaming import load_queryset
+from utils.model_streaming.queryset_streaming import model_tree_map
+from utils.model_streaming.update_model_from_dict import bulk_saved
+
+
+#
+# Cache of the encoded output of model_to_dict
+#
+# The encoded bytes of an instance are stored per (model, pk, output options,
+# format) under a key holding the modified date of the instance when it has
+# one (see BaseCustomModel), so that an instance saved in another process is
+# not served from a stale local cache.
+# Each object output in a payload has a version in the cache, a random token
+# dropped (and later replaced) when the object is saved, written in bulk by
+# update_model_from_dict (see bulk_saved) or deleted, and when an object its
+# ForeignKeys point to is (its reverse relations change). A payload is stored
+# with the versions of all the objects it holds and only served while they
+# are unchanged. The versions are read (and the missing ones added) before
+# the objects are loaded, so that a change made while a payload is encoded
+# drops a version the payload is stored with. As the objects of a payload
+# are only known once it is encoded, they are recorded for the next encoding
+# of the instance (see ids_key): a payload is stored from its second encoding
+# on, when it holds no object missing from that record.
+# The versions and records are only added or overwritten, never read to be
+# updated, so that concurrent processes can not lose each other's
+# invalidations.
+#
+# The payloads are only cached for the models declared with
+# connect_invalidation, whose signal receivers are connected to the models
+# their payloads may hold.
+#
+# Settings:
+# MODEL_STREAMING_CACHE -- alias of the cache, e.g. a LocMemNoPickleCache
+# (see utils.locmemcache) which returns the stored bytes without copying
+# them. Default == 'default'.
+# MODEL_STREAMING_CACHE_TIMEOUT -- timeout of the payloads, the default
+# timeout of the cache if not set.
+# MODEL_STREAMING_CACHED_MODELS -- labels of the models whose payloads are
+# cached ('app_label.ModelName'), connected when the app is ready (see
+# utils.apps).
+#
+def get_payload_cache():
+  return caches[getattr(settings, 'MODEL_STREAMING_CACHE', 'default')]
+
+
+def timeout_kwargs():
+  if hasattr(settings, 'MODEL_STREAMING_CACHE_TIMEOUT'):
+    return { 'timeout': settings.MODEL_STREAMING_CACHE_TIMEOUT }
+  return {}
+
+
+# Encoders of the cached formats, returning bytes
+encoders = {
+  'json': lambda d: dumps(d).encode('utf-8'),
+  'msgpack': packb,
+}
+
+
+def spec_key(format, kwargs):
+  """ Return the hash of the output format and of the keyword arguments of
+  model_to_dict.
+  """
+  if format not in encoders:
+    raise ValueError('unknown payload format: %s' % format)
+  spec = dict((name, kwargs.get(name, None))
+              for name in ('included_fields', 'excluded_fields', 'max_depth', 'expand', 'relations'))
+  for name in ('included_fields', 'excluded_fields'):
+    if spec[name] is not None:
+      spec[name] = sorted(spec[name])
+  # A selector given as a string or compiled to a Selection gives the same key
+  select = compile_selector(kwargs.get('select', None))
+  spec['select'] = canonical_selector(select) if select is not None else None
+  spec['format'] = format
+  return hashlib.md5(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def payload_key(model, pk, spec, version):
+  return 'ms:payload:%s:%s:%s:%s' % (model._meta.label_lower, pk, spec, version)
+
+
+# Key of the record of the objects held by the last payload encoded for an
+# instance, whatever its modified date
+def ids_key(model, pk, spec):
+  return 'ms:ids:%s:%s:%s' % (model._meta.label_lower, pk, spec)
+
+
+# Key of the version of an object, by model label as in the ids collected by
+# model_to_dict
+def version_key(label, pk):
+  return 'ms:version:%s:%s' % (label, pk)
+
+
+# Version of the payload of an instance from its modified date
+def payload_version(modified):
+  return modified.strftime('%Y%m%d%H%M%S%f') if modified is not None else '-'
+
+
+def encode_payload(instance, format, kwargs):
+  """ Return the encoded output of model_to_dict for an instance and the
+  (pk, model label) of all the objects it holds.
+  """
+  kwargs = dict(kwargs, ids=set())
+  if format == 'msgpack':
+    kwargs['native'] = True
+  payload = encoders[format](model_to_dict(instance, **kwargs))
+  return payload, kwargs['ids']
+
+
+def read_versions(model, pks, spec, cache):
+  """ Return the records of the objects held by the payloads of instances
+  (see ids_key) and the versions of these objects and of the instances, the
+  missing versions being added. To be called before the instances are
+  loaded.
+  Return (records, versions):
+  records -- { ids key: set of (pk, model label) }
+  versions -- { version key: version }
+  """
+  records = cache.get_many([ids_key(model, pk, spec) for pk in pks])
+  records = dict((key, set(ids)) for key, ids in records.items())
+  keys = set(version_key(model._meta.label, pk) for pk in pks)
+  for ids in records.values():
+    keys.update(version_key(label, pk) for pk, label in ids)
+  versions = cache.get_many(list(keys))
+  missing = [key for key in keys if key not in versions]
+  if missing:
+    timeout = timeout_kwargs()
+    for key in missing:
+      # another process may add it meanwhile, the one stored is read below
+      cache.add(key, uuid.uuid4().hex, **timeout)
+    versions.update(cache.get_many(missing))
+  return records, versions
+
+
+def store_payloads(model, spec, payloads, records, versions, cache):
+  """ Store the encoded payloads whose objects all had a version read before
+  they were loaded, with these versions, and record the objects of the
+  others for their next encoding.
+  Keyword arguments:
+  payloads -- list of (pk, key, payload, ids) where ids holds the (pk, model
+  label) of the objects of the payload
+  records, versions -- returned by read_versions
+  cache -- the cache
+  """
+  stored = {}
+  recorded = {}
+  for pk, key, payload, ids in payloads:
+    names = [version_key(label, object_pk) for object_pk, label in ids]
+    # the instance itself has a version, whether recorded or not
+    recorded_ids = records.get(ids_key(model, pk, spec), set()) | set([(pk, model._meta.label)])
+    if ids <= recorded_ids and all(name in versions for name in names):
+      stored[key] = (dict((name, versions[name]) for name in names), payload)
+    else:
+      recorded[ids_key(model, pk, spec)] = list(ids)
+  timeout = timeout_kwargs()
+  if stored:
+    cache.set_many(stored, **timeout)
+  if recorded:
+    cache.set_many(recorded, **timeout)
+
+
+def valid_payloads(entries, cache):
+  """ Return { key: payload } of the stored entries { key: (versions,
+  payload) } whose objects have not changed since they were encoded.
+  """
+  keys = set()
+  for versions, payload in entries.values():
+    keys.update(versions)
+  current = cache.get_many(list(keys)) if keys else {}
+  return dict((key, payload) for key, (versions, payload) in entries.items()
+              if all(current.get(name, None) == version for name, version in versions.items()))
+
+
+def check_cached(model):
+  if model not in cached_models:
+    raise ValueError('the payloads of %s are not cached, see connect_invalidation' % model._meta.label)
+
+
+def cached_model_to_bytes(instance, format='json', **kwargs):
+  """ Return the encoded output of model_to_dict for an instance, from the
+  cache when it is there.
+  Keyword arguments:
+  format -- 'json' or 'msgpack'
+  Takes the same keyword arguments as model_to_dict.
+  """
+  model = instance.__class__
+  check_cached(model)
+  cache = get_payload_cache()
+  spec = spec_key(format, kwargs)
+  key = payload_key(model, instance.pk, spec, payload_version(getattr(instance, 'modified', None)))
+  entry = cache.get(key)
+  payload = valid_payloads({ key: entry }, cache).get(key, None) if entry is not None else None
+  if payload is None:
+    records, versions = read_versions(model, [instance.pk], spec, cache)
+    # Loaded again after the versions were read, the instance may be older
+    loaded = model._base_manager.using(instance._state.db).filter(pk=instance.pk).first()
+    # Cut as by stream_queryset_cached, the payloads being shared
+    payload, ids = encode_payload(loaded or instance, format, dict(kwargs, tree=model_tree_map(model, **kwargs)))
+    if loaded is not None:
+      store_payloads(model, spec, [(instance.pk, key, payload, ids)], records, versions, cache)
+  return payload
+
+
+def stream_queryset_cached(queryset, chunk_size=2000, format='json', **kwargs):
+  """ Generator yielding the encoded instances of a queryset, as
+  stream_queryset_json (format == 'json') or stream_queryset_msgpack
+  (format == 'msgpack') do, the cached payloads being yielded as memoryview
+  fragments without copy.
+  For each chunk, the keys are computed from the pk and modified date of the
+  rows, and only the instances missing from the cache are loaded and encoded.
+  Takes the same keyword arguments as queryset_to_dicts.
+  """
+  model = queryset.model
+  check_cached(model)
+  cache = get_payload_cache()
+  spec = spec_key(format, kwargs)
+  versioned = any(field.name == 'modified' for field in model._meta.concrete_fields)
+  rows = queryset.values_list(*(('pk', 'modified') if versioned else ('pk',))).iterator(chunk_size=chunk_size)
+  json_format = format == 'json'
+  # The instances are encoded with the relations prefetched, see tree_map
+  loaded_kwargs = dict(kwargs, tree=model_tree_map(queryset.model, **kwargs))
+  separator = b'['
+  while True:
+    chunk = list(islice(rows, chunk_size))
+    if not chunk:
+      break
+    keys = [payload_key(model, row[0], spec, payload_version(row[1] if versioned else None)) for row in chunk]
+    found = valid_payloads(cache.get_many(keys), cache)
+    missing = dict((row[0], key) for row, key in zip(chunk, keys) if key not in found)
+    if missing:
+      records, versions = read_versions(model, list(missing), spec, cache)
+      payloads = []
+      for instance in load_queryset(model._default_manager.filter(pk__in=list(missing)), **kwargs):
+        payload, ids = encode_payload(instance, format, loaded_kwargs)
+        payloads.append((instance.pk, missing[instance.pk], payload, ids))
+        found[missing[instance.pk]] = payload
+      store_payloads(model, spec, payloads, records, versions, cache)
+    for key in keys:
+      if key not in found:
+        # deleted since the chunk was read
+        continue
+      if json_format:
+        yield separator
+        separator = b','
+      yield memoryview(found[key])
+  if json_format:
+    yield b']' if separator == b',' else b'[]'
+
+
+#
+# Invalidation
+#
+# Models connected by connect_invalidation
+cached_models = set()
+
+
+def invalidate_objects(objects):
+  """ Invalidate the payloads holding any of the objects, given as a list of
+  (model label, pk), by deleting their versions.
+  """
+  get_payload_cache().delete_many([version_key(label, pk) for label, pk in objects])
+
+
+def related_objects(instance):
+  """ The instance and the objects its ForeignKeys and OneToOneFields point
+  to, as (model label, pk).
+  """
+  objects = [(instance._meta.label, instance.pk)]
+  for field in instance._meta.concrete_fields:
+    if field.is_relation:
+      pk = getattr(instance, field.attname)
+      if pk is not None:
+        objects.append((field.related_model._meta.label, pk))
+  return objects
+
+
+def invalidate_instance(sender, instance, **kwargs):
+  if kwargs.get('bulk', False):
+    # written in bulk, invalidated with the batch by invalidate_instances
+    return
+  invalidate_objects(related_objects(instance))
+
+
+# The instances written in bulk by update_model_from_dict, invalidated with
+# one cache query
+def invalidate_instances(sender, instances, **kwargs):
+  objects = []
+  for instance in instances:
+    objects.extend(related_objects(instance))
+  invalidate_objects(objects)
+
+
+def invalidate_m2m(sender, instance, action, model, pk_set, **kwargs):
+  if not action.startswith('post_'):
+    return
+  objects = related_objects(instance)
+  objects.extend((model._meta.label, pk) for pk in pk_set or ())
+  invalidate_objects(objects)
+
+
+def payload_models(model):
+  """ The models whose objects the payloads of a model may hold: the model
+  and the ones reachable through its relations.
+  """
+  models = set([model])
+  pending = [model]
+  while pending:
+    for field in pending.pop()._meta.get_fields(include_hidden=True):
+      related_model = field.related_model if field.is_relation else None
+      if related_model is not None and related_model not in models:
+        models.add(related_model)
+        pending.append(related_model)
+  return models
+
+
+def connect_invalidation(*models):
+  """ Cache the payloads of models: connect the invalidation receivers to
+  the models their payloads may hold and to the through models of their many
+  to many relations.
+  """
+  for model in models:
+    for sender in payload_models(model):
+      post_save.connect(invalidate_instance, sender=sender, dispatch_uid='model_streaming_payload_cache')
+      post_delete.connect(invalidate_instance, sender=sender, dispatch_uid='model_streaming_payload_cache')
+      bulk_saved.connect(invalidate_instances, sender=sender, dispatch_uid='model_streaming_payload_cache')
+      for field in sender._meta.many_to_many:
+        m2m_changed.connect(invalidate_m2m, sender=field.remote_field.through,
+                            dispatch_uid='model_streaming_payload_cache')
+    cached_models.add(model)
+
+
+def connect_cached_models():
+  """ Connect the models of the MODEL_STREAMING_CACHED_MODELS setting """
+  connect_invalidation(*[apps.get_model(label) for label in getattr(settings, 'MODEL_STREAMING_CACHED_MODELS', ())])
@@ -0,0 +1,228 @@
+import logging
+import threading
+from django.conf import settings
+from django.db import connections
+
+try:
+  from django.utils.deprecation import MiddlewareMixin
+except ImportError:
+  MiddlewareMixin = object
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+try:
+  from time import perf_counter as timer
+except ImportError:
+  from time import time as timer
+
+logger = logging.getLogger(__name__)
+
+
+#
+# Profiling of model_to_dict
+#
+# While a SerializationProfile is active in a thread, model_to_dict runs its
+# plans with timed serializers (see SerializationProfile.instrument) and the
+# queries of the database connections are counted per relation path. Nothing
+# is recorded, and nothing is slowed down but one lookup per instance, when
+# no profile is active.
+#
+_state = threading.local()
+
+
+def active_profile():
+  """ The innermost profile active in the current thread, None if there is
+  none.
+  """
+  profiles = getattr(_state, 'profiles', None)
+  return profiles[-1] if profiles else None
+
+
+class SerializationProfile(object):
+  """ Context manager recording, for the model_to_dict calls run while it is
+  active:
+  serializers -- { serializer name: [calls, time, own time] }, the own time
+  leaving out the time spent in the nested serializers
+  queries -- { relation path: number of queries }, '' for the queries run
+  outside of a relation (e.g. the prefetch queries of the batch entry points)
+  objects -- { model name: number of objects output }
+  peak_memory -- peak of the memory allocated while active, in bytes (with
+  memory=True, using tracemalloc)
+  duration -- time spent while active
+  The same profile can be entered several times (e.g. for each fragment of a
+  stream), the figures adding up.
+  """
+  def __init__(self, memory=False):
+    self.memory = memory and tracemalloc is not None
+    self.serializers = {}
+    self.queries = {}
+    self.objects = {}
+    self.peak_memory = None
+    self.duration = 0.0
+    self._plans = {}
+    # relation paths of the serializers running, and the time spent in their
+    # nested serializers
+    self._paths = []
+    self._children = []
+    # accessor name of the relation whose getter is running
+    self._getter = None
+
+  def __enter__(self):
+    if not hasattr(_state, 'profiles'):
+      _state.profiles = []
+    _state.profiles.append(self)
+    for connection in connections.all():
+      connection.execute_wrappers.append(self.count_query)
+    self._traced = False
+    if self.memory:
+      if not tracemalloc.is_tracing():
+        tracemalloc.start()
+        self._traced = True
+      self._memory_start = tracemalloc.get_traced_memory()[0]
+      if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    self._start = timer()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.duration += timer() - self._start
+    if self.memory:
+      peak = tracemalloc.get_traced_memory()[1] - self._memory_start
+      self.peak_memory = max(peak, self.peak_memory or 0)
+      if self._traced:
+        tracemalloc.stop()
+    for connection in connections.all():
+      if self.count_query in connection.execute_wrappers:
+        connection.execute_wrappers.remove(self.count_query)
+    _state.profiles.remove(self)
+
+  def visit(self, model_name):
+    self.objects[model_name] = self.objects.get(model_name, 0) + 1
+
+  def count_query(self, execute, sql, params, many, context):
+    path = self._paths[-1] if self._paths else ''
+    if self._getter is not None:
+      # Lazy loading of a relation by its getter
+      path = path + '.' + self._getter if path else self._getter
+    self.queries[path] = self.queries.get(path, 0) + 1
+    return execute(sql, params, many, context)
+
+  def instrument(self, plan):
+    """ Return the plan with timed serializers, and getters of the relations
+    accounting their queries to the relation.
+    """
+    try:
+      return self._plans[id(plan)][1]
+    except KeyError:
+      pass
+    instrumented = tuple((field_name,
+                          self.relation_getter(field_name, getter) if field.is_relation else getter,
+                          self.timed_serializer(serializer),
+                          field)
+                         for field_name, getter, serializer, field in plan)
+    # The plan is kept so that its id is not reused
+    self._plans[id(plan)] = (plan, instrumented)
+    return instrumented
+
+  def relation_getter(self, field_name, getter):
+    def relation_getter(instance):
+      previous, self._getter = self._getter, field_name
+      try:
+        return getter(instance)
+      finally:
+        self._getter = previous
+    return relation_getter
+
+  def timed_serializer(self, serializer):
+    name = serializer.__name__
+
+    def timed_serializer(value, **kwargs):
+      relation = kwargs['field'].is_relation
+      if relation:
+        self._paths.append(kwargs['path'][:-1])
+      self._children.append(0.0)
+      start = timer()
+      try:
+        return serializer(value, **kwargs)
+      finally:
+        elapsed = timer() - start
+        children = self._children.pop()
+        if self._children:
+          self._children[-1] += elapsed
+        if relation:
+          self._paths.pop()
+        stats = self.serializers.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] += elapsed - children
+    return timed_serializer
+
+  def summary(self):
+    """ The figures of the profile as a dictionary, the times in milliseconds """
+    return {
+      'duration': self.duration * 1000,
+      'serializers': dict((name, { 'calls': calls, 'time': time * 1000, 'own_time': own_time * 1000 })
+                          for name, (calls, time, own_time) in self.serializers.items()),
+      'queries': dict(self.queries),
+      'objects': dict(self.objects),
+      'peak_memory': self.peak_memory,
+    }
+
+  def header(self):
+    """ One line summary: duration, queries, objects, peak memory, and the
+    serializer and the relation path taking the most own time and queries.
+      duration=12.1ms queries=3 objects=120 peak=2.5kB serializer=to_dict:4.2ms path=b.c:2
+    """
+    items = ['duration=%.1fms' % (self.duration * 1000),
+             'queries=%i' % sum(self.queries.values()),
+             'objects=%i' % sum(self.objects.values())]
+    if self.peak_memory is not None:
+      items.append('peak=%.1fkB' % (self.peak_memory / 1024.0))
+    if self.serializers:
+      name, stats = max(self.serializers.items(), key=lambda item: item[1][2])
+      items.append('serializer=%s:%.1fms' % (name, stats[2] * 1000))
+    if self.queries:
+      path, count = max(self.queries.items(), key=lambda item: item[1])
+      items.append('path=%s:%i' % (path or '-', count))
+    return ' '.join(items)
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+  """ Profile the model_to_dict calls of each request. The summary (see
+  SerializationProfile.header) is logged and returned in a header, except
+  for the streaming responses whose content is serialized after the headers
+  are sent: they are profiled while streamed and logged once done.
+  Settings:
+  MODEL_STREAMING_PROFILE_HEADER -- name of the header, default ==
+  'X-Model-Streaming-Profile'
+  MODEL_STREAMING_PROFILE_MEMORY -- if True, the peak memory is recorded with
+  tracemalloc, default == False
+  """
+  def process_request(self, request):
+    request._ms_profile = SerializationProfile(getattr(settings, 'MODEL_STREAMING_PROFILE_MEMORY', False))
+    request._ms_profile.__enter__()
+
+  def process_response(self, request, response):
+    profile = getattr(request, '_ms_profile', None)
+    if profile is None:
+      return response
+    profile.__exit__(None, None, None)
+    if getattr(response, 'streaming', False) and not getattr(response, 'is_async', False):
+      response.streaming_content = self.profiled_stream(request, profile, response.streaming_content)
+      return response
+    header = profile.header()
+    logger.info('%s %s', request.path, header)
+    response[getattr(settings, 'MODEL_STREAMING_PROFILE_HEADER', 'X-Model-Streaming-Profile')] = header
+    return response
+
+  def profiled_stream(self, request, profile, content):
+    iterator = iter(content)
+    while True:
+      with profile:
+        try:
+          fragment = next(iterator)
+        except StopIteration:
+          break
+      yield fragment
+    logger.info('%s %s', request.path, profile.header())
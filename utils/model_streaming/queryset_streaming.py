@@ -0,0 +1,485 @@
+from django.db import models
+from django.db.models import Count
+from django.db.models import Exists
+from django.db.models import IntegerField
+from django.db.models import OuterRef
+from django.db.models import Prefetch
+from django.db.models import Subquery
+from django.db.models import prefetch_related_objects
+from django.db.models.functions import Coalesce
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.model_streaming import compile_plan
+from utils.model_streaming.model_streaming import compact_schema
+from utils.model_streaming.model_streaming import relation_attname
+from utils.model_streaming.model_streaming import reference_attname
+from utils.model_streaming.model_streaming import get_field_name
+from utils.model_streaming.model_streaming import to_dict
+from utils.model_streaming.field_selectors import compile_selector
+from utils.model_streaming.field_selectors import empty_selection
+from utils.model_streaming.model_streaming import OneToOneField_serializer
+from utils.model_streaming.model_streaming import ManyToManyField_serializer
+from utils.model_streaming.model_streaming import RelatedField_serializer
+from utils.model_streaming.values_streaming import flat_projection
+from utils.model_streaming.values_streaming import projection_rows
+
+
+# The serializers following a relation, i.e. the ones triggering a query when
+# the related objects are not already loaded.
+related_serializers = (
+  to_dict,
+  OneToOneField_serializer,
+  ManyToManyField_serializer,
+  RelatedField_serializer,
+)
+
+
+def get_back_reference(field):
+  """ Return the name of the relation pointing back to the parent that Django
+  already sets on the related objects when loading them, or None.
+  """
+  if field.one_to_many or (field.one_to_one and field.auto_created):
+    # reverse ForeignKey (prefetch) or reverse OneToOneField (select_related)
+    return field.field.name
+  if field.one_to_one:
+    # OneToOneField (select_related)
+    return field.remote_field.get_accessor_name()
+  return None
+
+
+def relation_tree(model, included_fields=None, excluded_fields=None, max_depth=100, expand=None,
+                  relations=None, walked=(), path='', selection=None, references=False):
+  """ Compute the relations model_to_dict will follow starting from a model.
+  Returns a list of (accessor name, field, sub tree, options, plan of the
+  related model).
+  A model already walked to reach this one is fetched but not walked any
+  further: model_to_dict only outputs a reference to an instance already
+  output, and the columns, the ForeignKey stubs and the references of the
+  other relations of another instance of the model (see tree_map). The sub
+  tree of such a relation is None, only the ids of the related objects are
+  loaded.
+  Keyword arguments:
+  model -- the model class
+  included_fields -- see model_to_dict
+  excluded_fields -- see model_to_dict
+  max_depth -- levels of relations to expand, see model_to_dict
+  expand -- expansion rules, see model_to_dict
+  relations -- options of the relations, see model_to_dict
+  walked -- models already walked to reach this one
+  path -- relation path leading to this model
+  selection -- the Selection of the fields of this model, see model_to_dict
+  references -- only load the ids of the related objects
+  """
+  tree = []
+  walked = walked + (model,)
+  for field_name, getter, serializer, field in compile_plan(model, included_fields, excluded_fields, selection):
+    if serializer not in related_serializers:
+      continue
+    if references and isinstance(field, models.ForeignKey):
+      # model_to_dict outputs a stub from the column
+      continue
+    field_path = path + field_name
+    levels = expand.get(field_path, max_depth) if expand else max_depth
+    if levels <= 0:
+      # model_to_dict outputs a stub without loading the related objects
+      continue
+    multiple = field.many_to_many or field.one_to_many
+    options = relations.get(field_path, None) if relations and multiple else None
+    related_selection = selection.related(field_name) if selection is not None else None
+    if is_aggregate(options):
+      subtree = []
+    elif references:
+      subtree = None
+      related_selection = empty_selection
+    else:
+      subtree = relation_tree(field.related_model, included_fields, excluded_fields, levels - 1, expand,
+                              relations, walked, field_path + '.', related_selection,
+                              field.related_model in walked)
+    if subtree:
+      back_reference = get_back_reference(field)
+      subtree = [node for node in subtree if node[0] != back_reference]
+    related_plan = compile_plan(field.related_model, included_fields, excluded_fields, related_selection)
+    tree.append((field_name, field, subtree, options, related_plan))
+  return tree
+
+
+def tree_map(tree):
+  """ Return the relations of a relation tree as nested dictionaries,
+  { accessor name: sub tree }, given to model_to_dict as its tree keyword
+  argument: the relations not in it are not loaded, model_to_dict outputs
+  them as beyond max_depth instead of running a query. A cycle reaching
+  another row of a model already walked (A1 -> CyclicForeignKey -> A2) is
+  thus cut where the relations are no longer loaded, and the number of
+  queries does not depend on the rows. The relations of which only the ids
+  are loaded map to None, model_to_dict outputs the references of the
+  related objects.
+  """
+  return dict((node[0], tree_map(node[2]) if node[2] is not None else None) for node in tree)
+
+
+# Whether the options of a relation only output a count or a flag
+def is_aggregate(options):
+  return options is not None and (options.get('count', False) or options.get('exists', False))
+
+
+def aggregate_annotation(field, options):
+  """ Return the expression annotating the parent queryset with the count or
+  the existence of the related objects of a relation, computed in a
+  subquery so that several relations do not multiply the joined rows.
+  """
+  back_reference = field.remote_field.name
+  related = field.related_model._default_manager.filter(**{back_reference: OuterRef('pk')}).order_by()
+  if options.get('count', False):
+    count = related.values(back_reference).annotate(count=Count('pk')).values('count')
+    return Coalesce(Subquery(count, output_field=IntegerField()), 0)
+  return Exists(related)
+
+
+def tree_lookups(tree):
+  """ Return the select_related lookups for the single valued relations of a
+  tree, the prefetch_related lookups (nested Prefetch objects) for the
+  multiple valued ones and the annotations for the counted ones.
+  """
+  select_related = []
+  prefetch_related = []
+  annotations = {}
+  for field_name, field, subtree, options, plan in tree:
+    if is_aggregate(options):
+      annotations[relation_attname(field_name)] = aggregate_annotation(field, options)
+  _collect_lookups(tree, '', select_related, prefetch_related)
+  return select_related, prefetch_related, annotations
+
+
+def is_joined(field, subtree, options):
+  """ Whether a relation of a tree is loaded with select_related """
+  if field.many_to_many or field.one_to_many or is_aggregate(options) or subtree is None:
+    return False
+  # The annotations must be on the queryset loading the related object
+  return not any(is_aggregate(node[3]) for node in subtree)
+
+
+def loaded_fields(model, plan, tree, prefix=''):
+  """ Return the field names to give to only() to load the columns output
+  with a plan (and the ones of the relations joined with select_related), and
+  whether some columns are left out.
+  """
+  names = [prefix + model._meta.pk.name]
+  deferred = False
+  columns = set(field.name for field_name, getter, serializer, field in plan
+                if field.concrete and not field.many_to_many)
+  for field in model._meta.concrete_fields:
+    if field.name in columns:
+      names.append(prefix + field.name)
+    elif not field.primary_key:
+      deferred = True
+  for field_name, field, subtree, options, related_plan in tree:
+    if is_joined(field, subtree, options):
+      related_names, related_deferred = loaded_fields(field.related_model, related_plan, subtree,
+                                                      prefix + field_name + '__')
+      names.extend(related_names)
+      deferred = deferred or related_deferred
+  return names, deferred
+
+
+def load_only(queryset, plan, tree, required=()):
+  """ Restrict a queryset to the columns output with a plan, when some columns
+  are not output.
+  Keyword arguments:
+  plan -- the plan of the model of the queryset
+  tree -- its relation tree
+  required -- names of the fields to load anyway
+  """
+  names, deferred = loaded_fields(queryset.model, plan, tree)
+  if not deferred:
+    return queryset
+  return queryset.only(*(names + [name for name in required if name not in names]))
+
+
+def prefetch_tree(queryset, tree):
+  """ Apply the lookups of a relation tree to a queryset """
+  select_related, prefetch_related, annotations = tree_lookups(tree)
+  if annotations:
+    queryset = queryset.annotate(**annotations)
+  if select_related:
+    queryset = queryset.select_related(*select_related)
+  if prefetch_related:
+    queryset = queryset.prefetch_related(*prefetch_related)
+  return queryset
+
+
+def relation_queryset(field, subtree, plan):
+  """ The queryset loading the related objects of a prefetched relation """
+  queryset = field.related_model._default_manager.all()
+  # The objects are matched to their parent with the ForeignKey of a reverse
+  # relation
+  required = (field.field.name,) if not field.concrete and not field.many_to_many else ()
+  return prefetch_tree(load_only(queryset, plan, subtree, required), subtree)
+
+
+def _collect_lookups(tree, prefix, select_related, prefetch_related):
+  for field_name, field, subtree, options, plan in tree:
+    lookup = prefix + field_name
+    if is_aggregate(options):
+      # annotated on the queryset of the parent
+      continue
+    if subtree is None and options is None:
+      # only the ids, see load_references
+      continue
+    if field.many_to_many or field.one_to_many:
+      related_queryset = relation_queryset(field, subtree or [], plan)
+      if options is None:
+        prefetch_related.append(Prefetch(lookup, queryset=related_queryset))
+        continue
+      # Ordered and limited in the same query for all the parents, the limit
+      # being applied per parent (ROW_NUMBER() window)
+      if 'ordering' in options:
+        related_queryset = related_queryset.order_by(*options['ordering'])
+      if 'limit' in options:
+        related_queryset = related_queryset[:options['limit']]
+      prefetch_related.append(Prefetch(lookup, queryset=related_queryset, to_attr=relation_attname(field_name)))
+    elif any(is_aggregate(node[3]) for node in subtree):
+      # The annotations must be on the queryset loading the related object
+      related_queryset = relation_queryset(field, subtree, plan)
+      prefetch_related.append(Prefetch(lookup, queryset=related_queryset))
+    else:
+      select_related.append(lookup)
+      _collect_lookups(subtree, lookup + '__', select_related, prefetch_related)
+
+
+def reference_lookup(field):
+  """ The lookup from the related objects of a relation back to its model """
+  if field.concrete:
+    return field.related_query_name()
+  return field.field.name
+
+
+def load_references(instances, tree):
+  """ Load the ids of the related objects of the relations of a tree of which
+  only the references are output (None sub tree), with one values_list()
+  query per relation for all the instances reaching it, whatever the path.
+  The instances must already hold the other relations of the tree.
+  """
+  parents = {}
+  _collect_references(instances, tree, parents)
+  for field, instances_by_pk in parents.items():
+    lookup = reference_lookup(field) + '__pk'
+    related = field.related_model._default_manager.filter(**{lookup + '__in': list(instances_by_pk)})
+    ids = dict((pk, []) for pk in instances_by_pk)
+    for parent_pk, pk in related.values_list(lookup, 'pk'):
+      ids[parent_pk].append(pk)
+    multiple = field.many_to_many or field.one_to_many
+    attname = reference_attname(get_field_name(field))
+    for parent_pk, parent_instances in instances_by_pk.items():
+      value = ids[parent_pk] if multiple else (ids[parent_pk] or [None])[0]
+      for instance in parent_instances:
+        setattr(instance, attname, value)
+
+
+def _collect_references(instances, tree, parents):
+  for field_name, field, subtree, options, plan in tree:
+    if is_aggregate(options):
+      continue
+    if subtree is None:
+      if options is None:
+        instances_by_pk = parents.setdefault(field, {})
+        for instance in instances:
+          instances_by_pk.setdefault(instance.pk, []).append(instance)
+      continue
+    if not subtree:
+      continue
+    related = []
+    for instance in instances:
+      if options is not None:
+        related.extend(getattr(instance, relation_attname(field_name)))
+      elif field.many_to_many or field.one_to_many:
+        related.extend(getattr(instance, field_name).all())
+      elif field.is_cached(instance) and field.get_cached_value(instance) is not None:
+        related.append(field.get_cached_value(instance))
+    if related:
+      _collect_references(related, subtree, parents)
+
+
+def queryset_relation_tree(queryset, **kwargs):
+  """ Return the relation tree of a queryset for the keyword arguments of
+  model_to_dict.
+  """
+  return relation_tree(queryset.model,
+                       kwargs.get('included_fields', None),
+                       kwargs.get('excluded_fields', None),
+                       kwargs.get('max_depth', 100),
+                       kwargs.get('expand', None),
+                       kwargs.get('relations', None),
+                       selection=compile_selector(kwargs.get('select', None)))
+
+
+def model_tree_map(model, **kwargs):
+  """ Return the tree_map of a model for the keyword arguments of
+  model_to_dict.
+  """
+  return tree_map(relation_tree(model,
+                                kwargs.get('included_fields', None),
+                                kwargs.get('excluded_fields', None),
+                                kwargs.get('max_depth', 100),
+                                kwargs.get('expand', None),
+                                kwargs.get('relations', None),
+                                selection=compile_selector(kwargs.get('select', None))))
+
+
+def queryset_plan(queryset, **kwargs):
+  """ Return the plan of the instances of a queryset for the keyword
+  arguments of model_to_dict.
+  """
+  return compile_plan(queryset.model,
+                      kwargs.get('included_fields', None),
+                      kwargs.get('excluded_fields', None),
+                      compile_selector(kwargs.get('select', None)))
+
+
+def prefetch_queryset(queryset, **kwargs):
+  """ Return the queryset with all the relations model_to_dict will follow
+  already joined or prefetched, and only the columns output loaded. Takes the
+  same keyword arguments as model_to_dict.
+  """
+  tree = queryset_relation_tree(queryset, **kwargs)
+  return prefetch_tree(load_only(queryset, queryset_plan(queryset, **kwargs), tree), tree)
+
+
+def load_queryset(queryset, **kwargs):
+  """ Return the instances of a queryset with all the relations model_to_dict
+  will follow loaded (see prefetch_queryset and load_references). Takes the
+  same keyword arguments as model_to_dict.
+  """
+  instances = list(prefetch_queryset(queryset, **kwargs))
+  load_references(instances, queryset_relation_tree(queryset, **kwargs))
+  return instances
+
+
+def chunked_queryset(queryset, **kwargs):
+  """ Return the queryset read by chunks, with only the columns output
+  loaded, the counts annotated and the single valued relations joined, the
+  prefetch_related lookups to apply to each chunk and the relation tree (see
+  load_references).
+  """
+  tree = queryset_relation_tree(queryset, **kwargs)
+  select_related, prefetch_related, annotations = tree_lookups(tree)
+  queryset = load_only(queryset, queryset_plan(queryset, **kwargs), tree)
+  if annotations:
+    queryset = queryset.annotate(**annotations)
+  if select_related:
+    queryset = queryset.select_related(*select_related)
+  return queryset, prefetch_related, tree
+
+
+def iterate_chunks(queryset, chunk_size=2000, **kwargs):
+  """ Iterate over a queryset with a server side cursor and yield lists of at
+  most chunk_size instances. The single valued relations are joined, the
+  multiple valued ones are prefetched for each chunk so only one chunk is
+  held in memory at a time.
+  """
+  queryset, prefetch_related, tree = chunked_queryset(queryset, **kwargs)
+  chunk = []
+  for instance in queryset.iterator(chunk_size=chunk_size):
+    chunk.append(instance)
+    if len(chunk) == chunk_size:
+      prefetch_related_objects(chunk, *prefetch_related)
+      load_references(chunk, tree)
+      yield chunk
+      chunk = []
+  if chunk:
+    prefetch_related_objects(chunk, *prefetch_related)
+    load_references(chunk, tree)
+    yield chunk
+
+
+def iterate_dict_chunks(queryset, chunk_size=2000, **kwargs):
+  """ Same as iterate_chunks but yields lists of dictionaries, read directly
+  from values_list() for the flat projections.
+  """
+  projection = flat_projection(queryset.model, **kwargs)
+  if projection is None:
+    tree = model_tree_map(queryset.model, **kwargs)
+    for chunk in iterate_chunks(queryset, chunk_size, **kwargs):
+      yield [model_to_dict(instance, tree=tree, **kwargs) for instance in chunk]
+    return
+  chunk = []
+  for d in projection_rows(queryset, projection, chunk_size):
+    chunk.append(d)
+    if len(chunk) == chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+def queryset_to_dicts(queryset, **kwargs):
+  """ Convert all the instances of a queryset to dictionaries.
+  The relations are loaded up front so the number of queries does not depend
+  on the number of rows.
+  Keyword arguments:
+  included_fields -- see model_to_dict
+  excluded_fields -- see model_to_dict
+  max_depth -- see model_to_dict
+  expand -- see model_to_dict
+  relations -- see model_to_dict
+  select -- see model_to_dict
+  When only columns of the model are output, no instance is built: the rows
+  are read with values_list().
+  """
+  projection = flat_projection(queryset.model, **kwargs)
+  if projection is not None:
+    return list(projection_rows(queryset, projection))
+  tree = model_tree_map(queryset.model, **kwargs)
+  return [model_to_dict(instance, tree=tree, **kwargs) for instance in load_queryset(queryset, **kwargs)]
+
+
+def queryset_to_graph(queryset, **kwargs):
+  """ Convert all the instances of a queryset to a normalized graph (see
+  model_to_graph), the objects shared by several rows being output once.
+    { 'data': [{ '$ref': 'A:12' }, { '$ref': 'A:13' }], 'objects': { ... } }
+  Takes the same keyword arguments as queryset_to_dicts.
+  """
+  tree = model_tree_map(queryset.model, **kwargs)
+  instances = load_queryset(queryset, **kwargs)
+  kwargs['objects'] = {}
+  data = [model_to_dict(instance, tree=tree, **kwargs) for instance in instances]
+  return { 'data': data, 'objects': kwargs['objects'] }
+
+
+def queryset_to_compact(queryset, **kwargs):
+  """ Convert all the instances of a queryset to the compact output (see
+  model_to_compact), the label tables being output once for all the rows.
+    { '_schema': { 'A': { 'option': ['Option 1', 'Option 2'] } },
+      'data': [{ 'id': 12, '_ms_type': 'A', 'option': 1 }, ...] }
+  Takes the same keyword arguments as queryset_to_dicts.
+  """
+  kwargs['schema'] = {}
+  data = queryset_to_dicts(queryset, **kwargs)
+  return { '_schema': compact_schema(kwargs['schema']), 'data': data }
+
+
+def stream_queryset_json(queryset, chunk_size=2000, compact=False, **kwargs):
+  """ Generator yielding the JSON array of the instances of a queryset, one
+  fragment per chunk. Can be given as is to a StreamingHttpResponse:
+    StreamingHttpResponse(stream_queryset_json(queryset), content_type='application/json')
+  Keyword arguments:
+  chunk_size -- number of instances fetched and encoded at once
+  included_fields -- see model_to_dict
+  excluded_fields -- see model_to_dict
+  max_depth -- see model_to_dict
+  expand -- see model_to_dict
+  relations -- see model_to_dict
+  select -- see model_to_dict
+  compact -- if True, stream the compact output (see queryset_to_compact),
+  the schema being output after the data as it is collected while streaming:
+    {"data":[...],"_schema":{...}}
+  """
+  if compact:
+    kwargs['schema'] = {}
+    yield '{"data":'
+  separator = '['
+  for chunk in iterate_dict_chunks(queryset, chunk_size, **kwargs):
+    yield separator + ','.join(dumps(d) for d in chunk)
+    separator = ','
+  yield ']' if separator == ',' else '[]'
+  if compact:
+    yield ',"_schema":%s}' % dumps(compact_schema(kwargs['schema']))
@@ -0,0 +1,316 @@
+from django.db import connections
+from django.db import models
+from django.db.models import F
+from django.db.models.constants import LOOKUP_SEP
+from django.db.models.expressions import OrderBy
+from django.db.models.expressions import RawSQL
+from utils.model_streaming.model_streaming import compile_plan
+from utils.model_streaming.model_streaming import default_serializer
+from utils.model_streaming.model_streaming import Choice_serializer
+from utils.model_streaming.model_streaming import BitField_serializer
+from utils.model_streaming.model_streaming import DateTimeField_serializer
+from utils.model_streaming.queryset_streaming import related_serializers
+from utils.model_streaming.queryset_streaming import is_aggregate
+from utils.model_streaming.field_selectors import compile_selector
+
+
+#
+# Database side construction of the model_to_dict output: the compiled plan
+# of a model is turned into one SQL expression building the JSON text of a row
+# with the JSON functions of the database.
+#
+# Differences with model_to_dict: cycles are detected per model and not per
+# instance (a relation to a model already walked is output as a stub), and
+# Decimal values are output as JSON numbers.
+#
+class JSONDialect(object):
+  """ The JSON functions of a database. The subclasses name the functions
+  building an object and an array, and define aggregate and datetime.
+  """
+  object_function = None
+  array_function = None
+
+  def object(self, pairs):
+    return '%s(%s)' % (self.object_function, ', '.join('%s, %s' % pair for pair in pairs))
+
+  def array(self, items):
+    return '%s(%s)' % (self.array_function, ', '.join(items))
+
+  def nested(self, subquery):
+    """ A JSON value returned by a subquery, to be nested in an object """
+    return subquery
+
+  def boolean(self, expression):
+    return expression
+
+  def text(self, expression):
+    """ The JSON text of a JSON value """
+    return expression
+
+  def random(self):
+    return 'RANDOM()'
+
+
+class SQLiteDialect(JSONDialect):
+  """ SQLite JSON1 extension """
+  object_function = 'json_object'
+  array_function = 'json_array'
+
+  def nested(self, subquery):
+    # The JSON subtype is lost when going through a subquery
+    return 'json(%s)' % subquery
+
+  def aggregate(self, expression):
+    return 'json_group_array(json(%s))' % expression
+
+  def boolean(self, expression):
+    return "CASE WHEN %s IS NULL THEN NULL WHEN %s THEN json('true') ELSE json('false') END" % (expression, expression)
+
+  def datetime(self, expression):
+    # '%' doubled as the query is run with parameters
+    return "strftime('%%Y-%%m-%%dT%%H:%%M:%%S', " + expression + ")"
+
+
+class PostgreSQLDialect(JSONDialect):
+  """ PostgreSQL json functions """
+  object_function = 'json_build_object'
+  array_function = 'json_build_array'
+
+  def aggregate(self, expression):
+    return "COALESCE(json_agg(%s), '[]'::json)" % expression
+
+  def datetime(self, expression):
+    return "to_char(%s, 'YYYY-MM-DD\"T\"HH24:MI:SS')" % expression
+
+  def text(self, expression):
+    return '(%s)::text' % expression
+
+
+dialects = {
+  'sqlite': SQLiteDialect(),
+  'postgresql': PostgreSQLDialect(),
+}
+
+
+def dialect_for(connection):
+  """ Return the JSON dialect of a database connection, raise ValueError if
+  the JSON functions of its database are not known.
+  """
+  try:
+    return dialects[connection.vendor]
+  except KeyError:
+    raise ValueError('no JSON functions known for the %s database (supported: %s)' % (
+      connection.vendor, ', '.join(sorted(dialects))))
+
+
+class JSONBuilder(object):
+  """ Build the SQL expression of the JSON text of a model row.
+  Keyword arguments are the ones of model_to_dict (included_fields,
+  excluded_fields, max_depth, expand, relations, select).
+  """
+  def __init__(self, connection, **kwargs):
+    self.dialect = dialect_for(connection)
+    self.quote = connection.ops.quote_name
+    self.included_fields = kwargs.get('included_fields', None)
+    self.excluded_fields = kwargs.get('excluded_fields', None)
+    self.max_depth = kwargs.get('max_depth', 100)
+    self.expand = kwargs.get('expand', None)
+    self.relations = kwargs.get('relations', None)
+    self.selection = compile_selector(kwargs.get('select', None))
+    self.aliases = 0
+
+  def alias(self):
+    self.aliases += 1
+    return 'ms%i' % self.aliases
+
+  def column(self, alias, column):
+    return '%s.%s' % (alias, self.quote(column))
+
+  def table(self, model, alias):
+    return '%s %s' % (self.quote(model._meta.db_table), alias)
+
+  def stub(self, model, pk, params):
+    params.append(model.__name__)
+    return self.dialect.object([("'id'", pk), ("'_ms_type'", '%s')])
+
+  def ordering(self, model, alias, fields):
+    """ ORDER BY clause for a list of orderings as given to order_by(): field
+    names ('-name' for descending), '?' or F() expressions (asc(), desc()).
+    Raise ValueError for an ordering the database can not run on the
+    related rows (lookups through relations, other expressions).
+    """
+    fields = fields or model._meta.ordering or ['pk']
+    terms = []
+    for ordering in fields:
+      if ordering == '?':
+        terms.append(self.dialect.random())
+        continue
+      descending = False
+      nulls = ''
+      if isinstance(ordering, OrderBy):
+        descending = ordering.descending
+        nulls = ' NULLS FIRST' if ordering.nulls_first else ' NULLS LAST' if ordering.nulls_last else ''
+        ordering = ordering.expression
+      if isinstance(ordering, F):
+        name = ordering.name
+      elif isinstance(ordering, str):
+        descending = ordering.startswith('-')
+        name = ordering[1:] if descending else ordering
+      else:
+        raise ValueError('the ordering %r of %s can not be run by the database' % (ordering, model.__name__))
+      if LOOKUP_SEP in name:
+        raise ValueError('the ordering %r of %s follows a relation' % (name, model.__name__))
+      field = model._meta.pk if name == 'pk' else model._meta.get_field(name)
+      terms.append(self.column(alias, field.column) + (' DESC' if descending else '') + nulls)
+    return ' ORDER BY ' + ', '.join(terms)
+
+  def row(self, model, alias, depth, walked=(), path='', selection=None):
+    """ Return the (sql, params) of the JSON object of the row of model
+    available under alias in the enclosing query, with the fields of
+    selection (see compile_plan).
+    """
+    params = []
+    walked = walked + (model,)
+    pk = model._meta.pk
+    pairs = [("'id'", self.column(alias, pk.column)), ("'_ms_type'", '%s')]
+    params.append(model.__name__)
+    for field_name, getter, serializer, field in compile_plan(model, self.included_fields, self.excluded_fields,
+                                                              selection):
+      if field == pk and field_name == 'id':
+        # already output, JSON objects of the database keep duplicated keys
+        continue
+      if field.is_relation:
+        field_path = path + field_name
+        levels = self.expand.get(field_path, depth) if self.expand else depth
+        related_selection = selection.related(field_name) if selection is not None else None
+        value = self.relation(field, serializer, alias, levels, walked, field_path, params, related_selection)
+      else:
+        value = self.value(field, serializer, self.column(alias, field.column), params)
+      if value is not None:
+        pairs.append(("'%s'" % field_name, value))
+    return self.dialect.object(pairs), params
+
+  def value(self, field, serializer, column, params):
+    """ SQL of a column value, converted as its serializer does """
+    if serializer is Choice_serializer:
+      cases = []
+      for index, (code, label) in enumerate(field.choices):
+        cases.append('WHEN %%s THEN %i' % index)
+        params.append(code)
+      selected = 'CASE %s %s ELSE 0 END' % (column, ' '.join(cases))
+      labels = self.dialect.array(['%s'] * len(field.choices))
+      # the labels may be lazy translations
+      params.extend(str(label) for code, label in field.choices)
+      return self.dialect.object([("'selected'", selected), ("'labels'", labels)])
+    if serializer is BitField_serializer:
+      items = []
+      for index, label in enumerate(field.labels):
+        checked = self.dialect.boolean('(%s & %i) != 0' % (column, 1 << index))
+        items.append(self.dialect.object([("'checked'", checked), ("'label'", '%s')]))
+        params.append(str(label))
+      return self.dialect.array(items)
+    if serializer is DateTimeField_serializer:
+      return self.dialect.datetime(column)
+    if serializer is not default_serializer:
+      raise ValueError('the serializer of %s can not be run by the database' % field.name)
+    if field.get_internal_type() in ('BooleanField', 'NullBooleanField'):
+      return self.dialect.boolean(column)
+    return column
+
+  def relation(self, field, serializer, alias, levels, walked, path, params, selection=None):
+    """ SQL of a relation, None if it is left out """
+    if serializer not in related_serializers:
+      return None
+    related_model = field.related_model
+    if isinstance(field, models.ForeignKey):
+      column = self.column(alias, field.column)
+      if levels <= 0 or related_model in walked:
+        params.append(related_model.__name__)
+        return 'CASE WHEN %s IS NULL THEN NULL ELSE %s END' % (
+          column, self.dialect.object([("'id'", column), ("'_ms_type'", '%s')]))
+      related_alias = self.alias()
+      sql, related_params = self.row(related_model, related_alias, levels - 1, walked, path + '.', selection)
+      params.extend(related_params)
+      return self.dialect.nested('(SELECT %s FROM %s WHERE %s = %s)' % (
+        sql, self.table(related_model, related_alias),
+        self.column(related_alias, field.target_field.column), column))
+    if levels <= 0:
+      # Listing the related objects would need a query, see model_to_dict
+      return None
+    related_alias = self.alias()
+    source, condition = self.join(field, alias, related_alias)
+    options = None
+    if self.relations and not field.one_to_one:
+      options = self.relations.get(path, None)
+    if is_aggregate(options):
+      if options.get('count', False):
+        return '(SELECT COUNT(*) FROM %s WHERE %s)' % (source, condition)
+      return self.dialect.boolean('EXISTS (SELECT 1 FROM %s WHERE %s)' % (source, condition))
+    if related_model in walked:
+      sql = self.stub(related_model, self.column(related_alias, related_model._meta.pk.column), params)
+    else:
+      sql, related_params = self.row(related_model, related_alias, levels - 1, walked, path + '.', selection)
+      params.extend(related_params)
+    if field.one_to_one:
+      # reverse OneToOneField
+      return self.dialect.nested('(SELECT %s FROM %s WHERE %s)' % (sql, source, condition))
+    options = options or {}
+    subquery = 'SELECT %s AS ms_json FROM %s WHERE %s%s' % (
+      sql, source, condition, self.ordering(related_model, related_alias, options.get('ordering', None)))
+    if 'limit' in options:
+      subquery += ' LIMIT %i' % options['limit']
+    return '(SELECT %s FROM (%s) %s)' % (self.dialect.aggregate('ms_json'), subquery, self.alias())
+
+  def join(self, field, alias, related_alias):
+    """ Return the FROM and WHERE clauses selecting the related rows of a
+    multiple valued relation (or reverse OneToOneField) of the row under alias.
+    """
+    related_model = field.related_model
+    if field.one_to_many or field.one_to_one:
+      # reverse ForeignKey or OneToOneField
+      return (self.table(related_model, related_alias),
+              '%s = %s' % (self.column(related_alias, field.field.column),
+                           self.column(alias, field.field.target_field.column)))
+    # ManyToManyField (forward or reverse) through its table
+    m2m = field if field.concrete else field.field
+    through_alias = self.alias()
+    if field.concrete:
+      source_column, target_column = m2m.m2m_column_name(), m2m.m2m_reverse_name()
+    else:
+      source_column, target_column = m2m.m2m_reverse_name(), m2m.m2m_column_name()
+    return ('%s INNER JOIN %s %s ON %s = %s' % (
+              self.table(related_model, related_alias), self.quote(m2m.m2m_db_table()), through_alias,
+              self.column(through_alias, target_column), self.column(related_alias, related_model._meta.pk.column)),
+            '%s = %s' % (self.column(through_alias, source_column), self.column(alias, field.model._meta.pk.column)))
+
+
+def queryset_to_json_rows(queryset, **kwargs):
+  """ Return a queryset of the JSON text of each instance of a queryset, in
+  the shape of model_to_dict, built by the database (SQLite JSON1 or
+  PostgreSQL). The filters, ordering and slicing of the queryset are kept.
+  Takes the same keyword arguments as model_to_dict.
+  """
+  connection = connections[queryset.db]
+  builder = JSONBuilder(connection, **kwargs)
+  sql, params = builder.row(queryset.model, connection.ops.quote_name(queryset.model._meta.db_table), builder.max_depth,
+                            selection=builder.selection)
+  json_sql = RawSQL(builder.dialect.text(sql), params, output_field=models.TextField())
+  return queryset.annotate(_ms_json=json_sql).values_list('_ms_json', flat=True)
+
+
+def stream_queryset_sql_json(queryset, chunk_size=2000, **kwargs):
+  """ Generator yielding the JSON array of the instances of a queryset built by
+  the database, one fragment per chunk. See stream_queryset_json.
+  """
+  separator = '['
+  chunk = []
+  for row in queryset_to_json_rows(queryset, **kwargs).iterator(chunk_size=chunk_size):
+    chunk.append(row)
+    if len(chunk) == chunk_size:
+      yield separator + ','.join(chunk)
+      separator = ','
+      chunk = []
+  if chunk:
+    yield separator + ','.join(chunk)
+    separator = ','
+  yield ']' if separator == ',' else '[]'
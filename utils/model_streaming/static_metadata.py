@@ -0,0 +1,147 @@
+import hashlib
+import logging
+from django.apps import apps
+from django.conf import settings
+from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags
+from django.utils.http import quote_etag
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.static_streaming import model_static_to_dict
+
+logger = logging.getLogger(__name__)
+
+
+#
+# Cache of the static metadata of the models
+#
+# The output of model_static_to_dict (choice and BitField labels, default
+# values, the callable defaults being called once) of each model is encoded
+# to JSON once, when the app is ready (see utils.apps), and kept with the
+# hash of its content. static_metadata_view serves the metadata of one or
+# several models with an ETag: a request holding the current ETag in
+# If-None-Match gets a 304 without anything being encoded.
+#
+# Settings:
+# MODEL_STREAMING_STATIC_MODELS -- labels of the models whose metadata is
+# computed when the app is ready ('app_label.ModelName'), default == all the
+# installed models. The other models are computed on their first request.
+#
+class StaticMetadata(object):
+  """ The static metadata of a model:
+  data -- the output of model_static_to_dict
+  payload -- its JSON text
+  etag -- the hash of the payload
+  """
+  def __init__(self, data):
+    self.data = data
+    self.payload = dumps(data)
+    self.etag = hashlib.sha1(self.payload.encode('utf-8')).hexdigest()
+
+
+# StaticMetadata by model label
+_metadata = {}
+
+
+def model_label(model):
+  return '%s.%s' % (model._meta.app_label, model.__name__)
+
+
+def normalize_label(label):
+  """ Return the label of the model given by label, whose model name may
+  differ in case (apps.get_model ignores it). Raise LookupError if there is
+  no such model.
+  """
+  return model_label(apps.get_model(label))
+
+
+def get_static_metadata(label):
+  """ Return the StaticMetadata of a model given by its label
+  ('app_label.ModelName'), computed on the first call. Raise LookupError if
+  there is no such model.
+  """
+  # Stored under the label of the model only, whatever the label given
+  model = apps.get_model(label)
+  label = model_label(model)
+  try:
+    return _metadata[label]
+  except KeyError:
+    pass
+  metadata = _metadata[label] = StaticMetadata(model_static_to_dict(model))
+  return metadata
+
+
+def load_static_metadata():
+  """ Compute the StaticMetadata of the models of the
+  MODEL_STREAMING_STATIC_MODELS setting, all the installed models by
+  default. The models of the setting must exist; the others whose metadata
+  can not be encoded are left out with a warning.
+  """
+  labels = getattr(settings, 'MODEL_STREAMING_STATIC_MODELS', None)
+  if labels is not None:
+    for label in labels:
+      get_static_metadata(label)
+    return
+  for model in apps.get_models():
+    try:
+      get_static_metadata(model_label(model))
+    except (TypeError, ValueError) as e:
+      logger.warning('no static metadata for %s: %s', model_label(model), e)
+
+
+def clear_static_metadata():
+  """ Forget the computed metadata, e.g. when a test changes a model """
+  _metadata.clear()
+
+
+def combined_etag(labels, metadata):
+  """ The ETag of the combined payload of several models: the hash of their
+  labels and hashes.
+  """
+  content = ','.join('%s:%s' % (label, m.etag) for label, m in zip(labels, metadata))
+  return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def etag_matches(etag, if_none_match):
+  """ Weak comparison of an ETag with the ones of an If-None-Match header """
+  etags = [tag[2:] if tag.startswith('W/') else tag for tag in parse_etags(if_none_match)]
+  return etag in etags or '*' in etags
+
+
+def combined_payload(labels, metadata):
+  """ The JSON object of the metadata of several models by label, built from
+  their encoded payloads.
+  """
+  return '{%s}' % ','.join('%s:%s' % (dumps(label), m.payload) for label, m in zip(labels, metadata))
+
+
+def static_metadata_view(request, label=None):
+  """ View returning the static metadata of a model (label given by the URL
+  pattern) or the combined payload of the models listed in the models
+  parameter, all the computed models if there is none:
+    GET /static/fakeapp.ModelToDictTestModel  { "option": [...], ... }
+    GET /static?models=fakeapp.A,fakeapp.B    { "fakeapp.A": {...}, "fakeapp.B": {...} }
+  The responses have an ETag; a request whose If-None-Match holds it gets a
+  304. Unknown models raise Http404. The labels are normalized, so that the
+  combined payload and its ETag do not depend on their case.
+  """
+  if label is not None:
+    labels = [label]
+  elif request.GET.get('models', ''):
+    labels = request.GET['models'].split(',')
+  else:
+    labels = [model_label(model) for model in apps.get_models() if model_label(model) in _metadata]
+  try:
+    labels = sorted(set(normalize_label(name) for name in labels))
+  except (LookupError, ValueError):
+    raise Http404('unknown model in %s' % ','.join(labels))
+  metadata = [get_static_metadata(name) for name in labels]
+  etag = quote_etag(metadata[0].etag if label is not None else combined_etag(labels, metadata))
+  if etag_matches(etag, request.META.get('HTTP_IF_NONE_MATCH', '')):
+    response = HttpResponseNotModified()
+  else:
+    payload = metadata[0].payload if label is not None else combined_payload(labels, metadata)
+    response = HttpResponse(payload, content_type='application/json')
+  response['ETag'] = etag
+  return response
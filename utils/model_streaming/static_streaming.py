@@ -1,7 +1,7 @@
 from django.db import models
 from bitfield import BitField
-from to_dict import choices_to_dict
-from to_dict import bitfield_to_dict
+from utils.model_streaming.to_dict import choices_to_dict
+from utils.model_streaming.to_dict import bitfield_to_dict
 
 
 #
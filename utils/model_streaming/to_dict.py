@@ -8,6 +8,15 @@ def choices_to_dict(choices, value):
   return {'selected': value_index, 'labels': labels}
 
 
+# Map each code of a choice to its index (the first one for duplicated codes),
+# to look the selected index up without scanning the choices
+def choices_index(choices):
+  indexes = {}
+  for index, (code, label) in enumerate(choices):
+    indexes.setdefault(code, index)
+  return indexes
+
+
 # Convert a bitfield to the canonical JSON representation
 def bitfield_to_dict(labels, value):
   return [{ 'checked': 1 << index & value != 0, 'label': label} for index, label in enumerate(labels)]
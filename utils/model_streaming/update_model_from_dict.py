@@ -1,57 +1,744 @@
 # -*- coding: utf-8 -*-
 import logging
+import datetime
+from collections import OrderedDict
 from django.db import models
-from django.db.models.fields import FieldDoesNotExist
+from django.db import connections
+from django.db import router
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.db.models import signals
+from django.dispatch import Signal
+from django.db.models.signals import class_prepared
+from django.core.signals import setting_changed
+from django.core.exceptions import ValidationError
+from django.conf import settings
+from django.utils import timezone
+from utils.model_streaming.model_streaming import DateTimeField_serializer
+from utils.model_streaming.options import reduce_array_to_bit_field
 
 
-# Remove element not present in the dictionary,
-# create new element and call update_model_from_dict for
-# existing instances
-def update_related_from_list(instance, fieldname, l):
+#
+# Compiled writer plans
+#
+# How each key of a dictionary is applied to an instance (the field it
+# names, what is done with its value and how the value is converted) is the
+# same for every instance of a model. It is resolved once per model and the
+# resulting WriterPlan kept in _writer_plans until the app registry changes.
+# The keys are the names output by model_to_dict (the accessor names for the
+# reverse relations) and the attnames of the ForeignKeys.
+#
+_writer_plans = {}
+
+# Actions of the keys of a writer plan
+PRIMARY_KEY = 0     # the id: identifies the instance, only set on creation
+SET_VALUE = 1       # field which is not a relation: the value is converted and set
+SET_FOREIGN = 2     # ForeignKey (or OneToOneField): the id is set, a dictionary is applied to the related object
+SET_ID = 3          # attname of a ForeignKey: the id is set
+UPDATE_RELATED = 4  # reverse OneToOneField: a dictionary is applied to the related object
+RELATED_LIST = 5    # reverse ForeignKey or many to many: the related list is diffed
+
+
+def clear_writer_plans(**kwargs):
+  """ Drop all the compiled writer plans. Connected to the signals notifying a
+  change of the app registry, can also be called directly.
+  """
+  if kwargs.get('setting', 'INSTALLED_APPS') == 'INSTALLED_APPS':
+    _writer_plans.clear()
+
+class_prepared.connect(clear_writer_plans, dispatch_uid='model_streaming_clear_writer_plans')
+setting_changed.connect(clear_writer_plans, dispatch_uid='model_streaming_clear_writer_plans')
+
+
+def converter(field):
+  """ Return the function converting a value of the model_to_dict output
+  (choice dictionary, BitField list, date as a datetime string, Decimal or
+  datetime as a string) to the value of a field, given the current value of
+  the field when there is one. The values to_python rejects are returned as
+  is, for the database to take or refuse them.
+  """
+  to_python = field.to_python
+
+  def convert(value, current=None):
+    try:
+      return to_python(value)
+    except ValidationError:
+      return value
+
+  if hasattr(field, 'labels'):
+    # BitField
+    def convert_bitfield(value, current=None):
+      return convert(reduce_array_to_bit_field(value) if isinstance(value, list) else value)
+    return convert_bitfield
+  if getattr(field, 'choices', None):
+    codes = [code for code, label in field.choices]
+
+    def convert_choice(value, current=None):
+      if isinstance(value, dict) and 'selected' in value:
+        value = codes[value['selected']]
+      return convert(value)
+    return convert_choice
+  if isinstance(field, models.DateTimeField):
+    # The output has no time zone and no microseconds: the current value is
+    # kept when it gives the same text, so that the stored microseconds are
+    # not lost. A new naive value is read as the output writes it, in UTC
+    # with USE_TZ, else in the TIME_ZONE setting.
+    def convert_datetime(value, current=None):
+      if current is not None and hasattr(value, 'split') and DateTimeField_serializer(current) == value:
+        return current
+      value = convert(value)
+      if isinstance(value, datetime.datetime) and settings.USE_TZ and timezone.is_naive(value):
+        value = timezone.make_aware(value, datetime.timezone.utc)
+      return value
+    return convert_datetime
+  if isinstance(field, models.DateField):
+    def convert_date(value, current=None):
+      if hasattr(value, 'split') and 'T' in value:
+        value = value.split('T')[0]
+      return convert(value)
+    return convert_date
+  return convert
+
+
+# True if the model overrides a method of Model (eg. save filling a field):
+# its instances are then written one at a time, not in bulk
+def overrides(model, name):
+  method = getattr(model, name)
+  base_method = getattr(models.Model, name)
+  return getattr(method, '__func__', method) is not getattr(base_method, '__func__', base_method)
+
+
+class WriterPlan(object):
+  """ The compiled writer plan of a model:
+  actions -- { key: (action, field, converter) }, the keys not in it (eg.
+  added, _ms_type) being ignored
+  concrete_names -- names of the concrete fields, reported for a created
+  instance
+  auto_now_fields -- the fields updated by every save
+  auto_now_names -- their names
+  overrides_save, overrides_delete -- see overrides
+  """
+  def __init__(self, model):
+    self.model = model
+    self.actions = {}
+    for field in model._meta.get_fields():
+      if field.is_relation and (field.many_to_many or field.one_to_many):
+        self.actions[get_accessor_name(field)] = (RELATED_LIST, field, None)
+      elif field.is_relation and field.one_to_one and not field.concrete:
+        self.actions[get_accessor_name(field)] = (UPDATE_RELATED, field, None)
+      elif not field.concrete:
+        # eg. GenericForeignKey
+        continue
+      elif field.primary_key:
+        self.actions[field.name] = (PRIMARY_KEY, field, converter(field))
+      elif field.is_relation:
+        self.actions[field.name] = (SET_FOREIGN, field, converter(field))
+        self.actions[field.attname] = (SET_ID, field, converter(field))
+      else:
+        self.actions[field.name] = (SET_VALUE, field, converter(field))
+    self.concrete_names = set(field.name for field in model._meta.concrete_fields)
+    self.auto_now_fields = [field for field in model._meta.concrete_fields if getattr(field, 'auto_now', False)]
+    self.auto_now_names = set(field.name for field in self.auto_now_fields)
+    self.overrides_save = overrides(model, 'save')
+    self.overrides_delete = overrides(model, 'delete')
+
+
+# The reverse relations are named by their accessor (eg.
+# fakeitemchildren_set) as in the output of model_to_dict
+def get_accessor_name(field):
+  return field.get_accessor_name() if hasattr(field, 'get_accessor_name') else field.name
+
+
+def writer_plan(model):
+  """ Return the compiled WriterPlan of a model """
+  try:
+    return _writer_plans[model]
+  except KeyError:
+    plan = _writer_plans[model] = WriterPlan(model)
+    return plan
+
+
+# Report of update_model_from_dict: { (class name, pk): changed field names },
+# None for the deleted objects. The created objects hold all their fields, the
+# instances whose related lists gained or lost objects hold the name of the
+# related list.
+def report(changes, instance, names):
+  if changes is not None:
+    changes.setdefault((instance.__class__.__name__, instance.pk), set()).update(names)
+
+
+# True if bulk_create sets the primary keys of the created instances
+def can_return_pks(db):
+  features = connections[db].features
+  return getattr(features, 'can_return_rows_from_bulk_insert',
+                 getattr(features, 'can_return_ids_from_bulk_insert', False))
+
+
+# Sent once after each bulk write of bulk_create_instances and
+# bulk_update_instances, so that its receivers (eg. the payload cache) can
+# handle the whole batch at once. Arguments:
+# sender -- the model
+# instances -- the list of the instances written
+# created -- True if they were inserted
+# using -- the database alias
+# update_fields -- the names of the fields written, None for an insert
+# The pre_save and post_save signals are still sent for each instance, as by
+# save, with bulk=True so that the receivers of bulk_saved can skip them.
+bulk_saved = Signal()
+
+
+# Insert instances with one bulk query, the signals being sent as described
+# above
+def bulk_create_instances(model, db, instances):
+  for instance in instances:
+    signals.pre_save.send(sender=model, instance=instance, raw=False, using=db, update_fields=None, bulk=True)
+  model._base_manager.using(db).bulk_create(instances)
+  logging.debug('create %s %s' % (model.__name__, [x.pk for x in instances]))
+  for instance in instances:
+    signals.post_save.send(sender=model, instance=instance, created=True, raw=False, using=db, update_fields=None,
+                           bulk=True)
+  bulk_saved.send(sender=model, instances=instances, created=True, using=db, update_fields=None)
+
+
+# Write the given fields of instances with one bulk query, the auto_now fields
+# being set as save does. The signals are sent as by bulk_create_instances.
+def bulk_update_instances(model, db, instances, names):
+  plan = writer_plan(model)
+  # bulk_update does not run pre_save, the auto_now fields are set here
+  for field in plan.auto_now_fields:
+    for instance in instances:
+      field.pre_save(instance, False)
+  update_fields = frozenset(set(names) | plan.auto_now_names)
+  for instance in instances:
+    signals.pre_save.send(sender=model, instance=instance, raw=False, using=db, update_fields=update_fields,
+                          bulk=True)
+  model._base_manager.using(db).bulk_update(instances, sorted(update_fields))
+  logging.debug('update %s %s' % (model.__name__, [x.pk for x in instances]))
+  for instance in instances:
+    signals.post_save.send(sender=model, instance=instance, created=False, raw=False, using=db,
+                           update_fields=update_fields, bulk=True)
+  bulk_saved.send(sender=model, instances=instances, created=False, using=db, update_fields=update_fields)
+
+
+# Delete instances with one query, one at a time if the model overrides delete
+def delete_instances(model, db, instances):
+  logging.debug('delete %s %s' % (model.__name__, [x.pk for x in instances]))
+  if writer_plan(model).overrides_delete:
+    for instance in instances:
+      instance.delete()
+  else:
+    model._base_manager.using(db).filter(pk__in=[x.pk for x in instances]).delete()
+
+
+# True if an element of a related list holds relations to update with
+# update_model_from_dict (related lists, ForeignKeys given as dictionaries)
+def is_nested(plan, element):
+  actions = plan.actions
+  for key, value in element.items():
+    if isinstance(value, (list, dict)) and key in actions and actions[key][0] in (SET_FOREIGN, UPDATE_RELATED,
+                                                                                   RELATED_LIST):
+      return True
+  return False
+
+
+# Split an element of a related list to create in the values of the fields of
+# the new instance and its related lists. The ForeignKeys given as
+# dictionaries are set from their id.
+def related_values(plan, element, back_reference):
+  actions = plan.actions
+  values = {}
+  related_lists = {}
+  for key, value in element.items():
+    if key not in actions:
+      continue
+    action, field, convert = actions[key]
+    if field is back_reference:
+      continue
+    if action == SET_VALUE or action == PRIMARY_KEY:
+      values[field.attname] = convert(value)
+    elif action == SET_FOREIGN or action == SET_ID:
+      values[field.attname] = convert(value['id'] if isinstance(value, dict) else value)
+    elif action == RELATED_LIST and isinstance(value, list):
+      related_lists[key] = value
+  return values, related_lists
+
+
+# Create a related instance from an element of a list. The related lists of
+# the element are applied once the instance exists.
+def create_related(related_field, element, changes=None):
+  plan = writer_plan(related_field.model)
+  # The ForeignKey back to the instance is set by the related manager
+  values, related_lists = related_values(plan, element, getattr(related_field, 'field', None))
+  new_related_instance = related_field.create(**values)
+  logging.debug('create related_instance %s' % new_related_instance.id)
+  report(changes, new_related_instance, plan.concrete_names)
+  if related_lists:
+    update_model_from_dict(new_related_instance, related_lists, changes)
+  return new_related_instance
+
+
+# Compute the changes applying a related list to the related instances of an
+# instance:
+#   existing -- { pk: related instance } of the instances in the table
+#   l -- the related list
+# Return (to_create, to_update, to_delete): the elements to create (without
+# id, or with an id not among the related instances, see split_moved), the
+# couples (related instance, element) to update and the related instances to
+# delete.
+def diff_related(existing, l):
+  to_create = []
+  to_update = []
+  kept = set()
+  for element in l:
+    related_instance = existing.get(element['id'], None) if 'id' in element else None
+    if related_instance is None:
+      to_create.append(element)
+    else:
+      kept.add(related_instance.pk)
+      to_update.append((related_instance, element))
+  to_delete = [x for pk, x in existing.items() if pk not in kept]
+  return to_create, to_update, to_delete
+
+
+# Split the elements to create of a related list holding an id: the ones whose
+# object exists, related to another instance (eg. moved to this one), are
+# returned as couples (object, element) to move to the instance. Only the
+# elements whose id is in no row (eg. created on the other side in a delta)
+# are created with their id.
+def split_moved(model, db, to_create):
+  ids = set()
+  for element in to_create:
+    if 'id' in element:
+      ids.add(model._meta.pk.to_python(element['id']))
+  if not ids:
+    return to_create, []
+  elsewhere = model._base_manager.using(db).in_bulk(list(ids))
+  created = []
+  moved = []
+  for element in to_create:
+    pk = model._meta.pk.to_python(element['id']) if 'id' in element else None
+    if pk in elsewhere:
+      moved.append((elsewhere[pk], element))
+    else:
+      created.append(element)
+  return created, moved
+
+
+# The element of a moved object without the ForeignKey back to its former
+# instance
+def moved_element(element, back_reference):
+  if back_reference is None:
+    return element
+  return dict((key, value) for key, value in element.items()
+              if key != back_reference.name and key != back_reference.attname)
+
+
+# Move the objects of a related list from another instance to this one: the
+# ForeignKey of a reverse relation is pointed to the instance with one bulk
+# update, the objects of a many to many relation are linked to it. They are
+# then updated from their elements.
+def move_related_list(instance, related_field, couples, changes=None):
+  if not couples:
+    return
+  back_reference = getattr(related_field, 'field', None)
+  related_instances = [related_instance for related_instance, element in couples]
+  if back_reference is None:
+    related_field.add(*related_instances)
+  else:
+    for related_instance in related_instances:
+      setattr(related_instance, back_reference.name, instance)
+      report(changes, related_instance, [back_reference.name])
+    bulk_update_instances(related_field.model, related_field.db, related_instances, [back_reference.name])
+  update_related_list(related_field, [(related_instance, moved_element(element, back_reference))
+                                      for related_instance, element in couples], changes)
+
+
+def delete_related_list(related_field, related_instances, changes=None):
+  if not related_instances:
+    return
+  model = related_field.model
+  if changes is not None:
+    for related_instance in related_instances:
+      changes[(model.__name__, related_instance.pk)] = None
+  delete_instances(model, related_field.db, related_instances)
+
+
+# Create the elements of a related list with one bulk insert. The instances
+# are created one at a time when the model overrides save, or when their
+# primary keys are needed (many to many links, related lists of the
+# elements) and bulk_create can not return them.
+def create_related_list(instance, related_field, elements, changes=None):
+  if not elements:
+    return
+  model = related_field.model
+  db = related_field.db
+  plan = writer_plan(model)
+  back_reference = getattr(related_field, 'field', None)
+  split = [related_values(plan, element, back_reference) for element in elements]
+  if plan.overrides_save or (not can_return_pks(db)
+                             and (back_reference is None or any(lists for values, lists in split))):
+    for element in elements:
+      create_related(related_field, element, changes)
+    return
+  new_related_instances = []
+  for values, related_lists in split:
+    new_related_instance = model(**values)
+    if back_reference is not None:
+      setattr(new_related_instance, back_reference.name, instance)
+    new_related_instances.append(new_related_instance)
+  bulk_create_instances(model, db, new_related_instances)
+  if back_reference is None:
+    related_field.add(*new_related_instances)
+  for new_related_instance, (values, related_lists) in zip(new_related_instances, split):
+    report(changes, new_related_instance, plan.concrete_names)
+    if related_lists:
+      update_model_from_dict(new_related_instance, related_lists, changes)
+
+
+# Update the related instances from their elements. The fields which changed
+# are written with one bulk update; the elements holding relations, and the
+# instances of a model overriding save, go through update_model_from_dict.
+def update_related_list(related_field, couples, changes=None):
+  model = related_field.model
+  plan = writer_plan(model)
+  actions = plan.actions
+  changed_instances = []
+  changed_fields = set()
+  for related_instance, element in couples:
+    if plan.overrides_save or is_nested(plan, element):
+      update_model_from_dict(related_instance, element, changes)
+      continue
+    names = set()
+    for key, value in element.items():
+      if key not in actions:
+        continue
+      action, field, convert = actions[key]
+      if action == SET_VALUE or action == SET_FOREIGN or action == SET_ID:
+        current = getattr(related_instance, field.attname)
+        value = convert(value, current)
+        if current != value:
+          setattr(related_instance, field.attname, value)
+          names.add(field.name)
+    if names:
+      changed_instances.append(related_instance)
+      changed_fields.update(names)
+      report(changes, related_instance, names)
+  if changed_instances:
+    bulk_update_instances(model, related_field.db, changed_instances, changed_fields)
+
+
+# Apply a related list to the related instances of an instance: the related
+# instances are loaded once and compared by pk to the elements (see
+# diff_related), the ones not in the list are deleted, the new elements are
+# created and the others updated, with bulk queries in one transaction.
+# The instances written in bulk are notified with pre_save and post_save, and
+# with one bulk_saved signal per query.
+def update_related_from_list(instance, fieldname, l, changes=None, unit_of_work=None):
+  if unit_of_work is not None:
+    collect_related_from_list(instance, fieldname, l, changes, unit_of_work)
+    return
   related_field = getattr(instance, fieldname)
-  # Remove instance in table not present in l
-  for related_instance in [x for x in related_field.all() if x.id not in [y['id'] for y in l if 'id' in y]]:
-    logging.debug('delete related_instance %s' % related_instance.id)
-    related_instance.delete()
-  # Create instance in table for element of the l without id
-  for element in [x for x in l if 'id' not in x]:
-    # first, pop all tags in the dictionary that are not model fields (eg. added)
-    for unknown_key in [key for key, value in element.iteritems() if key not in related_field.model._meta.get_all_field_names()]:
-      del element[unknown_key]
-    # element must be a dictionary containing all the mandatory fields
-    new_related_instance = related_field.create(**element)
-    logging.debug('create related_instance %s' % new_related_instance.id)
-  # Get all the related instances present in the dict
-  # meaning instances that must be updated
-  related_instances_to_update = [x for x in related_field.all() if x.id in [y['id'] for y in l if 'id' in y]]
-  # Get a list of couples of the related_instance
-  # and the associated dictionary
-  couple_of_updates = [(x, next(y for y in l if 'id' in y and y['id'] == x.id)) for x in related_instances_to_update]
-  # Perform the update on all the couples
-  for related_instance, d in couple_of_updates:
-    update_model_from_dict(related_instance, d)
-
-
-# Take one instance and update its attributes depending on
-# the content of the dictionary
-def update_model_from_dict(instance, d):
+  existing = dict((x.pk, x) for x in related_field.all())
+  to_create, to_update, to_delete = diff_related(existing, l)
+  with transaction.atomic(using=related_field.db):
+    to_create, moved = split_moved(related_field.model, related_field.db, to_create)
+    delete_related_list(related_field, to_delete, changes)
+    move_related_list(instance, related_field, moved, changes)
+    create_related_list(instance, related_field, to_create, changes)
+    update_related_list(related_field, to_update, changes)
+  if to_create or to_delete or moved:
+    report(changes, instance, [fieldname])
+
+
+# Update the related object of a ForeignKey (or OneToOneField) from its
+# dictionary, given the action of its key in the writer plan. If the
+# dictionary refers to another object, the ForeignKey is first pointed to it.
+# Return True in that case.
+def update_foreign_from_dict(instance, entry, key, d, changes=None, unit_of_work=None):
+  action, field, convert = entry
+  repointed = False
+  if action == SET_FOREIGN and 'id' in d:
+    current = getattr(instance, field.attname)
+    value = convert(d['id'], current)
+    if current != value:
+      setattr(instance, field.attname, value)
+      repointed = True
+  # A reference ({ 'id', '_ms_type' }) has nothing to update, the related
+  # object is not loaded
+  if all(name in ('id', '_ms_type') for name in d):
+    return repointed
+  attr = getattr(instance, key, None) if action == UPDATE_RELATED else getattr(instance, key)
+  if attr is not None:
+    update_model_from_dict(attr, d, changes, unit_of_work)
+  return repointed
+
+
+# Take one instance and update its attributes depending on the content of the
+# dictionary. The values are compared to the ones of the instance: the
+# instance is only saved if some changed, and then only its changed fields
+# (and the auto_now ones) are written. The id identifies the instance, it is
+# never changed.
+# Return the report of the objects changed (see report), also added to
+# changes if given.
+# With a unit_of_work, nothing is written: the writes are collected to be
+# flushed at once (see bulk_update_model_from_dict).
+def update_model_from_dict(instance, d, changes=None, unit_of_work=None):
   if not isinstance(d, dict):
     logging.debug(d)
     raise TypeError('d is not a dictionary')
-  for key, value in d.iteritems():
-    if isinstance(value, list): # related field
-      update_related_from_list(instance, key, value)
-    elif isinstance(value, dict): # ForeignKey field
-      attr = getattr(instance, key)
-      update_model_from_dict(attr, value)
-    else: # All other types
-      try:
-        if isinstance(instance._meta.get_field_by_name(key)[0], models.ForeignKey):
-          # we are dealing with a ForeignKey refered to by its id
-          setattr(instance, key + '_id', value)
-        else: # Just a plain scalar key
-          setattr(instance, key, value)
-      except FieldDoesNotExist as e:
-        # We have an uknown field to our model (eg added), just ignore it.
-        pass
-  instance.save()
+  if changes is None:
+    changes = {}
+  plan = writer_plan(instance.__class__)
+  actions = plan.actions
+  changed = set()
+  for key, value in d.items():
+    if key not in actions:
+      # Unknown field to our model (eg added), just ignore it
+      continue
+    entry = actions[key]
+    action, field, convert = entry
+    if action == SET_VALUE or action == SET_ID or (action == SET_FOREIGN and not isinstance(value, dict)):
+      # A plain value, possibly in the model_to_dict representation, or a
+      # ForeignKey refered to by its id
+      current = getattr(instance, field.attname)
+      value = convert(value, current)
+      if current != value:
+        setattr(instance, field.attname, value)
+        changed.add(field.name)
+    elif action == RELATED_LIST:
+      if isinstance(value, list):
+        update_related_from_list(instance, key, value, changes, unit_of_work)
+    elif action != PRIMARY_KEY and isinstance(value, dict):
+      if update_foreign_from_dict(instance, entry, key, value, changes, unit_of_work):
+        changed.add(field.name)
+  if unit_of_work is not None:
+    if instance.pk is None or instance._state.adding:
+      unit_of_work.create(instance)
+    elif changed:
+      unit_of_work.update(instance, changed)
+      report(changes, instance, changed)
+  elif instance.pk is None or instance._state.adding:
+    instance.save()
+    report(changes, instance, plan.concrete_names)
+  elif changed:
+    instance.save(update_fields=sorted(changed | plan.auto_now_names))
+    report(changes, instance, changed)
+  return changes
+
+
+# The writes of update_model_from_dict collected across a nested dictionary,
+# to be flushed per model with bulk queries in one transaction (see flush).
+# The instances created refer to the instances they depend on (eg. the
+# parent of a related list), so that their ForeignKeys are set once these
+# are inserted.
+class UnitOfWork(object):
+  def __init__(self, using=None):
+    self.using = using
+    # { model: [instance] } in the order the models are met
+    self.creates = OrderedDict()
+    # { model: { id(instance): (instance, changed field names) } }
+    self.updates = OrderedDict()
+    # { model: { pk: instance } }
+    self.deletes = OrderedDict()
+    self._created = set()
+    # names reported for the instances created, once their pk is known
+    self._reports = OrderedDict()
+
+  def create(self, instance):
+    if id(instance) not in self._created:
+      self._created.add(id(instance))
+      self.creates.setdefault(instance.__class__, []).append(instance)
+
+  def report(self, instance, names):
+    """ Add names to the report of an instance not yet created """
+    self._reports.setdefault(id(instance), (instance, set()))[1].update(names)
+
+  def update(self, instance, names):
+    instances = self.updates.setdefault(instance.__class__, OrderedDict())
+    instances.setdefault(id(instance), (instance, set()))[1].update(names)
+
+  def delete(self, instance):
+    self.deletes.setdefault(instance.__class__, OrderedDict())[instance.pk] = instance
+
+  def link(self, instance, fieldname, related_instance):
+    """ Create the row of the through table of a many to many relation
+    linking two instances.
+    """
+    descriptor = getattr(instance.__class__, fieldname)
+    field = descriptor.field
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    if descriptor.reverse:
+      source, target = target, source
+    self.create(descriptor.through(**{ source: instance, target: related_instance }))
+
+  def merge(self, other):
+    """ Add the writes collected by another unit of work to this one """
+    for instances in other.creates.values():
+      for instance in instances:
+        self.create(instance)
+    for entries in other.updates.values():
+      for instance, names in entries.values():
+        self.update(instance, names)
+    for instances in other.deletes.values():
+      for instance in instances.values():
+        self.delete(instance)
+    for instance, names in other._reports.values():
+      self.report(instance, names)
+
+  def db(self, model):
+    return self.using or router.db_for_write(model)
+
+  def flush(self, changes=None):
+    """ Write the collected changes in one transaction: the creates, then the
+    updates, the models being ordered after the models their ForeignKeys
+    point to, then the deletes in the reverse order. Each model is written
+    with one bulk query per kind of write, except for the models overriding
+    save or delete (see overrides), or when bulk_create can not return the
+    primary keys, whose instances are written one at a time.
+    The created objects are added to the report changes.
+    """
+    order = dependency_order(list(self.creates) + list(self.updates) + list(self.deletes))
+    with transaction.atomic(using=self.using):
+      for model in order:
+        instances = self.creates.get(model, None)
+        if not instances:
+          continue
+        db = self.db(model)
+        if writer_plan(model).overrides_save or not can_return_pks(db):
+          for instance in instances:
+            instance.save(using=db)
+        else:
+          bulk_create_instances(model, db, instances)
+      for model in order:
+        entries = list(self.updates.get(model, {}).values())
+        if not entries:
+          continue
+        plan = writer_plan(model)
+        if plan.overrides_save:
+          for instance, names in entries:
+            instance.save(update_fields=sorted(names | plan.auto_now_names))
+        else:
+          bulk_update_instances(model, self.db(model), [instance for instance, names in entries],
+                                set().union(*[names for instance, names in entries]))
+      for model in reversed(order):
+        instances = list(self.deletes.get(model, {}).values())
+        if instances:
+          delete_instances(model, self.db(model), instances)
+    for model, instances in self.creates.items():
+      if not model._meta.auto_created:
+        names = writer_plan(model).concrete_names
+        for instance in instances:
+          report(changes, instance, names)
+    for instance, names in self._reports.values():
+      report(changes, instance, names)
+    self.creates.clear()
+    self.updates.clear()
+    self.deletes.clear()
+    self._created.clear()
+    self._reports.clear()
+
+
+# Order models so that a model comes after the models its ForeignKeys point
+# to, the models of a cycle being kept in the order given
+def dependency_order(model_list):
+  order = []
+  visiting = set()
+
+  def visit(model):
+    if model in visiting:
+      return
+    visiting.add(model)
+    for field in model._meta.concrete_fields:
+      if field.is_relation and field.related_model in model_list:
+        visit(field.related_model)
+    order.append(model)
+
+  for model in model_list:
+    visit(model)
+  return order
+
+
+# update_related_from_list with a unit of work: the related instances are
+# diffed as by update_related_from_list, and the writes collected. The related
+# instances of an instance not yet created are all new.
+def collect_related_from_list(instance, fieldname, l, changes, unit_of_work):
+  plan = writer_plan(instance.__class__)
+  field = plan.actions[fieldname][1]
+  model = field.related_model
+  # The ForeignKey back to the instance of a reverse relation, None for a
+  # many to many relation
+  back_reference = field.field if field.one_to_many else None
+  if instance.pk is None or instance._state.adding:
+    existing = {}
+  else:
+    existing = dict((x.pk, x) for x in getattr(instance, fieldname).all())
+  to_create, to_update, to_delete = diff_related(existing, l)
+  to_create, moved = split_moved(model, unit_of_work.db(model), to_create)
+  for related_instance in to_delete:
+    unit_of_work.delete(related_instance)
+    if changes is not None:
+      changes[(model.__name__, related_instance.pk)] = None
+  for related_instance, element in moved:
+    if back_reference is None:
+      unit_of_work.link(instance, fieldname, related_instance)
+    else:
+      setattr(related_instance, back_reference.name, instance)
+      unit_of_work.update(related_instance, [back_reference.name])
+      report(changes, related_instance, [back_reference.name])
+    update_model_from_dict(related_instance, moved_element(element, back_reference), changes, unit_of_work)
+  for element in to_create:
+    values, related_lists = related_values(writer_plan(model), element, back_reference)
+    new_related_instance = model(**values)
+    if back_reference is not None:
+      setattr(new_related_instance, back_reference.name, instance)
+    unit_of_work.create(new_related_instance)
+    if back_reference is None:
+      unit_of_work.link(instance, fieldname, new_related_instance)
+    if related_lists:
+      update_model_from_dict(new_related_instance, related_lists, changes, unit_of_work)
+  for related_instance, element in to_update:
+    update_model_from_dict(related_instance, element, changes, unit_of_work)
+  if to_create or to_delete or moved:
+    if instance._state.adding:
+      unit_of_work.report(instance, [fieldname])
+    else:
+      report(changes, instance, [fieldname])
+
+
+# Prefetch lookups of the relations followed by a dictionary (related lists
+# and ForeignKeys given as dictionaries), at every level
+def dict_lookups(model, d, prefix='', lookups=None):
+  if lookups is None:
+    lookups = []
+  actions = writer_plan(model).actions
+  for key, value in d.items():
+    if not isinstance(value, (list, dict)) or key not in actions:
+      continue
+    action, field, convert = actions[key]
+    if action not in (SET_FOREIGN, UPDATE_RELATED, RELATED_LIST):
+      continue
+    lookup = prefix + key
+    if lookup not in lookups:
+      lookups.append(lookup)
+    for element in value if isinstance(value, list) else [value]:
+      if isinstance(element, dict):
+        dict_lookups(field.related_model, element, lookup + '__', lookups)
+  return lookups
+
+
+def bulk_update_model_from_dict(instance, d, changes=None):
+  """ Unit of work version of update_model_from_dict: the related objects
+  followed by the dictionary are prefetched, one query per relation, and the
+  creates, updates and deletes of the whole dictionary are collected then
+  flushed per model in one transaction (see UnitOfWork.flush). The number of
+  queries grows with the number of relations and models, not of objects.
+  Return the report of the objects changed, as update_model_from_dict.
+  """
+  if instance.pk is not None and not instance._state.adding:
+    lookups = dict_lookups(instance.__class__, d)
+    if lookups:
+      prefetch_related_objects([instance], *lookups)
+  unit_of_work = UnitOfWork()
+  changes = update_model_from_dict(instance, d, changes, unit_of_work)
+  unit_of_work.flush(changes)
+  return changes
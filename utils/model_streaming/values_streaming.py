@@ -0,0 +1,122 @@
+from functools import partial
+from django.db import models
+from utils.model_streaming.to_dict import bitfield_to_dict
+from utils.model_streaming.model_streaming import compile_plan
+from utils.model_streaming.model_streaming import choice_table
+from utils.model_streaming.model_streaming import plan_schema
+from utils.model_streaming.model_streaming import related_stub
+from utils.model_streaming.model_streaming import default_serializer
+from utils.model_streaming.model_streaming import Choice_serializer
+from utils.model_streaming.model_streaming import BitField_serializer
+from utils.model_streaming.model_streaming import DateTimeField_serializer
+from utils.model_streaming.model_streaming import BitMask
+from utils.model_streaming.field_selectors import compile_selector
+
+
+#
+# Fast path for the flat projections: when model_to_dict would only output
+# columns of the model, the rows are read with values_list() and no model
+# instance is built.
+#
+def memoize(convert):
+  """ Cache the converted value for each distinct value of a column """
+  cache = {}
+  def memoized(value):
+    try:
+      return cache[value]
+    except KeyError:
+      converted = cache[value] = convert(value)
+      return converted
+  return memoized
+
+
+def choices_converter(field, compact=False):
+  """ Convert the raw value of a field with choices as Choice_serializer does,
+  with the precomputed code -> index map.
+  """
+  indexes, labels = choice_table(field)
+  if compact:
+    return lambda value: indexes.get(str(value), 0)
+  labels = list(labels)
+  return lambda value: { 'selected': indexes.get(str(value), 0), 'labels': labels }
+
+
+def column_converter(field, serializer, compact=False, native=False):
+  """ Return the function converting a value read by values_list() the way the
+  serializer of the field does, or None if the value is output as is.
+  compact -- if True, convert as for the compact output (see model_to_compact)
+  native -- if True, convert as for the native output (see model_to_dict)
+  """
+  if serializer is default_serializer:
+    return None
+  if serializer is Choice_serializer:
+    return memoize(choices_converter(field, compact))
+  if serializer is DateTimeField_serializer and native:
+    return None
+  if serializer is BitField_serializer:
+    # values_list() returns the integer, not the BitHandler
+    if native:
+      return BitMask
+    if compact:
+      return int
+    return memoize(lambda value: bitfield_to_dict(field.labels, int(value)))
+  return lambda value: serializer(value, field=field)
+
+
+def flat_projection(model, **kwargs):
+  """ Return the list of (field name, column, converter) producing the same
+  dictionary as model_to_dict from a values_list() row, or None when the
+  output needs model instances (expanded relations).
+  Takes the same keyword arguments as model_to_dict, the label tables being
+  stored in the schema for the compact output.
+  """
+  max_depth = kwargs.get('max_depth', 100)
+  expand = kwargs.get('expand', None)
+  schema = kwargs.get('schema', None)
+  plan = compile_plan(model, kwargs.get('included_fields', None), kwargs.get('excluded_fields', None),
+                      compile_selector(kwargs.get('select', None)))
+  projection = []
+  for field_name, getter, serializer, field in plan:
+    if field.is_relation:
+      levels = expand.get(field_name, max_depth) if expand else max_depth
+      if levels > 0:
+        return None
+      # Not expanded: a stub for the ForeignKeys, nothing for the others
+      if isinstance(field, models.ForeignKey):
+        projection.append((field_name, field.attname, partial(related_stub, field)))
+      continue
+    if not field.concrete:
+      return None
+    converter = column_converter(field, serializer, schema is not None, kwargs.get('native', False))
+    projection.append((field_name, field.attname, converter))
+  if schema is not None and model.__name__ not in schema:
+    schema[model.__name__] = plan_schema(plan)
+  return projection
+
+
+def projection_rows(queryset, projection, chunk_size=None):
+  """ Generator yielding the dictionaries of a flat projection.
+  Keyword arguments:
+  queryset -- the queryset to read
+  projection -- the outcome of flat_projection
+  chunk_size -- if set, rows are read with a server side cursor
+  """
+  model_name = queryset.model.__name__
+  rows = projection_values(queryset, projection)
+  if chunk_size is not None:
+    rows = rows.iterator(chunk_size=chunk_size)
+  for row in rows:
+    yield projection_dict(model_name, projection, row)
+
+
+# The values_list() queryset of the columns of a flat projection
+def projection_values(queryset, projection):
+  return queryset.values_list('pk', *[column for field_name, column, converter in projection])
+
+
+# The dictionary of a row of projection_values
+def projection_dict(model_name, projection, row):
+  d = { 'id': row[0], '_ms_type': model_name }
+  for (field_name, column, converter), value in zip(projection, row[1:]):
+    d[field_name] = value if converter is None else converter(value)
+  return d
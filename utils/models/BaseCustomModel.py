@@ -11,7 +11,9 @@ class BaseCustomModel(models.Model):
   def save(self, *args, **kwargs):
     if not self.uuid:
       self.uuid = uuid4().hex
-    super(BaseCustomModel, self).save()
+      if kwargs.get('update_fields', None) is not None:
+        kwargs['update_fields'] = list(kwargs['update_fields']) + ['uuid']
+    super(BaseCustomModel, self).save(*args, **kwargs)
 
   # This model is abstract and shall not generate a table
   class Meta:
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the JSON encoding of the model_streaming output.
+# Run it with the fakeapp installed, e.g. from a Django shell:
+#   from utils.tests.benchmarks.json_encoding import main; main()
+#
+import json
+import datetime
+import decimal
+import timeit
+
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming import json_helpers
+
+from fakeapp.models import ModelToDictTestModel
+
+
+def build_payloads(count):
+  """ Return the model_to_dict output of count ModelToDictTestModel, built in
+  memory so no database is needed.
+  """
+  payloads = []
+  for pk in range(1, count + 1):
+    instance = ModelToDictTestModel(
+      pk=pk, integer=-125313, positive_integer=75615, postitive_small_integer=5, small_integer=-2,
+      null_boolean=None, char=u'This is a charfield é', boolean=True,
+      date=datetime.date(2008, 8, 9), datetime=datetime.datetime(2008, 8, 9, 16, 0, 0),
+      ip_address_field='192.168.1.0', comma_separated_integer_fields='12,58913,-531',
+      floatf=1.253541, url='http://www.nike.com/baskets', slug='this-is-a-slug',
+      email='robert@user.co.uk', decimal=decimal.Decimal('1.23'), option='B', bitfield=9,
+      simple_foreign_key_id=pk, cyclic_foreign_key_id=pk, one_to_one_id=pk)
+    payloads.append(model_to_dict(instance, max_depth=0))
+  return payloads
+
+
+# The DateTimeField serialization replaced by the direct formatting
+def legacy_datetime(value):
+  return json.dumps(value.strftime('%Y-%m-%dT%H:%M:%S')).replace('"', '')
+
+
+def run(count=1000, number=5):
+  """ Return the best time in seconds of each way to encode count payloads:
+  'DecimalEncoder' for the former path, the name of the backend for the others.
+  The 'datetime' entries compare the former and the direct formatting of
+  count datetimes.
+  """
+  payloads = build_payloads(count)
+  results = {}
+  results['DecimalEncoder'] = min(timeit.repeat(
+    lambda: [json.dumps(d, cls=json_helpers.DecimalEncoder) for d in payloads], number=1, repeat=number))
+  for name, dumps in json_helpers.json_backends.items():
+    results[name] = min(timeit.repeat(lambda: [dumps(d) for d in payloads], number=1, repeat=number))
+  value = datetime.datetime(2008, 8, 9, 16, 0, 0)
+  results['datetime (former)'] = min(timeit.repeat(
+    lambda: [legacy_datetime(value) for i in range(count)], number=1, repeat=number))
+  results['datetime (direct)'] = min(timeit.repeat(
+    lambda: [value.strftime('%Y-%m-%dT%H:%M:%S') for i in range(count)], number=1, repeat=number))
+  return results
+
+
+def main(count=1000, number=5):
+  results = run(count, number)
+  for reference, names in [('DecimalEncoder', list(json_helpers.json_backends)),
+                           ('datetime (former)', ['datetime (direct)'])]:
+    for name in [reference] + sorted(names, key=results.get):
+      print('%-20s %8.2f ms  %5.2fx' % (name, results[name] * 1000, results[reference] / results[name]))
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark of the serialization modes of model_streaming at production data
+# sizes. The fakeapp graph is generated in the database configured for the
+# default connection, so run it against a disposable database with the
+# fakeapp installed, e.g. from a Django shell:
+#   from utils.tests.benchmarks.serialization import main; main()
+#   from utils.tests.benchmarks.serialization import main; main(sizes=(1000, 100000, 1000000), path='new.json')
+# or with the benchmark_serialization management command. The results saved
+# as JSON are compared between two commits with compare():
+#   from utils.tests.benchmarks.serialization import compare; compare('old.json', 'new.json')
+#
+import os
+import gc
+import json
+import datetime
+import decimal
+import platform
+import subprocess
+
+import django
+from django.db import connection
+from django.db import transaction
+from django.db.models import Max
+
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.queryset_streaming import queryset_to_dicts
+from utils.model_streaming.queryset_streaming import queryset_to_compact
+from utils.model_streaming.queryset_streaming import stream_queryset_json
+from utils.model_streaming.msgpack_streaming import stream_queryset_msgpack
+from utils.model_streaming.columnar_streaming import queryset_to_columns
+from utils.model_streaming.columnar_streaming import columns_to_json
+from utils.model_streaming.sql_streaming import stream_queryset_sql_json
+from utils.model_streaming.parallel_streaming import stream_queryset_parallel
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+try:
+  from time import perf_counter as timer
+except ImportError:
+  from time import time as timer
+
+from fakeapp.models import SimpleForeignKey
+from fakeapp.models import CyclicForeignKey
+from fakeapp.models import ManyToManyModel
+from fakeapp.models import OneToOneModel
+from fakeapp.models import ModelToDictTestModel
+from fakeapp.models import SimpleRelatedFieldModel
+from fakeapp.models import ComplexRelatedFieldModel
+from fakeapp.models import RelatedToRelatedFieldModel
+
+SIZES = (1000, 100000, 1000000)
+
+
+#
+# Generation of the graph
+#
+# Each ModelToDictTestModel gets its own SimpleForeignKey, CyclicForeignKey
+# and OneToOneModel, m2m_fan_out ManyToManyModel taken from a shared pool,
+# and fan_out SimpleRelatedFieldModel and ComplexRelatedFieldModel (each
+# having one RelatedToRelatedFieldModel). The graph only grows: generating
+# the sizes in increasing order adds the missing rows at each size.
+#
+def next_pk(model):
+  return (model.objects.aggregate(pk=Max('pk'))['pk'] or 0) + 1
+
+
+def build_instance(pk):
+  return ModelToDictTestModel(
+    pk=pk, integer=-125313 + pk, positive_integer=75615, postitive_small_integer=5, small_integer=-2,
+    null_boolean=None, char=u'This is a charfield é', text=u'This is a textfield %i' % pk, boolean=pk % 2 == 0,
+    date=datetime.date(2008, 8, 9), datetime=datetime.datetime(2008, 8, 9, 16, 0, 0),
+    ip_address_field='192.168.1.0', comma_separated_integer_fields='12,58913,-531',
+    floatf=1.253541, url='http://www.nike.com/baskets', slug='this-is-a-slug',
+    email='robert@user.co.uk', decimal=decimal.Decimal('1.23'), option='ABCD'[pk % 4], bitfield=pk % 64,
+    simple_foreign_key_id=pk, cyclic_foreign_key_id=pk, one_to_one_id=pk)
+
+
+def generate(rows, fan_out=3, m2m_fan_out=3, m2m_pool=1000, batch_size=5000, progress=None):
+  """ Grow the fakeapp graph to rows ModelToDictTestModel (see above), with
+  bulk inserts of batch_size instances. The primary keys are given
+  explicitly, so the graph must only be generated by this function.
+  progress -- called with the number of ModelToDictTestModel after each batch
+  """
+  start = next_pk(ModelToDictTestModel)
+  pool_size = max(m2m_pool, m2m_fan_out)
+  pool_start = next_pk(ManyToManyModel)
+  if pool_start <= pool_size:
+    ManyToManyModel.objects.bulk_create([ManyToManyModel(pk=pk, integer=pk)
+                                         for pk in range(pool_start, pool_size + 1)], batch_size)
+  through = ModelToDictTestModel.many_to_many.through
+  complex_pk = next_pk(ComplexRelatedFieldModel)
+  for first in range(start, rows + 1, batch_size):
+    pks = range(first, min(first + batch_size, rows + 1))
+    with transaction.atomic():
+      SimpleForeignKey.objects.bulk_create([SimpleForeignKey(pk=pk, integer=pk) for pk in pks])
+      OneToOneModel.objects.bulk_create([OneToOneModel(pk=pk, integer=pk) for pk in pks])
+      CyclicForeignKey.objects.bulk_create([CyclicForeignKey(pk=pk) for pk in pks])
+      ModelToDictTestModel.objects.bulk_create([build_instance(pk) for pk in pks])
+      through.objects.bulk_create([through(modeltodicttestmodel_id=pk, manytomanymodel_id=(pk + i) % pool_size + 1)
+                                   for pk in pks for i in range(m2m_fan_out)])
+      SimpleRelatedFieldModel.objects.bulk_create([SimpleRelatedFieldModel(integer=i, model_to_dict_id=pk)
+                                                   for pk in pks for i in range(fan_out)])
+      complex_pks = range(complex_pk, complex_pk + len(pks) * fan_out)
+      ComplexRelatedFieldModel.objects.bulk_create([ComplexRelatedFieldModel(pk=complex_pk + i, integer=i % fan_out,
+                                                                             model_to_dict_id=pks[i // fan_out])
+                                                    for i in range(len(complex_pks))])
+      RelatedToRelatedFieldModel.objects.bulk_create([RelatedToRelatedFieldModel(complex_related_field_id=pk)
+                                                      for pk in complex_pks])
+      complex_pk += len(complex_pks)
+    if progress is not None:
+      progress(pks[-1])
+
+
+#
+# Serialization modes
+#
+# Each mode maps a queryset to the iterable of the encoded fragments it
+# outputs, so that the time measured includes the encoding and the bytes
+# are the size of what would be sent.
+#
+def encode(fragment):
+  return fragment if isinstance(fragment, bytes) else fragment.encode('utf-8')
+
+
+def per_instance(queryset):
+  for instance in queryset.iterator():
+    yield dumps(model_to_dict(instance, max_depth=1))
+
+
+MODES = [
+  # name, function, maximum number of rows (None: no limit)
+  ('model_to_dict per instance', per_instance, 10000),
+  ('queryset_to_dicts', lambda queryset: [dumps(queryset_to_dicts(queryset, max_depth=1))], 100000),
+  ('queryset_to_compact', lambda queryset: [dumps(queryset_to_compact(queryset, max_depth=1))], 100000),
+  ('stream_queryset_json', lambda queryset: stream_queryset_json(queryset, max_depth=1), None),
+  ('stream_queryset_json flat', lambda queryset: stream_queryset_json(queryset, max_depth=0), None),
+  ('stream_queryset_json select', lambda queryset: stream_queryset_json(
+    queryset, select='char,integer,simple_foreign_key{char},many_to_many{integer}'), None),
+  ('stream_queryset_msgpack', lambda queryset: stream_queryset_msgpack(queryset, max_depth=1), None),
+  ('stream_queryset_sql_json', lambda queryset: stream_queryset_sql_json(queryset, max_depth=1), None),
+  ('queryset_to_columns', lambda queryset: [columns_to_json(queryset_to_columns(queryset))], None),
+  ('stream_queryset_parallel', lambda queryset: stream_queryset_parallel(queryset, max_depth=1), None),
+]
+
+
+class QueryCounter(object):
+  def __init__(self):
+    self.count = 0
+
+  def __call__(self, execute, sql, params, many, context):
+    self.count += 1
+    return execute(sql, params, many, context)
+
+
+def measure(function, queryset, memory=True):
+  """ Serialize the queryset with a mode, return the figures of the run:
+  { 'time': seconds, 'queries': n, 'bytes': n, 'peak_memory': bytes }
+  The peak memory is measured by a second run with tracemalloc, which would
+  slow down the first one (None without tracemalloc or with memory=False).
+  Only the queries and the memory of the current process are measured (not
+  the ones of the workers of stream_queryset_parallel).
+  """
+  counter = QueryCounter()
+  gc.collect()
+  with connection.execute_wrapper(counter):
+    start = timer()
+    size = sum(len(encode(fragment)) for fragment in function(queryset.all()))
+    elapsed = timer() - start
+  result = { 'time': elapsed, 'queries': counter.count, 'bytes': size, 'peak_memory': None }
+  if memory and tracemalloc is not None:
+    gc.collect()
+    tracemalloc.start()
+    try:
+      for fragment in function(queryset.all()):
+        pass
+      result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+    finally:
+      tracemalloc.stop()
+  return result
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+                                   cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def run(sizes=SIZES, fan_out=3, m2m_fan_out=3, modes=None, memory=True, progress=None):
+  """ Generate the graph at each size and measure each mode on the first
+  ModelToDictTestModel of the graph. Return the results (see main for their format).
+  modes -- names of the modes measured, default == all the modes
+  progress -- called with a message before each step
+  """
+  results = {
+    'commit': git_commit(),
+    'date': datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'django': django.get_version(),
+    'database': connection.vendor,
+    'fan_out': fan_out,
+    'm2m_fan_out': m2m_fan_out,
+    'results': [],
+  }
+  for rows in sorted(sizes):
+    if progress is not None:
+      progress('generating %i rows' % rows)
+    generate(rows, fan_out, m2m_fan_out)
+    for name, function, limit in MODES:
+      if modes is not None and name not in modes:
+        continue
+      if limit is not None and rows > limit:
+        continue
+      if progress is not None:
+        progress('%s on %i rows' % (name, rows))
+      try:
+        result = measure(function, ModelToDictTestModel.objects.filter(pk__lte=rows).order_by('pk'), memory)
+      except ValueError as e:
+        # e.g. no JSON functions for the database of stream_queryset_sql_json
+        result = { 'error': str(e) }
+      result.update({ 'mode': name, 'rows': rows })
+      results['results'].append(result)
+  return results
+
+
+#
+# Reports
+#
+def format_size(size):
+  if size is None:
+    return '-'
+  for unit in ('B', 'kB', 'MB'):
+    if size < 1024:
+      return '%.1f%s' % (size, unit)
+    size /= 1024.0
+  return '%.1fGB' % size
+
+
+def report(results):
+  print('commit %s, %s %s, python %s, django %s' % (results['commit'], results['database'], results['date'],
+                                                     results['python'], results['django']))
+  for result in results['results']:
+    if 'error' in result:
+      print('%-30s %8i  %s' % (result['mode'], result['rows'], result['error']))
+    else:
+      print('%-30s %8i %10.1f ms %8i queries %10s %10s peak' % (
+        result['mode'], result['rows'], result['time'] * 1000, result['queries'],
+        format_size(result['bytes']), format_size(result['peak_memory'])))
+
+
+def compare(old_path, new_path, threshold=0.1):
+  """ Print the changes of the time and the peak memory of each mode and size
+  between two saved results, flagging the changes above threshold (a
+  fraction of the old figure) and the query counts which changed.
+  """
+  with open(old_path) as f:
+    old = json.load(f)
+  with open(new_path) as f:
+    new = json.load(f)
+  print('%s -> %s' % (old['commit'], new['commit']))
+  old_results = dict(((result['mode'], result['rows']), result) for result in old['results'] if 'error' not in result)
+  for result in new['results']:
+    previous = old_results.get((result['mode'], result['rows']), None)
+    if previous is None or 'error' in result:
+      continue
+    changes = []
+    for key in ('time', 'peak_memory'):
+      if result[key] is None or not previous[key]:
+        continue
+      change = float(result[key] - previous[key]) / previous[key]
+      changes.append('%s %+6.1f%%%s' % (key, change * 100, ' !' if abs(change) > threshold else '  '))
+    if result['queries'] != previous['queries']:
+      changes.append('queries %i -> %i !' % (previous['queries'], result['queries']))
+    print('%-30s %8i  %s' % (result['mode'], result['rows'], '  '.join(changes)))
+
+
+def main(sizes=(1000,), path=None, fan_out=3, m2m_fan_out=3, modes=None, memory=True):
+  """ Run the benchmark, print the results and save them as JSON to path:
+  { 'commit': ..., 'date': ..., 'python': ..., 'django': ..., 'database': ...,
+    'fan_out': 3, 'm2m_fan_out': 3,
+    'results': [{ 'mode': ..., 'rows': ..., 'time': seconds, 'queries': n,
+                  'bytes': n, 'peak_memory': bytes }, ...] }
+  """
+  results = run(sizes, fan_out, m2m_fan_out, modes, memory)
+  report(results)
+  if path is not None:
+    with open(path, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  return results
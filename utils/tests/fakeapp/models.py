@@ -4,6 +4,7 @@ import datetime
 from decimal import Decimal
 from django.db import models
 from bitfield import BitField
+from utils.models.BaseCustomModel import BaseCustomModel
 
 
 ###############################################################################
@@ -160,3 +161,9 @@ class RelatedToRelatedFieldModel(models.Model):
   integer = models.IntegerField(default=668)
   # link to the related model of ModelToDict
   complex_related_field = models.ForeignKey(ComplexRelatedFieldModel)
+
+
+# A model having the uuid and the added and modified dates of BaseCustomModel
+class TimestampedModel(BaseCustomModel):
+  # CharField
+  char = models.CharField(max_length=33, default='Some timestamped field')
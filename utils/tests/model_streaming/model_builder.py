@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from django.conf import settings
+from django.db.models import loading
+from django.db.models.loading import load_app
+from django.core.management import call_command
+
+from fakeapp.models import SimpleForeignKey
+from fakeapp.models import ManyToManyModel
+from fakeapp.models import OneToOneModel
+from fakeapp.models import ModelToDictTestModel
+from fakeapp.models import CyclicForeignKey
+from fakeapp.models import SimpleRelatedFieldModel
+from fakeapp.models import ComplexRelatedFieldModel
+from fakeapp.models import RelatedToRelatedFieldModel
+
+
+# Shared by the model_streaming tests: installs the fakeapp models for each
+# test, and builds the complex model object
+class ModelBuilderMixin(object):
+  def setUp(self):
+    super(ModelBuilderMixin, self).setUp()
+    self.maxDiff = None
+    self.old_INSTALLED_APPS = settings.INSTALLED_APPS
+    settings.INSTALLED_APPS += ( 'utils.tests.fakeapp', )
+    loading.cache.loaded = False
+    load_app('utils.tests.fakeapp')
+    call_command('syncdb', verbosity=0, interactive=False) # Create tables for fakeapp
+
+  def tearDown(self):
+    settings.INSTALLED_APPS = self.old_INSTALLED_APPS
+    super(ModelBuilderMixin, self).tearDown()
+
+  # Common function to build the complex model object used to test the streaming
+  def build_model(self):
+    self.simple_foreign_object = SimpleForeignKey(
+      integer=999,
+      char="this is subfield"
+    )
+    self.simple_foreign_object.save()
+    self.cyclic_foreign_object = CyclicForeignKey(
+      char="this is a cyclic relation example",
+      model_to_dict=None
+    )
+    self.cyclic_foreign_object.save()
+    self.many_to_many_object_1 = ManyToManyModel(integer=1)
+    self.many_to_many_object_1.save()
+    self.many_to_many_object_2 = ManyToManyModel(integer=2)
+    self.many_to_many_object_2.save()
+    self.many_to_many_object_3 = ManyToManyModel(integer=3)
+    self.many_to_many_object_3.save()
+    self.one_to_one_object = OneToOneModel(integer=456)
+    self.one_to_one_object.save()
+    self.model = ModelToDictTestModel(
+      integer=-125313,
+      positive_integer=75615,
+      postitive_small_integer=5,
+      small_integer=-2,
+      null_boolean=None,
+      char="This is a charfiéld",
+      text="This is a\n\nmulti-line\ntext\narea\nsome stranges characters follow Â¡¢£¤¥¦§¨©ª«¬­®¯°±²³´µ¶·¸¹º»¼½¾¿ÀÁÂÃÄÅÆÇÈÉÊËÌÍÎÏÐÑÒÓÔÕÖ×ØÙÚÛÜÝÞßàáâãäåæçèéêëìíîïðñòóôõö÷øùúûüýþÿ",
+      boolean=True,
+      # binary="1001"
+      date=datetime.datetime(2008, 8, 9),
+      datetime=datetime.datetime(2008, 8, 9, 16, 00, 00),
+      ip_address_field="192.168.1.0",
+      comma_separated_integer_fields="12,58913,-531",
+      # filef=
+      # filepath
+      floatf=1.253541,
+      # image
+      url="http://www.nike.com/baskets",
+      slug="this-is-a-slug",
+      email="robert@user.co.uk",
+      decimal=1.23,
+      option='B',
+      bitfield=9,
+      simple_foreign_key=self.simple_foreign_object,
+      cyclic_foreign_key=self.cyclic_foreign_object,
+      one_to_one=self.one_to_one_object,
+    )
+    self.model.save()
+    self.model.many_to_many.add(self.many_to_many_object_1)
+    self.model.many_to_many.add(self.many_to_many_object_2)
+    self.model.many_to_many.add(self.many_to_many_object_3)
+    # Establish the cycle
+    self.cyclic_foreign_object.model_to_dict = self.model
+    self.cyclic_foreign_object.save()
+    # Building related models
+    self.simple_related_object = SimpleRelatedFieldModel(
+      integer=421,
+      model_to_dict=self.model,
+    )
+    self.simple_related_object.save()
+    self.simple_related_object2 = SimpleRelatedFieldModel(
+      integer=422,
+      model_to_dict=self.model,
+    )
+    self.simple_related_object2.save()
+    self.complex_related_object = ComplexRelatedFieldModel(
+      integer=442,
+      model_to_dict=self.model,
+    )
+    self.complex_related_object.save()
+    self.related_to_related_object = RelatedToRelatedFieldModel(
+      integer=789,
+      complex_related_field=self.complex_related_object,
+    )
+    self.related_to_related_object.save()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.test import TestCase
+from asgiref.sync import sync_to_async
+
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.queryset_streaming import queryset_to_dicts
+from utils.model_streaming.queryset_streaming import stream_queryset_json
+from utils.model_streaming.async_streaming import amodel_to_dict
+from utils.model_streaming.async_streaming import aqueryset_to_dicts
+from utils.model_streaming.async_streaming import astream_queryset_json
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+
+
+class AsyncStreamingTest(ModelBuilderMixin, TestCase):
+  # The relations are loaded before model_to_dict, which would raise
+  # SynchronousOnlyOperation if it had to query the database
+  async def test_amodel_to_dict(self):
+    await sync_to_async(self.build_model)()
+    relations = { 'simplerelatedfieldmodel_set': { 'count': True } }
+    expected_outcome = await sync_to_async(model_to_dict)(
+      await ModelToDictTestModel.objects.aget(pk=self.model.pk), relations=relations)
+    observed_outcome = await amodel_to_dict(
+      await ModelToDictTestModel.objects.aget(pk=self.model.pk), relations=relations)
+    self.assertEqual(expected_outcome, observed_outcome)
+
+  async def test_aqueryset_to_dicts(self):
+    for i in range(3):
+      await sync_to_async(self.build_model)()
+    queryset = ModelToDictTestModel.objects.order_by('pk')
+    for kwargs in ({}, { 'max_depth': 0 }):
+      expected_outcome = await sync_to_async(queryset_to_dicts)(queryset, **kwargs)
+      observed_outcome = await aqueryset_to_dicts(queryset, chunk_size=2, **kwargs)
+      self.assertEqual(expected_outcome, observed_outcome)
+
+  # A cycle reaching another row is cut where the relations are no longer
+  # loaded (see tree_map), no query is run by model_to_dict
+  async def test_aqueryset_to_dicts_cross_row_cycles(self):
+    def build():
+      models = []
+      for i in range(3):
+        self.build_model()
+        models.append(self.model)
+      for model, next_model in zip(models, models[1:] + models[:1]):
+        model.cyclic_foreign_key.model_to_dict = next_model
+        model.cyclic_foreign_key.save()
+    await sync_to_async(build)()
+    queryset = ModelToDictTestModel.objects.order_by('pk')
+    expected_outcome = await sync_to_async(queryset_to_dicts)(queryset)
+    observed_outcome = await aqueryset_to_dicts(queryset, chunk_size=2)
+    self.assertEqual(expected_outcome, observed_outcome)
+
+  async def test_astream_queryset_json(self):
+    for i in range(3):
+      await sync_to_async(self.build_model)()
+    queryset = ModelToDictTestModel.objects.order_by('pk')
+    expected_outcome = await sync_to_async(lambda: ''.join(stream_queryset_json(queryset, chunk_size=2)))()
+    observed_outcome = ''.join([fragment async for fragment in astream_queryset_json(queryset, chunk_size=2)])
+    self.assertEqual(json.loads(expected_outcome), json.loads(observed_outcome))
+    observed_outcome = [fragment async for fragment in astream_queryset_json(ModelToDictTestModel.objects.none())]
+    self.assertEqual(['[]'], observed_outcome)
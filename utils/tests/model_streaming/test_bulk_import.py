@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import json
+import shutil
+import tempfile
+from decimal import Decimal
+
+from django.test import TestCase
+
+from utils.model_streaming.bulk_import import import_json
+from utils.model_streaming.bulk_import import import_records
+from utils.model_streaming.bulk_import import iterate_json_array
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import FakeItem
+from fakeapp.models import FakeItemParent
+
+
+class BulkImportTest(ModelBuilderMixin, TestCase):
+  def setUp(self):
+    super(BulkImportTest, self).setUp()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    super(BulkImportTest, self).tearDown()
+
+  def test_iterate_json_array(self):
+    records = [{ 'id': 1, 'char': u'caf\xe9 ]["}', 'nested': [{ 'a': [1, 2] }, {}] }, 12345, None, 'a\\"b', 1.5, []]
+    text = json.dumps(records, ensure_ascii=False, indent=2).encode('utf-8')
+    expected_outcome = json.loads(text.decode('utf-8'), parse_float=Decimal)
+    # The blocks end everywhere, including inside the elements and the UTF-8
+    # sequences
+    for buffer_size in (1, 2, 3, 7, 64, 65536):
+      self.assertEquals(expected_outcome, list(iterate_json_array(io.BytesIO(text), buffer_size)))
+    self.assertEquals(expected_outcome, list(iterate_json_array(io.StringIO(text.decode('utf-8')), 5)))
+    self.assertEquals([], list(iterate_json_array(io.BytesIO(b' [ ] \n'))))
+    # The numbers split after their '.' or exponent are read in full
+    for buffer_size in (1, 2, 3, 4):
+      self.assertEquals([1, Decimal('2.5'), Decimal('-3E+2'), 4],
+                        list(iterate_json_array(io.BytesIO(b'[1, 2.5, -3e+2, 4]'), buffer_size)))
+    text = b'[' + b'1,' * 32766 + b'12.5]'
+    self.assertEquals(Decimal('12.5'), list(iterate_json_array(io.BytesIO(text)))[-1])
+    for text in (b'', b'{}', b'[1, 2', b'[1 2]', b'[1, }]', b'[1] 2'):
+      self.assertRaises(ValueError, list, iterate_json_array(io.BytesIO(text), 2))
+
+  def test_import_records(self):
+    parent = FakeItemParent.objects.create(char_field='parent')
+    item = FakeItem.objects.create(char_field='item', integer_field=1, foreign_key=parent, time_field='12:00:00')
+    unchanged = FakeItem.objects.create(char_field='unchanged', integer_field=2, foreign_key=parent,
+                                        time_field='12:00:00')
+    records = [
+      { 'id': item.id, 'char_field': 'item_updated', 'fakeitemchildren_set': [{ 'char_field': 'child' }] },
+      { 'id': unchanged.id, 'char_field': 'unchanged', 'integer_field': 2 },
+      'not a record',
+      { 'char_field': 'new', 'integer_field': 3, 'foreign_key': parent.id, 'time_field': '13:00:00' },
+      { 'id': 1000, 'char_field': 'new_with_id', 'integer_field': 4, 'foreign_key': parent.id,
+        'time_field': '13:00:00' },
+      # unknown ForeignKey
+      { 'id': item.id, 'foreign_key': { 'id': parent.id + 1000, 'char_field': 'unknown' } },
+    ]
+    progress = []
+    result = import_records(FakeItem, records, chunk_size=4, progress=lambda result: progress.append(result.records))
+    self.assertEquals([4, 6], progress)
+    self.assertEquals((6, 2, 1, 1), (result.records, result.created, result.updated, result.unchanged))
+    self.assertEquals([2, 5], [index for index, message in result.errors])
+    item = FakeItem.objects.get(pk=item.pk)
+    self.assertEquals('item_updated', item.char_field)
+    self.assertEquals(['child'], [child.char_field for child in item.fakeitemchildren_set.all()])
+    self.assertEquals(parent, item.foreign_key)
+    self.assertEquals('new_with_id', FakeItem.objects.get(pk=1000).char_field)
+    self.assertEquals(1, FakeItem.objects.filter(char_field='new').count())
+    # Imported again, nothing changes. The child without id is a new one.
+    result = import_records(FakeItem, records[1:2] + records[4:5])
+    self.assertEquals((0, 0, 2), (result.created, result.updated, result.unchanged))
+
+  # Every record of a chunk whose writes fail is reported
+  def test_import_records_failed_chunk(self):
+    parent = FakeItemParent.objects.create(char_field='parent')
+    records = [{ 'char_field': 'item%i' % i, 'integer_field': i, 'foreign_key': parent.id, 'time_field': '12:00:00' }
+               for i in range(5)]
+    # integer_field can not be null
+    del records[1]['integer_field']
+    records[2] = 'not a record'
+    result = import_records(FakeItem, records, chunk_size=3)
+    self.assertEquals((5, 2, 0, 0), (result.records, result.created, result.updated, result.unchanged))
+    self.assertEquals([0, 1, 2], [index for index, message in result.errors])
+    self.assertTrue(result.errors[2][1].startswith('ValueError'))
+    self.assertTrue('not written' in result.errors[0][1])
+    self.assertEquals([3, 4], sorted(FakeItem.objects.values_list('integer_field', flat=True)))
+
+  # A record failing half way leaves the instance of its key as it was for
+  # the next records of the chunk, a record not in the model_to_dict shape is
+  # reported
+  def test_import_records_failed_record(self):
+    parent = FakeItemParent.objects.create(char_field='parent')
+    item = FakeItem.objects.create(char_field='item', integer_field=1, foreign_key=parent, time_field='12:00:00')
+    records = [
+      { 'id': item.id, 'char_field': 'failed', 'foreign_key': { 'id': parent.id + 1000, 'char_field': 'unknown' } },
+      { 'id': item.id, 'char_field': 'item', 'foreign_key': parent.id },
+      { 'id': item.id, 'fakeitemchildren_set': ['not a child'] },
+    ]
+    result = import_records(FakeItem, records)
+    self.assertEquals((0, 0, 1), (result.created, result.updated, result.unchanged))
+    self.assertEquals([0, 2], [index for index, message in result.errors])
+    self.assertTrue(result.errors[0][1].startswith('DoesNotExist'))
+    self.assertEquals('ValueError: fakeitemchildren_set[0] is not a dictionary', result.errors[1][1])
+    item = FakeItem.objects.get(pk=item.pk)
+    self.assertEquals(('item', parent.pk), (item.char_field, item.foreign_key_id))
+
+  def test_import_json(self):
+    parent = FakeItemParent.objects.create(char_field='parent')
+    path = os.path.join(self.directory, 'items.json')
+    with open(path, 'w') as output:
+      json.dump([{ 'char_field': 'item%i' % i, 'integer_field': i, 'foreign_key': parent.id, 'time_field': '12:00:00' }
+                 for i in range(25)], output)
+    result = import_json(FakeItem, path, chunk_size=10, buffer_size=100)
+    self.assertEquals((25, 25, []), (result.records, result.created, result.errors))
+    self.assertEquals(list(range(25)), sorted(FakeItem.objects.values_list('integer_field', flat=True)))
+    self.assertRaises(ValueError, import_records, FakeItem, [], key='foreign_key')
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.test import TestCase
+
+from utils.model_streaming.queryset_streaming import queryset_to_compact
+from utils.model_streaming.columnar_streaming import queryset_to_columns
+from utils.model_streaming.columnar_streaming import columns_to_json
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+
+
+class ColumnarStreamingTest(ModelBuilderMixin, TestCase):
+  # The columns must hold the values of the compact output of each row
+  def test_queryset_to_columns(self):
+    self.build_model()
+    self.build_model()
+    self.build_model()
+    with self.assertNumQueries(1):
+      observed_outcome = queryset_to_columns(ModelToDictTestModel.objects.all(), chunk_size=2)
+    columns = dict((description['name'], description) for description in observed_outcome['columns'])
+    self.assertEquals(['Option 1', 'Option 2', 'Option 3', 'Option 4'], columns['option']['labels'])
+    self.assertEquals(['Type 1', 'Type 2', 'Type 3', 'Type 4', 'Type 5', 'Type 6'], columns['bitfield']['labels'])
+    self.assertEquals('SimpleForeignKey', columns['simple_foreign_key']['model'])
+    expected_outcome = queryset_to_compact(ModelToDictTestModel.objects.all(), max_depth=0)['data']
+    for name in ['id', 'integer', 'char', 'date', 'option', 'bitfield']:
+      self.assertEquals([d[name] for d in expected_outcome], list(observed_outcome['data'][name]))
+    self.assertEquals([d['simple_foreign_key']['id'] for d in expected_outcome],
+                      list(observed_outcome['data']['simple_foreign_key']))
+    # numpy arrays are converted to lists
+    self.assertEquals([1, 1, 1], json.loads(columns_to_json(observed_outcome))['data']['option'])
+
+  def test_queryset_to_columns_empty(self):
+    observed_outcome = queryset_to_columns(ModelToDictTestModel.objects.none())
+    self.assertEquals([], list(observed_outcome['data']['id']))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.delta_streaming import model_to_delta
+from utils.model_streaming.payload_cache import get_payload_cache
+from utils.model_streaming.update_model_from_dict import update_model_from_dict
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+from fakeapp.models import SimpleRelatedFieldModel
+from fakeapp.models import TimestampedModel
+
+
+class DeltaStreamingTest(ModelBuilderMixin, TestCase):
+  def setUp(self):
+    super(DeltaStreamingTest, self).setUp()
+    get_payload_cache().clear()
+
+  def fresh_model(self):
+    return ModelToDictTestModel.objects.get(pk=self.model.pk)
+
+  def change_model(self):
+    model = self.fresh_model()
+    model.integer = 42
+    model.option = 'A'
+    model.save()
+    self.simple_related_object.integer = 4242
+    self.simple_related_object.save()
+    self.simple_related_object2.delete()
+    return SimpleRelatedFieldModel.objects.create(integer=423, model_to_dict=self.model)
+
+  def test_model_to_delta(self):
+    self.build_model()
+    first = model_to_delta(self.fresh_model())
+    self.assertTrue(first['full'])
+    self.assertEqual(model_to_dict(self.fresh_model()), first['delta'])
+    unchanged = model_to_delta(self.fresh_model(), version=first['version'])
+    self.assertEqual(first['version'], unchanged['version'])
+    self.assertEqual({ 'id': self.model.pk, '_ms_type': 'ModelToDictTestModel' }, unchanged['delta'])
+    new_related_object = self.change_model()
+    delta = model_to_delta(self.fresh_model(), version=first['version'])
+    self.assertFalse('full' in delta)
+    self.assertNotEqual(first['version'], delta['version'])
+    self.assertEqual(
+      { 'id': self.model.pk, '_ms_type': 'ModelToDictTestModel',
+        'integer': 42,
+        'option': { 'selected': 0, 'labels': ['Option 1', 'Option 2', 'Option 3', 'Option 4'] },
+        'simplerelatedfieldmodel_set': [
+          { 'id': self.simple_related_object.pk, '_ms_type': 'SimpleRelatedFieldModel', 'integer': 4242 },
+          { 'id': new_related_object.pk, '_ms_type': 'SimpleRelatedFieldModel', 'integer': 423,
+            'model_to_dict': { 'id': self.model.pk, '_ms_type': 'ModelToDictTestModel' } }] },
+      delta['delta'])
+
+  # Without a known version, the objects without modified date are full
+  def test_model_to_delta_since(self):
+    self.build_model()
+    delta = model_to_delta(self.fresh_model(), version='expired', since=datetime.datetime(2008, 8, 9))
+    self.assertFalse('full' in delta)
+    self.assertEqual(model_to_dict(self.fresh_model()), delta['delta'])
+
+  # The modified dates are compared as aware datetimes, to the second
+  @override_settings(USE_TZ=True, TIME_ZONE='Europe/Paris')
+  def test_model_to_delta_since_timezone(self):
+    instance = TimestampedModel.objects.create()
+    reference = { 'id': instance.pk, '_ms_type': 'TimestampedModel' }
+    modified = instance.modified.replace(microsecond=0)
+    for since, changed in ((modified - datetime.timedelta(seconds=1), True),
+                           # modified in the same second
+                           (modified.replace(microsecond=999999), True),
+                           (modified + datetime.timedelta(seconds=1), False),
+                           # naive, in the current time zone
+                           (timezone.make_naive(modified, timezone.get_current_timezone()), True),
+                           (timezone.make_naive(modified + datetime.timedelta(seconds=1),
+                                                timezone.get_current_timezone()), False),
+                           # in another time zone
+                           (timezone.localtime(modified, datetime.timezone(datetime.timedelta(hours=-5))), True)):
+      delta = model_to_delta(TimestampedModel.objects.get(pk=instance.pk), version='expired', since=since)
+      self.assertEqual(changed, delta['delta'] != reference, since)
+
+  # Applying the delta to the previous version gives the current one
+  def test_update_model_from_delta(self):
+    self.build_model()
+    previous = model_to_dict(self.fresh_model())
+    first = model_to_delta(self.fresh_model())
+    self.change_model()
+    delta = model_to_delta(self.fresh_model(), version=first['version'])
+    expected_outcome = model_to_dict(self.fresh_model())
+    # Back to the previous version, with the full output
+    update_model_from_dict(self.fresh_model(), previous)
+    self.assertEqual(previous, model_to_dict(self.fresh_model()))
+    update_model_from_dict(self.fresh_model(), delta['delta'])
+    self.assertEqual(expected_outcome, model_to_dict(self.fresh_model()))
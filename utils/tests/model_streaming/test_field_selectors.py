@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from django.test import TestCase
+
+from utils.model_streaming.field_selectors import Selection
+from utils.model_streaming.field_selectors import parse_selector
+from utils.model_streaming.field_selectors import compile_selector
+from utils.model_streaming.model_streaming import compile_plan
+
+from fakeapp.models import ModelToDictTestModel
+
+
+class FieldSelectorsTest(TestCase):
+  def test_parse_selector(self):
+    selection = parse_selector(' char , simple_foreign_key { char , integer }, many_to_many{}, one_to_one ')
+    self.assertEquals(set(['char', 'simple_foreign_key', 'many_to_many', 'one_to_one']), set(selection.names))
+    self.assertEquals(None, selection.names['char'])
+    self.assertEquals(set(['char', 'integer']), set(selection.related('simple_foreign_key').names))
+    self.assertEquals({}, selection.related('many_to_many').names)
+    self.assertTrue(selection.related('many_to_many') is selection.related('one_to_one'))
+    for selector in ['', 'a,', 'a,,b', 'a{', 'a{b', 'a}', 'a{b}}', 'a b', 'a,a', 'a.b']:
+      with self.assertRaises(ValueError):
+        parse_selector(selector)
+
+  # A selector is compiled once, and its plans too
+  def test_compile_selector(self):
+    selection = compile_selector('char,simple_foreign_key{char}')
+    self.assertTrue(selection is compile_selector('char,simple_foreign_key{char}'))
+    self.assertTrue(selection is compile_selector(selection))
+    self.assertEquals(None, compile_selector(None))
+    plan = compile_plan(ModelToDictTestModel, selection=selection)
+    self.assertEquals(['char', 'simple_foreign_key'], [field_name for field_name, getter, serializer, field in plan])
+    self.assertTrue(plan is compile_plan(ModelToDictTestModel, selection=selection))
+    with self.assertRaises(ValueError):
+      compile_plan(ModelToDictTestModel, selection=Selection({ 'unknown': None }))
+    with self.assertRaises(ValueError):
+      compile_plan(ModelToDictTestModel, selection=Selection({ 'char': Selection({}) }))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import json
+import datetime
+from decimal import Decimal
+
+from django.test import TestCase
+
+from utils.model_streaming import json_helpers
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.json_helpers import set_json_backend
+
+
+class JSONHelpersTest(TestCase):
+  def setUp(self):
+    self.old_json_backend = json_helpers.json_backend
+
+  def tearDown(self):
+    set_json_backend(self.old_json_backend)
+
+  # Every backend must output the same text
+  def test_dumps(self):
+    value = { 'decimal': Decimal('1.10000000000000000001'),
+              'dates': [datetime.datetime(2008, 8, 9, 16, 0, 0), datetime.date(2008, 8, 9), datetime.time(16, 0)],
+              'char': u'é"\n\\',
+              'list': [1, 1.5, True, None] }
+    expected_outcome = (u'{"decimal":1.10000000000000000001,'
+                        u'"dates":["2008-08-09T16:00:00","2008-08-09","16:00:00"],'
+                        u'"char":"é\\"\\n\\\\",'
+                        u'"list":[1,1.5,true,null]}')
+    for name in json_helpers.json_backends:
+      set_json_backend(name)
+      self.assertEquals(expected_outcome, dumps(value))
+    # The Decimal is not rounded
+    self.assertEquals(Decimal('1.10000000000000000001'), json.loads(dumps(value), parse_float=Decimal)['decimal'])
+
+  # A string of the data can not be turned into a number
+  def test_dumps_marker(self):
+    set_json_backend('json')
+    self.assertEquals([u'\x00', u'\x00123'], json.loads(dumps([u'\x00', u'\x00123', Decimal('1')]))[:2])
+    self.assertRaises(ValueError, dumps, Decimal('NaN'))
+    self.assertRaises(ValueError, set_json_backend, 'unknown')
@@ -10,6 +10,11 @@ from django.db.models.loading import load_app
 from django.core.management import call_command
 
 from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.model_streaming import compile_plan
+from utils.model_streaming.model_streaming import clear_plans
+from utils.model_streaming.model_streaming import model_to_graph
+from utils.model_streaming.model_streaming import model_to_compact
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
 
 from fakeapp.models import SimpleForeignKey
 from fakeapp.models import ManyToManyModel
@@ -21,7 +26,7 @@ from fakeapp.models import ComplexRelatedFieldModel
 from fakeapp.models import RelatedToRelatedFieldModel
 
 
-class ModelStreamingTest(TestCase):
+class ModelStreamingTest(ModelBuilderMixin, TestCase):
   def setUp(self):
       self.maxDiff = None
       print ">>", settings.INSTALLED_APPS
@@ -35,83 +40,6 @@ class ModelStreamingTest(TestCase):
       settings.INSTALLED_APPS = self.old_INSTALLED_APPS
       print "<<", settings.INSTALLED_APPS
 
-  # Common function to build the complex model object used to test the streaming
-  def build_model(self):
-    self.simple_foreign_object = SimpleForeignKey(
-      integer=999,
-      char="this is subfield"
-    )
-    self.simple_foreign_object.save()
-    self.cyclic_foreign_object = CyclicForeignKey(
-      char="this is a cyclic relation example",
-      model_to_dict=None
-    )
-    self.cyclic_foreign_object.save()
-    self.many_to_many_object_1 = ManyToManyModel(integer=1)
-    self.many_to_many_object_1.save()
-    self.many_to_many_object_2 = ManyToManyModel(integer=2)
-    self.many_to_many_object_2.save()
-    self.many_to_many_object_3 = ManyToManyModel(integer=3)
-    self.many_to_many_object_3.save()
-    self.one_to_one_object = OneToOneModel(integer=456)
-    self.one_to_one_object.save()
-    self.model = ModelToDictTestModel(
-      integer=-125313,
-      positive_integer=75615,
-      postitive_small_integer=5,
-      small_integer=-2,
-      null_boolean=None,
-      char="This is a charfiéld",
-      text="This is a\n\nmulti-line\ntext\narea\nsome stranges characters follow Â¡¢£¤¥¦§¨©ª«¬­®¯°±²³´µ¶·¸¹º»¼½¾¿ÀÁÂÃÄÅÆÇÈÉÊËÌÍÎÏÐÑÒÓÔÕÖ×ØÙÚÛÜÝÞßàáâãäåæçèéêëìíîïðñòóôõö÷øùúûüýþÿ",
-      boolean=True,
-      # binary="1001"
-      date=datetime.datetime(2008, 8, 9),
-      datetime=datetime.datetime(2008, 8, 9, 16, 00, 00),
-      ip_address_field="192.168.1.0",
-      comma_separated_integer_fields="12,58913,-531",
-      # filef=
-      # filepath
-      floatf=1.253541,
-      # image
-      url="http://www.nike.com/baskets",
-      slug="this-is-a-slug",
-      email="robert@user.co.uk",
-      decimal=1.23,
-      option='B',
-      bitfield=9,
-      simple_foreign_key=self.simple_foreign_object,
-      cyclic_foreign_key=self.cyclic_foreign_object,
-      one_to_one=self.one_to_one_object,
-    )
-    self.model.save()
-    self.model.many_to_many.add(self.many_to_many_object_1)
-    self.model.many_to_many.add(self.many_to_many_object_2)
-    self.model.many_to_many.add(self.many_to_many_object_3)
-    # Establish the cycle
-    self.cyclic_foreign_object.model_to_dict = self.model
-    self.cyclic_foreign_object.save()
-    # Building related models
-    self.simple_related_object = SimpleRelatedFieldModel(
-      integer=421,
-      model_to_dict=self.model,
-    )
-    self.simple_related_object.save()
-    self.simple_related_object2 = SimpleRelatedFieldModel(
-      integer=422,
-      model_to_dict=self.model,
-    )
-    self.simple_related_object2.save()
-    self.complex_related_object = ComplexRelatedFieldModel(
-      integer=442,
-      model_to_dict=self.model,
-    )
-    self.complex_related_object.save()
-    self.related_to_related_object = RelatedToRelatedFieldModel(
-      integer=789,
-      complex_related_field=self.complex_related_object,
-    )
-    self.related_to_related_object.save()
-
   # Test the dump of a dynamically allocated object of a model
   def test_model_to_dict(self):
     self.build_model()
@@ -163,9 +91,13 @@ class ModelStreamingTest(TestCase):
         'integer': 456,
         'modeltodicttestmodel': {'id': 1, '_ms_type': 'ModelToDictTestModel'},
       },
-      'many_to_many': [{'id': 1, 'integer': 1, '_ms_type': 'ManyToManyModel'},
-                       {'id': 2, 'integer': 2, '_ms_type': 'ManyToManyModel'},
-                       {'id': 3, 'integer': 3, '_ms_type': 'ManyToManyModel'}],
+      # the reverse many to many relations are output as the other relations
+      'many_to_many': [{'id': 1, 'integer': 1, '_ms_type': 'ManyToManyModel',
+                        'modeltodicttestmodel_set': [{'id': self.model.pk, '_ms_type': 'ModelToDictTestModel'}]},
+                       {'id': 2, 'integer': 2, '_ms_type': 'ManyToManyModel',
+                        'modeltodicttestmodel_set': [{'id': self.model.pk, '_ms_type': 'ModelToDictTestModel'}]},
+                       {'id': 3, 'integer': 3, '_ms_type': 'ManyToManyModel',
+                        'modeltodicttestmodel_set': [{'id': self.model.pk, '_ms_type': 'ModelToDictTestModel'}]}],
       'simplerelatedfieldmodel_set':
         [{ 'id': self.simple_related_object.pk, '_ms_type': 'SimpleRelatedFieldModel', 'integer': 421, 'model_to_dict': { 'id': self.model.pk, '_ms_type': 'ModelToDictTestModel' } },
          { 'id': self.simple_related_object2.pk, '_ms_type': 'SimpleRelatedFieldModel', 'integer': 422, 'model_to_dict': { 'id': self.model.pk, '_ms_type': 'ModelToDictTestModel' } }],
@@ -186,3 +118,68 @@ class ModelStreamingTest(TestCase):
     }
     observed_outcome = model_to_dict(self.model)
     self.assertEquals(expected_outcome, observed_outcome)
+
+  # Test that plans are compiled once and dropped when the registry changes
+  def test_compile_plan(self):
+    plan = compile_plan(SimpleForeignKey, included_fields=['SimpleForeignKey.char'])
+    self.assertEquals(['char'], [field_name for field_name, getter, serializer, field in plan])
+    self.assertTrue(plan is compile_plan(SimpleForeignKey, included_fields=['SimpleForeignKey.char']))
+    self.assertFalse(plan is compile_plan(SimpleForeignKey))
+    clear_plans()
+    self.assertFalse(plan is compile_plan(SimpleForeignKey, included_fields=['SimpleForeignKey.char']))
+
+  # Test the normalized graph: each object once, references elsewhere
+  def test_model_to_graph(self):
+    self.build_model()
+    observed_outcome = model_to_graph(self.model)
+    self.assertEquals({ '$ref': 'ModelToDictTestModel:%s' % self.model.pk }, observed_outcome['root'])
+    # 1 ModelToDictTestModel, 1 SimpleForeignKey, 1 CyclicForeignKey, 3 ManyToManyModel,
+    # 1 OneToOneModel, 2 SimpleRelatedFieldModel, 1 ComplexRelatedFieldModel,
+    # 1 RelatedToRelatedFieldModel
+    self.assertEquals(11, len(observed_outcome['objects']))
+    model = observed_outcome['objects'][observed_outcome['root']['$ref']]
+    self.assertEquals({ '$ref': 'SimpleForeignKey:%s' % self.simple_foreign_object.pk }, model['simple_foreign_key'])
+    self.assertEquals([{ '$ref': 'ManyToManyModel:%s' % self.many_to_many_object_1.pk },
+                       { '$ref': 'ManyToManyModel:%s' % self.many_to_many_object_2.pk },
+                       { '$ref': 'ManyToManyModel:%s' % self.many_to_many_object_3.pk }], model['many_to_many'])
+    cyclic_foreign_key = observed_outcome['objects'][model['cyclic_foreign_key']['$ref']]
+    self.assertEquals(observed_outcome['root'], cyclic_foreign_key['model_to_dict'])
+
+  # Test that max_depth and the expansion rules bound the output
+  def test_model_to_dict_max_depth(self):
+    self.build_model()
+    model = ModelToDictTestModel.objects.get(pk=self.model.pk)
+    # Beyond the limit, ForeignKeys are stubs built without a query
+    with self.assertNumQueries(0):
+      observed_outcome = model_to_dict(model, max_depth=0)
+    self.assertEquals({ 'id': self.simple_foreign_object.pk, '_ms_type': 'SimpleForeignKey' }, observed_outcome['simple_foreign_key'])
+    self.assertEquals({ 'id': self.one_to_one_object.pk, '_ms_type': 'OneToOneModel' }, observed_outcome['one_to_one'])
+    # and the other relations are left out
+    self.assertFalse('many_to_many' in observed_outcome)
+    self.assertFalse('complexrelatedfieldmodel_set' in observed_outcome)
+    # One level: the relations of the related objects are not expanded
+    observed_outcome = model_to_dict(model, max_depth=1)
+    self.assertEquals([{ 'id': self.complex_related_object.pk,
+                         '_ms_type': 'ComplexRelatedFieldModel',
+                         'integer': 442,
+                         'model_to_dict': { 'id': self.model.pk, '_ms_type': 'ModelToDictTestModel' } }],
+                      observed_outcome['complexrelatedfieldmodel_set'])
+    # The expansion rules override max_depth for a given path
+    observed_outcome = model_to_dict(model, max_depth=1, expand={ 'complexrelatedfieldmodel_set': 2, 'simple_foreign_key': 0 })
+    self.assertEquals({ 'id': self.simple_foreign_object.pk, '_ms_type': 'SimpleForeignKey' }, observed_outcome['simple_foreign_key'])
+    self.assertEquals(self.related_to_related_object.pk,
+                      observed_outcome['complexrelatedfieldmodel_set'][0]['relatedtorelatedfieldmodel_set'][0]['id'])
+
+  # Test that the compact output holds the labels once in the schema
+  def test_model_to_compact(self):
+    self.build_model()
+    observed_outcome = model_to_compact(self.model)
+    self.assertEquals({ 'ModelToDictTestModel': {
+                          'option': ['Option 1', 'Option 2', 'Option 3', 'Option 4'],
+                          'bitfield': ['Type 1', 'Type 2', 'Type 3', 'Type 4', 'Type 5', 'Type 6'] } },
+                      observed_outcome['_schema'])
+    self.assertEquals(1, observed_outcome['data']['option'])
+    self.assertEquals(9, observed_outcome['data']['bitfield'])
+    # The other fields are output as by model_to_dict
+    expected_outcome = model_to_dict(self.model)
+    self.assertEquals(expected_outcome['simple_foreign_key'], observed_outcome['data']['simple_foreign_key'])
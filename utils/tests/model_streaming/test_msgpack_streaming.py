@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+from decimal import Decimal
+
+from django.test import TestCase
+from django.test import RequestFactory
+
+from utils.model_streaming.model_streaming import BitMask
+from utils.model_streaming.msgpack_streaming import packb
+from utils.model_streaming.msgpack_streaming import unpackb
+from utils.model_streaming.msgpack_streaming import unpack_stream
+from utils.model_streaming.msgpack_streaming import model_to_msgpack
+from utils.model_streaming.msgpack_streaming import stream_queryset_msgpack
+from utils.model_streaming.http_streaming import negotiate_format
+from utils.model_streaming.http_streaming import streaming_response
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+
+
+class MsgpackStreamingTest(ModelBuilderMixin, TestCase):
+  # Every value must be decoded as it was encoded, in the shortest format
+  def test_packb(self):
+    values = [None, True, False, 0, 127, 128, 65536, 2 ** 64 - 1, -1, -33, -2 ** 63, 1.5,
+              u'é' * 40, u'x' * 70000, list(range(20)), dict((str(i), i) for i in range(20)),
+              Decimal('1.10000000000000000001'), datetime.datetime(2008, 8, 9, 16, 0, 0),
+              datetime.datetime(2008, 8, 9, 16, 0, 0, 5), datetime.datetime(1960, 1, 1),
+              datetime.date(2008, 8, 9), BitMask(9)]
+    for value in values:
+      self.assertEquals(value, unpackb(packb(value)))
+    self.assertEquals(b'\x00', packb(0))
+    self.assertEquals(b'\xd6\xff\x48\x9d\xbf\x00', packb(datetime.datetime(2008, 8, 9, 16, 0, 0)))
+    self.assertRaises(TypeError, packb, object())
+
+  # The binary output holds the native values
+  def test_model_to_msgpack(self):
+    self.build_model()
+    model = ModelToDictTestModel.objects.get(pk=self.model.pk)
+    observed_outcome = unpackb(model_to_msgpack(model))
+    self.assertEquals(datetime.date(2008, 8, 9), observed_outcome['date'])
+    self.assertEquals(datetime.datetime(2008, 8, 9, 16, 0, 0), observed_outcome['datetime'])
+    self.assertEquals(BitMask(9), observed_outcome['bitfield'])
+    self.assertEquals(Decimal('1.23'), observed_outcome['decimal'])
+    self.assertEquals(3, len(observed_outcome['many_to_many']))
+
+  # The stream is a sequence of maps, with or without model instances
+  def test_stream_queryset_msgpack(self):
+    self.build_model()
+    self.build_model()
+    self.build_model()
+    queryset = ModelToDictTestModel.objects.all()
+    observed_outcome = list(unpack_stream(b''.join(stream_queryset_msgpack(queryset, chunk_size=2))))
+    self.assertEquals([model.pk for model in queryset], [d['id'] for d in observed_outcome])
+    flat_outcome = list(unpack_stream(b''.join(stream_queryset_msgpack(queryset, max_depth=0))))
+    for name in ['date', 'datetime', 'bitfield', 'decimal']:
+      self.assertEquals(observed_outcome[0][name], flat_outcome[0][name])
+
+  # The format is chosen from the Accept header, JSON by default
+  def test_negotiate_format(self):
+    self.assertEquals('application/json', negotiate_format(''))
+    self.assertEquals('application/json', negotiate_format('text/html, */*;q=0.1'))
+    self.assertEquals('application/msgpack', negotiate_format('application/msgpack, application/json;q=0.5'))
+    self.assertEquals('application/x-msgpack', negotiate_format('application/json;q=0.9, application/x-msgpack'))
+    # The most specific media range applies, an explicit q=0 excluding the format
+    self.assertEquals('application/msgpack', negotiate_format('application/json;q=0, */*'))
+    self.assertEquals('application/msgpack', negotiate_format('*/*;q=0.9, application/*;q=0.5, application/json;q=0.1'))
+    self.assertEquals('application/json', negotiate_format('application/*;q=0.5, */*, application/json;q=0.8'))
+    self.build_model()
+    request = RequestFactory().get('/', HTTP_ACCEPT='application/msgpack')
+    response = streaming_response(request, ModelToDictTestModel.objects.all())
+    self.assertEquals('application/msgpack', response['Content-Type'])
+    self.assertEquals(1, len(list(unpack_stream(b''.join(response.streaming_content)))))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from utils.model_streaming.queryset_streaming import stream_queryset_json
+from utils.model_streaming.msgpack_streaming import stream_queryset_msgpack
+from utils.model_streaming.parallel_streaming import pk_ranges
+from utils.model_streaming.parallel_streaming import export_queryset
+from utils.model_streaming.parallel_streaming import stream_queryset_parallel
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+
+
+class Interrupted(Exception):
+  pass
+
+
+# The ranges are encoded in the current process (processes=0), the workers of
+# a pool would not see the rows of the test transaction
+class ParallelStreamingTest(ModelBuilderMixin, TestCase):
+  def setUp(self):
+    super(ParallelStreamingTest, self).setUp()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    super(ParallelStreamingTest, self).tearDown()
+
+  def test_pk_ranges(self):
+    for i in range(5):
+      self.build_model()
+    pks = list(ModelToDictTestModel.objects.order_by('pk').values_list('pk', flat=True))
+    self.assertEqual([(pks[0], pks[1]), (pks[2], pks[3]), (pks[4], None)],
+                     pk_ranges(ModelToDictTestModel.objects.all(), 2))
+    self.assertEqual([(pks[0], pks[1]), (pks[2], None)],
+                     pk_ranges(ModelToDictTestModel.objects.filter(pk__lte=pks[3]), 2))
+    self.assertEqual([], pk_ranges(ModelToDictTestModel.objects.none(), 2))
+    with self.assertRaises(ValueError):
+      pk_ranges(ModelToDictTestModel.objects.all()[:4], 2)
+
+  def test_stream_queryset_parallel(self):
+    for i in range(5):
+      self.build_model()
+    queryset = ModelToDictTestModel.objects.order_by('pk')
+    expected_outcome = ''.join(stream_queryset_json(queryset, max_depth=1))
+    observed_outcome = b''.join(stream_queryset_parallel(queryset, processes=0, range_size=2, max_depth=1))
+    self.assertEqual(json.loads(expected_outcome), json.loads(observed_outcome.decode('utf-8')))
+    expected_outcome = b''.join(stream_queryset_msgpack(queryset, max_depth=1))
+    observed_outcome = b''.join(stream_queryset_parallel(queryset, processes=0, range_size=2, format='msgpack',
+                                                         max_depth=1))
+    self.assertEqual(expected_outcome, observed_outcome)
+    self.assertEqual(b'[]', b''.join(stream_queryset_parallel(ModelToDictTestModel.objects.none(), processes=0)))
+
+  # An interrupted export restarts after the last range written
+  def test_export_queryset(self):
+    for i in range(5):
+      self.build_model()
+    queryset = ModelToDictTestModel.objects.all()
+    path = os.path.join(self.directory, 'export.json')
+
+    def interrupt(done, total, count):
+      if done == 2:
+        raise Interrupted()
+
+    with self.assertRaises(Interrupted):
+      export_queryset(queryset, path, processes=0, range_size=2, progress=interrupt, max_depth=1)
+    calls = []
+    count = export_queryset(queryset, path, processes=0, range_size=2,
+                            progress=lambda *args: calls.append(args), max_depth=1)
+    self.assertEqual(1, count)
+    self.assertEqual([(3, 3, 5)], calls)
+    with open(path, 'rb') as output:
+      observed_outcome = json.loads(output.read().decode('utf-8'))
+    expected_outcome = json.loads(''.join(stream_queryset_json(queryset.order_by('pk'), max_depth=1)))
+    self.assertEqual(expected_outcome, observed_outcome)
+    # Done, nothing to export
+    self.assertEqual(0, export_queryset(queryset, path, processes=0, range_size=2, max_depth=1))
+    with self.assertRaises(ValueError):
+      export_queryset(queryset, path, processes=0, range_size=2, max_depth=2)
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.test import TestCase
+
+from utils.model_streaming.queryset_streaming import stream_queryset_json
+from utils.model_streaming.field_selectors import parse_selector
+from utils.model_streaming.payload_cache import spec_key
+from utils.model_streaming.payload_cache import payload_key
+from utils.model_streaming.payload_cache import payload_version
+from utils.model_streaming.payload_cache import read_versions
+from utils.model_streaming.payload_cache import encode_payload
+from utils.model_streaming.payload_cache import store_payloads
+from utils.model_streaming.payload_cache import related_objects
+from utils.model_streaming.payload_cache import get_payload_cache
+from utils.model_streaming.payload_cache import connect_invalidation
+from utils.model_streaming.payload_cache import cached_model_to_bytes
+from utils.model_streaming.payload_cache import stream_queryset_cached
+from utils.model_streaming.update_model_from_dict import update_model_from_dict
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+from fakeapp.models import ManyToManyModel
+from fakeapp.models import SimpleRelatedFieldModel
+from fakeapp.models import SimpleForeignKey
+
+
+class PayloadCacheTest(ModelBuilderMixin, TestCase):
+  def setUp(self):
+    super(PayloadCacheTest, self).setUp()
+    get_payload_cache().clear()
+    connect_invalidation(ModelToDictTestModel)
+
+  def cached_payload(self):
+    return json.loads(cached_model_to_bytes(ModelToDictTestModel.objects.get(pk=self.model.pk)).decode('utf-8'))
+
+  # A change of any object of the payload must invalidate it
+  def test_cached_model_to_bytes(self):
+    self.build_model()
+    model = ModelToDictTestModel.objects.get(pk=self.model.pk)
+    payload = cached_model_to_bytes(model)
+    # The first encoding records the objects of the payload, the second one
+    # stores it
+    self.assertEquals(payload, cached_model_to_bytes(model))
+    with self.assertNumQueries(0):
+      self.assertEquals(payload, cached_model_to_bytes(model))
+    # nested object saved
+    self.simple_foreign_object.char = 'changed'
+    self.simple_foreign_object.save()
+    self.assertEquals('changed', self.cached_payload()['simple_foreign_key']['char'])
+    # object added to a reverse relation
+    SimpleRelatedFieldModel.objects.create(integer=4242, model_to_dict=self.model)
+    self.assertEquals(3, len(self.cached_payload()['simplerelatedfieldmodel_set']))
+    # many to many relation changed
+    self.model.many_to_many.remove(self.many_to_many_object_1)
+    self.assertEquals(2, len(self.cached_payload()['many_to_many']))
+    # object deleted two levels below
+    self.related_to_related_object.delete()
+    self.assertEquals([], self.cached_payload()['complexrelatedfieldmodel_set'][0]['relatedtorelatedfieldmodel_set'])
+    # an object out of the payload does not invalidate it
+    self.cached_payload()
+    ManyToManyModel.objects.create(integer=4)
+    model = ModelToDictTestModel.objects.get(pk=self.model.pk)
+    with self.assertNumQueries(0):
+      cached_model_to_bytes(model)
+
+  # Only the instances missing from the cache are loaded
+  def test_stream_queryset_cached(self):
+    self.build_model()
+    self.build_model()
+    self.build_model()
+    queryset = ModelToDictTestModel.objects.all()
+    expected_outcome = json.loads(''.join(stream_queryset_json(queryset)))
+    for i in range(2):
+      fragments = list(stream_queryset_cached(queryset, chunk_size=2))
+      self.assertEquals(expected_outcome,
+                        json.loads(b''.join(bytes(fragment) for fragment in fragments).decode('utf-8')))
+    with self.assertNumQueries(1):
+      fragments = list(stream_queryset_cached(queryset, chunk_size=2))
+    self.assertTrue(all(isinstance(fragment, (bytes, memoryview)) for fragment in fragments))
+    self.assertEquals(expected_outcome, json.loads(b''.join(bytes(fragment) for fragment in fragments).decode('utf-8')))
+    self.assertEquals(b'[]', b''.join(stream_queryset_cached(queryset.none())))
+
+  # The objects written in bulk by update_model_from_dict invalidate the
+  # payloads holding them
+  def test_bulk_writes(self):
+    self.build_model()
+    related = self.cached_payload()['simplerelatedfieldmodel_set']
+    update_model_from_dict(ModelToDictTestModel.objects.get(pk=self.model.pk), {
+      'simplerelatedfieldmodel_set': [dict(related[0], integer=4242), dict(related[1], integer=4343), { 'integer': 4444 }]
+    })
+    self.assertEquals([4242, 4343, 4444],
+                      sorted(x['integer'] for x in self.cached_payload()['simplerelatedfieldmodel_set']))
+
+  # A payload holding an object changed while it is encoded is not served,
+  # the versions being read before the objects are loaded
+  def test_change_while_encoding(self):
+    self.build_model()
+    cache = get_payload_cache()
+    self.cached_payload()
+    spec = spec_key('json', {})
+    records, versions = read_versions(ModelToDictTestModel, [self.model.pk], spec, cache)
+    payload, ids = encode_payload(ModelToDictTestModel.objects.get(pk=self.model.pk), 'json', {})
+    self.simple_foreign_object.char = 'changed'
+    self.simple_foreign_object.save()
+    key = payload_key(ModelToDictTestModel, self.model.pk, spec, payload_version(None))
+    store_payloads(ModelToDictTestModel, spec, [(self.model.pk, key, payload, ids)], records, versions, cache)
+    self.assertTrue(key in cache)
+    self.assertEquals('changed', self.cached_payload()['simple_foreign_key']['char'])
+    # The objects are keyed by model label
+    self.assertTrue(('fakeapp.SimpleForeignKey', self.simple_foreign_object.pk) in related_objects(self.model))
+
+  # The payloads of a model not connected could not be invalidated
+  def test_not_connected(self):
+    self.assertRaises(ValueError, cached_model_to_bytes, SimpleForeignKey.objects.create(char='char'))
+    self.assertRaises(ValueError, list, stream_queryset_cached(SimpleForeignKey.objects.all()))
+
+  # The compiled selectors are keyed by their canonical form
+  def test_spec_key(self):
+    key = spec_key('json', { 'select': 'char,many_to_many{integer}' })
+    self.assertEquals(key, spec_key('json', { 'select': parse_selector(' many_to_many { integer }, char') }))
+    self.assertNotEquals(key, spec_key('json', { 'select': 'char,many_to_many' }))
+    self.assertNotEquals(key, spec_key('msgpack', { 'select': 'char,many_to_many{integer}' }))
+    self.assertRaises(ValueError, spec_key, 'xml', {})
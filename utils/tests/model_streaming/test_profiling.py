@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+
+from django.test import TestCase
+from django.test import RequestFactory
+from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.queryset_streaming import queryset_to_dicts
+from utils.model_streaming.queryset_streaming import stream_queryset_json
+from utils.model_streaming.profiling import active_profile
+from utils.model_streaming.profiling import SerializationProfile
+from utils.model_streaming.profiling import ProfilingMiddleware
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+
+
+class ProfilingTest(ModelBuilderMixin, TestCase):
+  # The lazy loading of the relations is accounted to their path
+  def test_serialization_profile(self):
+    self.build_model()
+    expected_outcome = model_to_dict(ModelToDictTestModel.objects.get(pk=self.model.pk), max_depth=1)
+    model = ModelToDictTestModel.objects.get(pk=self.model.pk)
+    with SerializationProfile(memory=True) as profile:
+      self.assertTrue(profile is active_profile())
+      observed_outcome = model_to_dict(model, max_depth=1)
+    self.assertEquals(None, active_profile())
+    self.assertEquals(expected_outcome, observed_outcome)
+    self.assertEquals(1, profile.queries['simple_foreign_key'])
+    self.assertEquals(1, profile.queries['many_to_many'])
+    self.assertFalse('' in profile.queries)
+    self.assertEquals(1, profile.objects['ModelToDictTestModel'])
+    self.assertEquals(3, profile.objects['ManyToManyModel'])
+    self.assertEquals(1, profile.serializers['ManyToManyField_serializer'][0])
+    summary = profile.summary()
+    self.assertTrue(summary['serializers']['to_dict']['time'] >= summary['serializers']['to_dict']['own_time'])
+    self.assertTrue(summary['peak_memory'] > 0)
+
+  # The batch entry points load the relations outside of model_to_dict
+  def test_serialization_profile_batch(self):
+    self.build_model()
+    self.build_model()
+    with SerializationProfile() as profile:
+      queryset_to_dicts(ModelToDictTestModel.objects.all(), max_depth=1)
+    self.assertEquals([''], list(profile.queries))
+    self.assertEquals(2, profile.objects['ModelToDictTestModel'])
+    self.assertEquals(None, profile.peak_memory)
+
+  def test_profiling_middleware(self):
+    self.build_model()
+    with SerializationProfile() as profile:
+      queryset_to_dicts(ModelToDictTestModel.objects.all(), max_depth=1)
+    objects = 'objects=%i ' % sum(profile.objects.values())
+
+    def view(request):
+      return HttpResponse(dumps(queryset_to_dicts(ModelToDictTestModel.objects.all(), max_depth=1)))
+
+    response = ProfilingMiddleware(view)(RequestFactory().get('/models'))
+    self.assertEquals(None, active_profile())
+    self.assertTrue(objects in response['X-Model-Streaming-Profile'])
+
+    def streaming_view(request):
+      return StreamingHttpResponse(stream_queryset_json(ModelToDictTestModel.objects.all(), max_depth=1))
+
+    response = ProfilingMiddleware(streaming_view)(RequestFactory().get('/models'))
+    self.assertFalse(response.has_header('X-Model-Streaming-Profile'))
+    with self.assertLogs('utils.model_streaming.profiling') as logs:
+      b''.join(response.streaming_content)
+    self.assertTrue(objects in logs.output[0])
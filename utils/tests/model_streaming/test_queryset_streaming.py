@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.test import TestCase
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from utils.model_streaming.model_streaming import model_to_dict
+from utils.model_streaming.json_helpers import DecimalEncoder
+from utils.model_streaming.queryset_streaming import queryset_to_dicts
+from utils.model_streaming.queryset_streaming import stream_queryset_json
+from utils.model_streaming.queryset_streaming import queryset_to_graph
+from utils.model_streaming.queryset_streaming import queryset_to_compact
+from utils.model_streaming.values_streaming import flat_projection
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+from fakeapp.models import ManyToManyModel
+from fakeapp.models import SimpleRelatedFieldModel
+
+
+# The dictionaries of an object, other than references, in a model_to_dict
+# output
+def find_objects(d, ms_type, pk):
+  found = []
+  if isinstance(d, list):
+    for element in d:
+      found.extend(find_objects(element, ms_type, pk))
+  elif isinstance(d, dict):
+    if d.get('_ms_type', None) == ms_type and d.get('id', None) == pk and len(d) > 2:
+      found.append(d)
+    for value in d.values():
+      found.extend(find_objects(value, ms_type, pk))
+  return found
+
+
+class QuerysetStreamingTest(ModelBuilderMixin, TestCase):
+  # The batch output must be the same as the instance by instance output
+  def test_queryset_to_dicts(self):
+    self.build_model()
+    self.build_model()
+    expected_outcome = [model_to_dict(instance) for instance in ModelToDictTestModel.objects.all()]
+    observed_outcome = queryset_to_dicts(ModelToDictTestModel.objects.all())
+    self.assertEquals(expected_outcome, observed_outcome)
+
+  # Starting from the other side of the relations, the relations of the rows
+  # cut from the walk are output as references
+  def test_queryset_to_dicts_many_to_many(self):
+    self.build_model()
+    self.build_model()
+    expected_outcome = [model_to_dict(instance) for instance in ManyToManyModel.objects.all()]
+    observed_outcome = queryset_to_dicts(ManyToManyModel.objects.all())
+    self.assertEquals(expected_outcome, observed_outcome)
+
+  # The number of queries must not depend on the number of rows
+  def test_queryset_to_dicts_queries(self):
+    self.build_model()
+    with self.assertNumQueries(14):
+      queryset_to_dicts(ModelToDictTestModel.objects.all())
+    self.build_model()
+    self.build_model()
+    with self.assertNumQueries(14):
+      queryset_to_dicts(ModelToDictTestModel.objects.all())
+
+  # A cycle reaching another row of a model already walked is cut where the
+  # relations are no longer loaded
+  def test_queryset_to_dicts_cross_row_cycles(self):
+    def build(count):
+      ModelToDictTestModel.objects.all().delete()
+      models = []
+      for i in range(count):
+        self.build_model()
+        models.append(self.model)
+      # Each row points to the next one through its CyclicForeignKey
+      for model, next_model in zip(models, models[1:] + models[:1]):
+        model.cyclic_foreign_key.model_to_dict = next_model
+        model.cyclic_foreign_key.save()
+      return models
+
+    models = build(2)
+    with CaptureQueriesContext(connection) as queries:
+      observed_outcome = queryset_to_dicts(ModelToDictTestModel.objects.order_by('pk'))
+    count = len(queries)
+    # The other row is output once in the first one, with its columns, the
+    # stubs of its ForeignKeys and the references of its other relations
+    next_model, = find_objects(observed_outcome[0], 'ModelToDictTestModel', models[1].pk)
+    self.assertEquals({ 'id': models[1].simple_foreign_key_id, '_ms_type': 'SimpleForeignKey' },
+                      next_model['simple_foreign_key'])
+    self.assertEquals([{ 'id': related.pk, '_ms_type': 'SimpleRelatedFieldModel' }
+                       for related in models[1].simplerelatedfieldmodel_set.all()],
+                      next_model['simplerelatedfieldmodel_set'])
+    build(6)
+    with self.assertNumQueries(count):
+      queryset_to_dicts(ModelToDictTestModel.objects.all())
+
+  # Relations beyond max_depth are not loaded at all
+  def test_queryset_to_dicts_max_depth(self):
+    self.build_model()
+    self.build_model()
+    with self.assertNumQueries(1):
+      queryset_to_dicts(ModelToDictTestModel.objects.all(), max_depth=0)
+    expected_outcome = [model_to_dict(instance, max_depth=1) for instance in ModelToDictTestModel.objects.all()]
+    with self.assertNumQueries(5):
+      observed_outcome = queryset_to_dicts(ModelToDictTestModel.objects.all(), max_depth=1)
+    self.assertEquals(expected_outcome, observed_outcome)
+
+  # Limited, ordered, counted and tested relations, in one query per relation
+  def test_queryset_to_dicts_relations(self):
+    relations = {
+      'simplerelatedfieldmodel_set': { 'limit': 2, 'ordering': ['-integer'] },
+      'many_to_many': { 'count': True },
+      'complexrelatedfieldmodel_set': { 'exists': True },
+      'simple_foreign_key.modeltodicttestmodel_set': { 'count': True },
+    }
+    for i in range(3):
+      self.build_model()
+      SimpleRelatedFieldModel(integer=423, model_to_dict=self.model).save()
+    expected_outcome = [model_to_dict(instance, relations=relations) for instance in ModelToDictTestModel.objects.all()]
+    with self.assertNumQueries(10):
+      observed_outcome = queryset_to_dicts(ModelToDictTestModel.objects.all(), relations=relations)
+    self.assertEquals(expected_outcome, observed_outcome)
+    self.assertEquals([423, 422], [related['integer'] for related in observed_outcome[0]['simplerelatedfieldmodel_set']])
+    self.assertEquals(3, observed_outcome[0]['many_to_many'])
+    self.assertEquals(True, observed_outcome[0]['complexrelatedfieldmodel_set'])
+    self.assertEquals(1, observed_outcome[0]['simple_foreign_key']['modeltodicttestmodel_set'])
+
+  # Projections of columns only are read with values_list()
+  def test_queryset_to_dicts_flat(self):
+    self.build_model()
+    self.build_model()
+    included_fields = ['ModelToDictTestModel.%s' % name for name in ('integer', 'char', 'date', 'decimal', 'option', 'bitfield')]
+    self.assertTrue(flat_projection(ModelToDictTestModel, included_fields=included_fields) is not None)
+    self.assertTrue(flat_projection(ModelToDictTestModel) is None)
+    expected_outcome = [model_to_dict(instance, included_fields=included_fields) for instance in ModelToDictTestModel.objects.all()]
+    with self.assertNumQueries(1):
+      observed_outcome = queryset_to_dicts(ModelToDictTestModel.objects.all(), included_fields=included_fields)
+    self.assertEquals(expected_outcome, observed_outcome)
+    with self.assertNumQueries(1):
+      fragments = list(stream_queryset_json(ModelToDictTestModel.objects.all(), included_fields=included_fields))
+    self.assertEquals(json.loads(json.dumps(expected_outcome, cls=DecimalEncoder)), json.loads(''.join(fragments)))
+
+  # The objects shared by several rows are only output once
+  def test_queryset_to_graph(self):
+    self.build_model()
+    first_model = self.model
+    self.build_model()
+    # Both rows point to the same SimpleForeignKey
+    self.model.simple_foreign_key = first_model.simple_foreign_key
+    self.model.save()
+    observed_outcome = queryset_to_graph(ModelToDictTestModel.objects.all())
+    self.assertEquals([{ '$ref': 'ModelToDictTestModel:%s' % first_model.pk },
+                       { '$ref': 'ModelToDictTestModel:%s' % self.model.pk }], observed_outcome['data'])
+    simple_foreign_key = observed_outcome['objects']['SimpleForeignKey:%s' % first_model.simple_foreign_key.pk]
+    self.assertEquals(observed_outcome['data'], simple_foreign_key['modeltodicttestmodel_set'])
+
+  # The compact output holds the labels once for all the rows, with or without
+  # model instances
+  def test_queryset_to_compact(self):
+    self.build_model()
+    self.build_model()
+    labels = { 'option': ['Option 1', 'Option 2', 'Option 3', 'Option 4'],
+               'bitfield': ['Type 1', 'Type 2', 'Type 3', 'Type 4', 'Type 5', 'Type 6'] }
+    for kwargs in [{}, { 'max_depth': 0 }]:
+      observed_outcome = queryset_to_compact(ModelToDictTestModel.objects.all(), **kwargs)
+      self.assertEquals({ 'ModelToDictTestModel': labels }, observed_outcome['_schema'])
+      self.assertEquals([1, 1], [d['option'] for d in observed_outcome['data']])
+      self.assertEquals([9, 9], [d['bitfield'] for d in observed_outcome['data']])
+    fragments = stream_queryset_json(ModelToDictTestModel.objects.all(), chunk_size=1, compact=True)
+    observed_outcome = json.loads(''.join(fragments))
+    self.assertEquals({ 'ModelToDictTestModel': labels }, observed_outcome['_schema'])
+    self.assertEquals(2, len(observed_outcome['data']))
+
+  # The selector drives the columns loaded by every query
+  def test_queryset_to_dicts_select(self):
+    self.build_model()
+    self.build_model()
+    selector = 'char,simple_foreign_key{char},many_to_many{integer},simplerelatedfieldmodel_set{integer}'
+    queryset = ModelToDictTestModel.objects.order_by('pk')
+    expected_outcome = [model_to_dict(instance, select=selector) for instance in queryset]
+    self.assertEquals(set(['id', '_ms_type', 'char', 'simple_foreign_key', 'many_to_many', 'simplerelatedfieldmodel_set']),
+                      set(expected_outcome[0]))
+    self.assertEquals({ 'id': self.simple_foreign_object.pk, '_ms_type': 'SimpleForeignKey', 'char': 'this is subfield' },
+                      expected_outcome[1]['simple_foreign_key'])
+    with CaptureQueriesContext(connection) as context:
+      observed_outcome = queryset_to_dicts(queryset, select=selector)
+    self.assertEquals(expected_outcome, observed_outcome)
+    self.assertEquals(3, len(context.captured_queries))
+    for query in context.captured_queries:
+      self.assertFalse('"text"' in query['sql'])
+      self.assertFalse('"email"' in query['sql'])
+    observed_outcome = json.loads(''.join(stream_queryset_json(queryset, chunk_size=1, select=selector)))
+    self.assertEquals(json.loads(json.dumps(expected_outcome)), observed_outcome)
+
+  # The streamed fragments must make up the JSON of the whole queryset
+  def test_stream_queryset_json(self):
+    self.assertEquals(['[]'], list(stream_queryset_json(ModelToDictTestModel.objects.all())))
+    self.build_model()
+    self.build_model()
+    self.build_model()
+    queryset = ModelToDictTestModel.objects.all()
+    fragments = list(stream_queryset_json(queryset, chunk_size=2))
+    # Two chunks plus the closing bracket
+    self.assertEquals(3, len(fragments))
+    expected_outcome = json.loads(json.dumps(queryset_to_dicts(queryset), cls=DecimalEncoder))
+    self.assertEquals(expected_outcome, json.loads(''.join(fragments)))
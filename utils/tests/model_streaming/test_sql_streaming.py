@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.test import TestCase
+from django.db import connection
+from django.db.models import F
+from django.db.models.functions import Lower
+
+from utils.model_streaming.json_helpers import DecimalEncoder
+from utils.model_streaming.queryset_streaming import queryset_to_dicts
+from utils.model_streaming.sql_streaming import queryset_to_json_rows
+from utils.model_streaming.sql_streaming import stream_queryset_sql_json
+from utils.model_streaming.sql_streaming import dialect_for
+from utils.model_streaming.sql_streaming import JSONDialect
+from utils.model_streaming.sql_streaming import JSONBuilder
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+from fakeapp.models import SimpleRelatedFieldModel
+
+
+class SQLStreamingTest(ModelBuilderMixin, TestCase):
+  # Compare the JSON built by the database with the one built in Python
+  def assertSameOutput(self, **kwargs):
+    queryset = ModelToDictTestModel.objects.all()
+    expected_outcome = json.loads(json.dumps(queryset_to_dicts(queryset, **kwargs), cls=DecimalEncoder))
+    with self.assertNumQueries(1):
+      observed_outcome = json.loads(''.join(stream_queryset_sql_json(queryset, chunk_size=2, **kwargs)))
+    for expected, observed in zip(expected_outcome, observed_outcome):
+      # model_to_dict only outputs a stub for cyclic_foreign_key as the
+      # instance was already output in cyclicforeignkey_set. The database
+      # detects the cycles per model and expands it.
+      expected.pop('cyclic_foreign_key', None)
+      observed.pop('cyclic_foreign_key', None)
+    self.assertEquals(expected_outcome, observed_outcome)
+
+  def test_stream_queryset_sql_json(self):
+    self.build_model()
+    self.build_model()
+    self.build_model()
+    self.assertSameOutput()
+    self.assertSameOutput(max_depth=1)
+    self.assertSameOutput(max_depth=0)
+    self.assertSameOutput(included_fields=['ModelToDictTestModel.integer', 'ModelToDictTestModel.option', 'ModelToDictTestModel.bitfield'])
+    self.assertSameOutput(relations={
+      'simplerelatedfieldmodel_set': { 'limit': 1, 'ordering': ['-integer'] },
+      'many_to_many': { 'count': True },
+      'complexrelatedfieldmodel_set': { 'exists': True },
+    })
+    self.assertSameOutput(relations={
+      'simplerelatedfieldmodel_set': { 'ordering': [F('integer').desc()] },
+      'many_to_many': { 'ordering': ['integer', '-pk'] },
+    })
+
+  def test_queryset_to_json_rows(self):
+    self.assertEquals('[]', ''.join(stream_queryset_sql_json(ModelToDictTestModel.objects.all())))
+    self.build_model()
+    rows = list(queryset_to_json_rows(ModelToDictTestModel.objects.filter(pk=self.model.pk), max_depth=0))
+    self.assertEquals(1, len(rows))
+    self.assertEquals({ 'id': self.simple_foreign_object.pk, '_ms_type': 'SimpleForeignKey' },
+                      json.loads(rows[0])['simple_foreign_key'])
+
+  # The orderings are read as order_by() reads them
+  def test_ordering(self):
+    builder = JSONBuilder(connection)
+    self.assertEquals(' ORDER BY ms."integer" DESC, ms."id"',
+                      builder.ordering(SimpleRelatedFieldModel, 'ms', ['-integer', 'pk']))
+    self.assertEquals(' ORDER BY ms."integer" DESC NULLS LAST',
+                      builder.ordering(SimpleRelatedFieldModel, 'ms', [F('integer').desc(nulls_last=True)]))
+    self.assertEquals(' ORDER BY RANDOM()', builder.ordering(SimpleRelatedFieldModel, 'ms', ['?']))
+    self.assertRaises(ValueError, builder.ordering, SimpleRelatedFieldModel, 'ms', ['model_to_dict__integer'])
+    self.assertRaises(ValueError, builder.ordering, SimpleRelatedFieldModel, 'ms', [Lower('integer')])
+
+  def test_dialect_for(self):
+    class Connection(object):
+      vendor = 'oracle'
+    self.assertTrue(isinstance(dialect_for(connection), JSONDialect))
+    self.assertRaises(ValueError, dialect_for, Connection())
+
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from django.http import Http404
+from django.test import TestCase
+from django.test import RequestFactory
+
+from utils.model_streaming.json_helpers import dumps
+from utils.model_streaming.static_streaming import model_static_to_dict
+from utils.model_streaming.static_metadata import _metadata
+from utils.model_streaming.static_metadata import get_static_metadata
+from utils.model_streaming.static_metadata import clear_static_metadata
+from utils.model_streaming.static_metadata import static_metadata_view
+from utils.tests.model_streaming.model_builder import ModelBuilderMixin
+
+from fakeapp.models import ModelToDictTestModel
+from fakeapp.models import SimpleForeignKey
+
+
+class StaticMetadataTest(ModelBuilderMixin, TestCase):
+  def setUp(self):
+    super(StaticMetadataTest, self).setUp()
+    clear_static_metadata()
+
+  def test_get_static_metadata(self):
+    metadata = get_static_metadata('fakeapp.ModelToDictTestModel')
+    self.assertEquals(model_static_to_dict(ModelToDictTestModel), metadata.data)
+    self.assertEquals(json.loads(dumps(metadata.data)), json.loads(metadata.payload))
+    # Computed once
+    self.assertTrue(metadata is get_static_metadata('fakeapp.ModelToDictTestModel'))
+    self.assertNotEquals(metadata.etag, get_static_metadata('fakeapp.SimpleForeignKey').etag)
+    self.assertRaises(LookupError, get_static_metadata, 'fakeapp.Unknown')
+    # Stored once, whatever the case of the label
+    self.assertTrue(metadata is get_static_metadata('fakeapp.modeltodicttestmodel'))
+    self.assertEquals(['fakeapp.ModelToDictTestModel', 'fakeapp.SimpleForeignKey'], sorted(_metadata))
+
+  def test_static_metadata_view(self):
+    request = RequestFactory().get('/static/fakeapp.ModelToDictTestModel')
+    response = static_metadata_view(request, 'fakeapp.ModelToDictTestModel')
+    self.assertEquals(200, response.status_code)
+    self.assertEquals(json.loads(dumps(model_static_to_dict(ModelToDictTestModel))), json.loads(response.content))
+    etag = response['ETag']
+    request = RequestFactory().get('/static/fakeapp.ModelToDictTestModel', HTTP_IF_NONE_MATCH=etag)
+    response = static_metadata_view(request, 'fakeapp.ModelToDictTestModel')
+    self.assertEquals(304, response.status_code)
+    self.assertEquals(etag, response['ETag'])
+    request = RequestFactory().get('/static/fakeapp.ModelToDictTestModel', HTTP_IF_NONE_MATCH='W/' + etag)
+    self.assertEquals(304, static_metadata_view(request, 'fakeapp.ModelToDictTestModel').status_code)
+    request = RequestFactory().get('/static/fakeapp.Unknown')
+    self.assertRaises(Http404, static_metadata_view, request, 'fakeapp.Unknown')
+
+  def test_combined_static_metadata(self):
+    models = 'fakeapp.SimpleForeignKey,fakeapp.ModelToDictTestModel'
+    response = static_metadata_view(RequestFactory().get('/static', { 'models': models }))
+    expected_outcome = {
+      'fakeapp.ModelToDictTestModel': json.loads(dumps(model_static_to_dict(ModelToDictTestModel))),
+      'fakeapp.SimpleForeignKey': json.loads(dumps(model_static_to_dict(SimpleForeignKey))),
+    }
+    self.assertEquals(expected_outcome, json.loads(response.content))
+    etag = response['ETag']
+    self.assertNotEquals(get_static_metadata('fakeapp.ModelToDictTestModel').etag, etag.strip('"'))
+    # The order of the models does not change the ETag
+    request = RequestFactory().get('/static', { 'models': 'fakeapp.ModelToDictTestModel,fakeapp.SimpleForeignKey' },
+                                   HTTP_IF_NONE_MATCH=etag)
+    self.assertEquals(304, static_metadata_view(request).status_code)
+    # Nor the case of their labels
+    request = RequestFactory().get('/static', { 'models': 'fakeapp.SIMPLEFOREIGNKEY,fakeapp.modeltodicttestmodel' },
+                                   HTTP_IF_NONE_MATCH=etag)
+    self.assertEquals(304, static_metadata_view(request).status_code)
+    response = static_metadata_view(RequestFactory().get('/static', { 'models': 'fakeapp.simpleforeignkey' }))
+    self.assertEquals(['fakeapp.SimpleForeignKey'], list(json.loads(response.content)))
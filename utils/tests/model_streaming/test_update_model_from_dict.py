@@ -1,9 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import warnings
 import datetime
+from decimal import Decimal
 
 from django.test import TestCase
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.db.models.signals import post_save
 from django.core.management import call_command
 from django.db.models import loading
 from django.db.models.loading import load_app
@@ -11,7 +18,20 @@ from django.db.models.loading import load_app
 from fakeapp.models import FakeItem
 from fakeapp.models import FakeItemParent
 from fakeapp.models import FakeItemChildren
+from fakeapp.models import ModelToDictTestModel
+from fakeapp.models import TimestampedModel
 
+from utils.model_streaming.model_streaming import model_to_dict
+
+from utils.model_streaming.update_model_from_dict import bulk_saved
+from utils.model_streaming.update_model_from_dict import diff_related
+from utils.model_streaming.update_model_from_dict import writer_plan
+from utils.model_streaming.update_model_from_dict import SET_VALUE
+from utils.model_streaming.update_model_from_dict import SET_FOREIGN
+from utils.model_streaming.update_model_from_dict import SET_ID
+from utils.model_streaming.update_model_from_dict import RELATED_LIST
+from utils.model_streaming.update_model_from_dict import PRIMARY_KEY
+from utils.model_streaming.update_model_from_dict import bulk_update_model_from_dict
 from utils.model_streaming.update_model_from_dict import update_model_from_dict
 
 
@@ -106,3 +126,219 @@ class UpdateModelFromDictTest(TestCase):
         self.assertEquals(fake_item_dict['fakeitemchildren_set'][2]['char_field'], fake_item.fakeitemchildren_set.get(id=3).char_field)
         self.assertEquals(fake_item_dict['fakeitemchildren_set'][2]['foreign_key'], fake_item.fakeitemchildren_set.get(id=3).foreign_key.id)
 
+    def test_diff_related(self):
+        existing = dict((pk, FakeItemChildren(pk=pk)) for pk in (1, 2, 3))
+        to_create, to_update, to_delete = diff_related(existing, [{'id': 1}, {'id': 4}, {'char_field': 'new'}])
+        self.assertEquals([{'id': 4}, {'char_field': 'new'}], to_create)
+        self.assertEquals([(existing[1], {'id': 1})], to_update)
+        self.assertEquals([2, 3], sorted(x.pk for x in to_delete))
+
+    # A related list is applied with bulk queries, whatever its size
+    def test_update_related_from_list_bulk(self):
+        parent = FakeItemParent(char_field='fake_item_parent')
+        parent.save()
+        fake_item = FakeItem(char_field="fake_item", integer_field=4, foreign_key=parent,
+                             time_field=datetime.time(hour=10, minute=1))
+        fake_item.save()
+        FakeItemChildren.objects.bulk_create([FakeItemChildren(char_field='child%i' % i, foreign_key=fake_item)
+                                              for i in range(1000)])
+        children = list(FakeItemChildren.objects.filter(foreign_key=fake_item).order_by('pk'))
+        # 500 updated, 250 untouched, 250 deleted, 300 created
+        fake_item_dict = {
+            'fakeitemchildren_set':
+                [{'id': x.id, 'char_field': x.char_field + '_updated'} for x in children[:500]] +
+                [{'id': x.id, 'char_field': x.char_field} for x in children[500:750]] +
+                [{'char_field': 'new%i' % i, 'foreign_key': fake_item.id} for i in range(300)]
+        }
+        # One bulk_saved signal per bulk query, post_save still sent for each
+        # instance
+        sent = []
+        saved = []
+
+        def receiver(sender, instances, created, **kwargs):
+            sent.append((sender, len(instances), created))
+
+        def post_save_receiver(sender, instance, created, **kwargs):
+            saved.append((instance.pk, created, kwargs.get('bulk', False)))
+        bulk_saved.connect(receiver)
+        post_save.connect(post_save_receiver, sender=FakeItemChildren)
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                update_model_from_dict(fake_item, fake_item_dict)
+        finally:
+            bulk_saved.disconnect(receiver)
+            post_save.disconnect(post_save_receiver, sender=FakeItemChildren)
+        self.assertTrue(len(queries) < 20)
+        self.assertEquals([(FakeItemChildren, 300, True), (FakeItemChildren, 500, False)], sent)
+        self.assertEquals(800, len(saved))
+        self.assertEquals(300, len([pk for pk, created, bulk in saved if created and pk is not None and bulk]))
+        observed_outcome = dict(FakeItemChildren.objects.filter(foreign_key=fake_item).values_list('id', 'char_field'))
+        self.assertEquals(1050, len(observed_outcome))
+        for element in fake_item_dict['fakeitemchildren_set'][:750]:
+            self.assertEquals(element['char_field'], observed_outcome[element['id']])
+        self.assertFalse(any(x.id in observed_outcome for x in children[750:]))
+        self.assertEquals(sorted('new%i' % i for i in range(300)),
+                          sorted(char for char in observed_outcome.values() if char.startswith('new')))
+
+    # An element of a related list whose object belongs to another instance is
+    # moved to this one, not created again
+    def test_update_related_from_list_move(self):
+        for update in (update_model_from_dict, bulk_update_model_from_dict):
+            p1 = FakeItemParent(char_field='p1')
+            p1.save()
+            p2 = FakeItemParent(char_field='p2')
+            p2.save()
+            fake_item = FakeItem(char_field='fake_item', integer_field=4, foreign_key=p1,
+                                 time_field=datetime.time(hour=10, minute=1))
+            fake_item.save()
+            d = model_to_dict(FakeItemParent.objects.get(pk=p2.pk), levels=1)
+            d['fakeitem_set'] = [model_to_dict(fake_item, levels=0)]
+            d['fakeitem_set'][0]['char_field'] = 'fake_item_moved'
+            changes = update(FakeItemParent.objects.get(pk=p2.pk), d)
+            fake_item = FakeItem.objects.get(pk=fake_item.pk)
+            self.assertEquals((p2.pk, 'fake_item_moved'), (fake_item.foreign_key_id, fake_item.char_field))
+            self.assertEquals(0, p1.fakeitem_set.count())
+            self.assertEquals(set(['fakeitem_set']), changes[('FakeItemParent', p2.pk)])
+            self.assertEquals(set(['foreign_key', 'char_field']), changes[('FakeItem', fake_item.pk)])
+
+    # Only the changed fields are written, nothing if none changed
+    def test_update_model_from_dict_changes(self):
+        parent = FakeItemParent(char_field='fake_item_parent')
+        parent.save()
+        fake_item = FakeItem(char_field="fake_item", integer_field=4, foreign_key=parent,
+                             time_field=datetime.time(hour=10, minute=1))
+        fake_item.save()
+        children = FakeItemChildren(char_field="fake_item_children", foreign_key=fake_item)
+        children.save()
+        fake_item_dict = {
+            'id'                   : fake_item.id,
+            'char_field'           : 'fake_item',
+            'integer_field'        : 4,
+            'foreign_key'          : parent.id,
+            'time_field'           : '10:01:00',
+            'fakeitemchildren_set' : [{'id': children.id, 'char_field': 'fake_item_children'}]
+        }
+        with CaptureQueriesContext(connection) as queries:
+            changes = update_model_from_dict(FakeItem.objects.get(pk=fake_item.id), fake_item_dict)
+        self.assertEquals({}, changes)
+        self.assertFalse(any(query['sql'].startswith(('UPDATE', 'INSERT', 'DELETE')) for query in queries))
+        fake_item_dict['integer_field'] = 8
+        fake_item_dict['fakeitemchildren_set'] = [{'char_field': 'fake_item_new_children'}]
+        with CaptureQueriesContext(connection) as queries:
+            changes = update_model_from_dict(FakeItem.objects.get(pk=fake_item.id), fake_item_dict)
+        new_children = FakeItemChildren.objects.get(foreign_key=fake_item)
+        self.assertEquals({
+            ('FakeItem', fake_item.id): set(['integer_field', 'fakeitemchildren_set']),
+            ('FakeItemChildren', children.id): None,
+            ('FakeItemChildren', new_children.id): set(['id', 'char_field', 'foreign_key', 'non_mandatory_field']),
+        }, changes)
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEquals(1, len(updates))
+        self.assertTrue('integer_field' in updates[0] and 'char_field' not in updates[0])
+        self.assertEquals(8, FakeItem.objects.get(pk=fake_item.id).integer_field)
+
+    # The unit of work gives the same outcome with a number of queries that
+    # does not grow with the number of objects
+    def test_bulk_update_model_from_dict(self):
+        def build():
+            parent = FakeItemParent(char_field='fake_item_parent')
+            parent.save()
+            for i in range(20):
+                fake_item = FakeItem(char_field='item%i' % i, integer_field=i, foreign_key=parent,
+                                     time_field=datetime.time(hour=10, minute=1))
+                fake_item.save()
+                for j in range(5):
+                    FakeItemChildren(char_field='child%i.%i' % (i, j), foreign_key=fake_item).save()
+            items = list(parent.fakeitem_set.order_by('pk'))
+            return parent, {
+                'char_field': 'fake_item_parent_updated',
+                'fakeitem_set':
+                    # 10 items updated, their children updated, removed and added
+                    [{'id': item.id, 'char_field': item.char_field + '_updated',
+                      'fakeitemchildren_set':
+                          [{'id': child.id, 'char_field': child.char_field + '_updated'}
+                           for child in item.fakeitemchildren_set.order_by('pk')[:3]] +
+                          [{'char_field': 'new_child'}]}
+                     for item in items[:10]] +
+                    # 5 items unchanged, 5 removed, 5 added with children
+                    [{'id': item.id, 'char_field': item.char_field} for item in items[10:15]] +
+                    [{'char_field': 'new_item%i' % i, 'integer_field': i, 'time_field': '12:00:00',
+                      'fakeitemchildren_set': [{'char_field': 'new_child%i' % j} for j in range(3)]}
+                     for i in range(5)]
+            }
+
+        def outcome(parent):
+            return sorted((item.char_field, sorted(child.char_field for child in item.fakeitemchildren_set.all()))
+                          for item in FakeItem.objects.filter(foreign_key=parent))
+
+        parent, d = build()
+        expected_changes = update_model_from_dict(FakeItemParent.objects.get(pk=parent.pk), d)
+        expected_outcome = outcome(parent)
+        parent, d = build()
+        with CaptureQueriesContext(connection) as queries:
+            changes = bulk_update_model_from_dict(FakeItemParent.objects.get(pk=parent.pk), d)
+        self.assertEquals(expected_outcome, outcome(parent))
+        self.assertEquals('fake_item_parent_updated', FakeItemParent.objects.get(pk=parent.pk).char_field)
+        self.assertEquals(len(expected_changes), len(changes))
+        self.assertEquals(sorted(sorted(names) for names in expected_changes.values() if names is not None),
+                          sorted(sorted(names) for names in changes.values() if names is not None))
+        self.assertTrue(len(queries) < 20)
+
+    def test_writer_plan(self):
+        plan = writer_plan(FakeItem)
+        # Compiled once
+        self.assertTrue(plan is writer_plan(FakeItem))
+        self.assertEquals(PRIMARY_KEY, plan.actions['id'][0])
+        self.assertEquals(SET_VALUE, plan.actions['char_field'][0])
+        self.assertEquals(SET_FOREIGN, plan.actions['foreign_key'][0])
+        self.assertEquals(SET_ID, plan.actions['foreign_key_id'][0])
+        self.assertEquals(RELATED_LIST, plan.actions['fakeitemchildren_set'][0])
+        self.assertFalse('_ms_type' in plan.actions)
+        # The conversions of the model_to_dict representation
+        actions = writer_plan(ModelToDictTestModel).actions
+        def convert(key, value):
+            return actions[key][2](value)
+        self.assertEquals('B', convert('option', {'selected': 1, 'options': []}))
+        self.assertEquals(5, int(convert('bitfield', [{'checked': True}, {'checked': False}, {'checked': True}])))
+        self.assertEquals(datetime.date(2008, 8, 9), convert('date', '2008-08-09T00:00:00'))
+        self.assertEquals(Decimal('1.25'), convert('decimal', '1.25'))
+        # Read in UTC with USE_TZ, as model_to_dict writes it
+        expected_datetime = datetime.datetime(2008, 8, 9, 16, 0)
+        if settings.USE_TZ:
+            expected_datetime = timezone.make_aware(expected_datetime, datetime.timezone.utc)
+        self.assertEquals(expected_datetime, convert('datetime', '2008-08-09T16:00:00'))
+        self.assertEquals('invalid', convert('integer', 'invalid'))
+
+    # The ForeignKeys output as references are not loaded
+    def test_update_model_from_dict_references(self):
+        parent = FakeItemParent.objects.create(char_field='fake_item_parent')
+        item = FakeItem.objects.create(char_field='fake_item', integer_field=1, foreign_key=parent,
+                                       time_field='12:00:00')
+        d = model_to_dict(FakeItem.objects.get(pk=item.pk), max_depth=0)
+        self.assertEquals({'id': parent.pk, '_ms_type': 'FakeItemParent'}, d['foreign_key'])
+        item = FakeItem.objects.get(pk=item.pk)
+        with self.assertNumQueries(0):
+            self.assertEquals({}, update_model_from_dict(item, d))
+
+    # The datetimes of the output have no time zone and no microseconds: an
+    # unchanged datetime keeps its stored value, a new one is read in UTC as
+    # the output is written, whatever the time zone
+    @override_settings(USE_TZ=True, TIME_ZONE='Europe/Paris')
+    def test_update_model_from_dict_timezone(self):
+        instance = TimestampedModel.objects.create(char='timestamped')
+        instance = TimestampedModel.objects.get(pk=instance.pk)
+        stored = (instance.added, instance.modified)
+        d = model_to_dict(instance)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEquals({}, update_model_from_dict(instance, d))
+            instance = TimestampedModel.objects.get(pk=instance.pk)
+            self.assertEquals(stored, (instance.added, instance.modified))
+            d['added'] = '2008-08-09T16:00:00'
+            self.assertEquals({('TimestampedModel', instance.pk): set(['added'])},
+                              update_model_from_dict(instance, d))
+        instance = TimestampedModel.objects.get(pk=instance.pk)
+        self.assertEquals(timezone.make_aware(datetime.datetime(2008, 8, 9, 16, 0), datetime.timezone.utc),
+                          instance.added)
+        # The output written back gives the same output
+        self.assertEquals('2008-08-09T16:00:00', model_to_dict(instance)['added'])